@@ -3,9 +3,21 @@ Preprocess Video Frames Script
 
 This script performs the following steps:
   1. Iterates over each .avi file in the input directory.
-  2. Loads the video frames (extracting one frame per second).
+  2. Streams the video frames (extracting FRAMES frames per second).
   3. Crops each frame to the region of interest and applies CLAHE enhancement.
   4. Saves the processed frames to an output directory (organized by video filename).
+  5. With ROI_GRAY, frames are decoded to gray where the backend allows (see
+     frameSampler.open_gray_video) and, once the well is known, watershed,
+     mask and CLAHE run only on the single-channel well ROI instead of the
+     full BGR frame. Otsu then thresholds the ROI histogram instead of the
+     whole frame's, so the masks can differ slightly from the full-frame path.
+  6. Images are encoded and written on background threads (see asyncWriter.py),
+     so JPEG encoding no longer stalls decoding and preprocessing.
+  7. With SEGMENTATION = 'background', the mask comes from a running median
+     background of the sampled frames (see backgroundModel.py) instead of a
+     per-frame Otsu threshold, so static debris is not segmented.
+  8. Optionally (SAVE_MASKS) keeps the binary watershed mask of every frame in a
+     run-length-encoded mask store (<video>.masks, see maskRLE.py).
 
 Requirements:
   - OpenCV
@@ -15,11 +27,32 @@ Requirements:
 import os
 import cv2
 import numpy as np
+from frameSampler import sample_video_frames, adaptive_sample_video_frames
+from circleCache import CircleRegistry, CIRCLE_PARAMS
+from preprocessContext import PreprocessContext
+from frameStore import FrameStoreWriter
+from manifest import Manifest, content_hash
+from maskRLE import MaskWriter
+from asyncWriter import AsyncImageWriter
+from backgroundModel import BackgroundModel
+import instrumentation as inst
 
 # Define input and output paths
 video_path = 'C:/Users/linus/NematodeAI/0_Data/Videos/2025.03.24_gemischte Stadien aus Fermenterlauf D31220_Tag 11/1zu100/C0134.MP4'   # Replace with your video path
 output_dir =  'linus/NematodeAI/0_Data/Frames'  # Output directory for processed frames
 FRAMES = 4  # Number of frames to extract per second
+SAMPLING = 'fixed'       # 'fixed': FRAMES per second, 'adaptive': only frames with new content
+MOTION_THRESHOLD = 2.0   # Adaptive: mean grey-level change that counts as new content
+MIN_INTERVAL = 0.5       # Adaptive: seconds between kept frames, at least
+MAX_INTERVAL = 10.0      # Adaptive: seconds between kept frames, at most
+OUTPUT_BACKEND = 'files'  # 'files': one JPEG per frame, 'store': chunked frame store (<video>.frames)
+STAGE = '1_VideoToFrames'  # Stage name recorded in the output manifest
+PROFILE = False            # Write a per-stage timing report (<video>_run_report.json/.prom)
+SAVE_MASKS = False         # Also store the cropped watershed masks as RLE (<video>.masks)
+ROI_GRAY = False           # Decode to gray and run watershed/mask/CLAHE on the well ROI only
+SEGMENTATION = 'otsu'     # 'otsu': per-frame watershed(), 'background': temporal background model
+IMAGE_FORMAT = 'jpg'       # 'files' backend image format: 'jpg', 'png' or 'webp'
+IMAGE_QUALITY = 95         # JPEG / WebP quality (PNG compression: asyncWriter.PNG_COMPRESSION)
 
 # -------------------------------
 # Helper Functions
@@ -33,41 +66,28 @@ def preprocess_frame(frame, clahe):
     enhanced_frame = clahe.apply(gray_frame)
     return cv2.cvtColor(enhanced_frame, cv2.COLOR_GRAY2BGR)
 
-def load_video_frames(video_path):
+def load_video_frames(video_path, frames_per_second=FRAMES, motion_log=None):
     """
-    Load video frames into a list of numpy arrays.
-    Extracts one frame per second.
+    Lazily load video frames as numpy arrays.
+    Yields (frame_idx, timestamp_s, frame) for FRAMES frames per second of video;
+    skipped frames are never decoded (see frameSampler.sample_video_frames).
+    With SAMPLING = 'adaptive', frames are probed at FRAMES per second and only
+    those with new content are yielded; the per-frame motion scores and the
+    reason each frame was kept are written to motion_log (CSV).
     """
-
-    if not os.path.exists(video_path):
-        print(f"Error: File does not exist at {video_path}")
-    
-    cap = cv2.VideoCapture(str(video_path))
-        # Check if video opened successfully
-    if not cap.isOpened():
-        print(f"Error: Could not open video file: {video_path}")
-        return []
-                               
-    frame_interval = 1             # One frame per second
-    frame_count = 0
-    frames = []
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        if frame_count % frame_interval == 0:
-            frames.append(frame)
-        frame_count += 1
-
-    cap.release()
-    return frames
+    if SAMPLING == 'adaptive':
+        for frame_idx, timestamp, frame, _ in adaptive_sample_video_frames(
+                video_path, MOTION_THRESHOLD, MIN_INTERVAL, MAX_INTERVAL, frames_per_second, motion_log,
+                gray=ROI_GRAY):
+            yield frame_idx, timestamp, frame
+    else:
+        yield from sample_video_frames(video_path, frames_per_second, gray=ROI_GRAY)
 
 def watershed (img):
     """""
-    Apply watershed algorithm to an image.
+    Apply watershed algorithm to an image (BGR or grayscale).
     """""
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
     ret, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     # noise removal
     kernel = np.ones((3, 3), np.uint8)
@@ -76,12 +96,19 @@ def watershed (img):
     sure_bg = cv2.dilate(opening, kernel, iterations=3)
     return sure_bg
 
+def background_watershed(img, model):
+    """
+    Foreground of an image (BGR or grayscale) against the temporal background
+    model, dilated like the sure background of watershed().
+    """
+    return cv2.dilate(model.apply(img), np.ones((3, 3), np.uint8), iterations=3)
+
 def houghCircle (img, param1, param2, minRadius, maxRadius):
     """"
     Apply Hough Circle Transform to an image. Returns array of circles detected [centerx, centery, radius].
     """""
     circles = cv2.HoughCircles(img,cv2.HOUGH_GRADIENT,1,20,
-                            param1=40,param2=20,minRadius=900,maxRadius=1100)
+                            param1=param1,param2=param2,minRadius=minRadius,maxRadius=maxRadius)
     return circles
 
 def crop_image(img, x, y, r, tolerance):
@@ -126,49 +153,147 @@ def clahe(img):
 # Main Processing Script
 # -------------------------------
 
-def main():
+def process_video(video_path, output_dir):
+    """
+    Extract, crop and enhance the frames of one video into output_dir.
+    Returns the number of frames read, or None if the video was up to date.
+    """
     os.makedirs(output_dir, exist_ok=True)
-        
     print(f"Processing video: {video_path}")
     
-    # Load frames (FRAMES per second)
-    frames = load_video_frames(video_path)
-    if not frames:
-        print(f"WARNING: No frames extracted from video.")
-        exit(1)
-       
     # Create output directory using video filename
     base_name = os.path.splitext(os.path.basename(video_path))[0]
     video_output_dir = os.path.join(output_dir, base_name)
-    os.makedirs(video_output_dir, exist_ok=True)
+    artifact = video_output_dir + '.frames' if OUTPUT_BACKEND == 'store' else video_output_dir
+
+    # Skip the video if it was already processed from the same content with the same parameters
+    manifest = Manifest(os.path.join(output_dir, '.manifest.json'))
+    video_hash = content_hash(video_path)
+    params = {'frames_per_second': FRAMES, 'sampling': SAMPLING, 'circle': CIRCLE_PARAMS,
+              'tolerance': 10, 'clahe': [2.0, [8, 8]], 'backend': OUTPUT_BACKEND}
+    if SAMPLING == 'adaptive':
+        params['motion'] = [MOTION_THRESHOLD, MIN_INTERVAL, MAX_INTERVAL]
+    if SAVE_MASKS:
+        params['masks'] = 'rle'
+    if ROI_GRAY:
+        params['roi_gray'] = True
+    if SEGMENTATION == 'background':
+        params['segmentation'] = 'background'
+    if OUTPUT_BACKEND == 'files' and (IMAGE_FORMAT, IMAGE_QUALITY) != ('jpg', 95):
+        # cv2.imwrite's JPEG default is quality 95, so earlier outputs stay valid
+        params['format'] = [IMAGE_FORMAT, IMAGE_QUALITY]
+    if manifest.is_up_to_date(artifact, video_hash, STAGE, params):
+        print(f"Up to date, skipping: {artifact}")
+        return None
+
+    writer = None
+    if OUTPUT_BACKEND == 'files':
+        os.makedirs(video_output_dir, exist_ok=True)
+        writer = AsyncImageWriter(quality=IMAGE_QUALITY)
+    store = None
+    masks = None
     
-    # Save each processed frame as an image file
-    for idx, frame in enumerate(frames):
-        output_filename = f"{base_name}_frame_{idx}.jpg"
+    # Detect the well once per video and re-check it periodically for drift
+    registry = CircleRegistry(video_path)
+    # Masks, CLAHE object and output buffers are reused between frames
+    ctx = PreprocessContext()
+    model = BackgroundModel() if SEGMENTATION == 'background' else None
+    segment = (lambda img: background_watershed(img, model)) if model is not None else watershed
+
+    def saved(output_path):
+        # Called by the writer once the image is on disk
+        manifest.record(output_path, video_path, video_hash, STAGE, params)
+        print(f"Saved preprocessed frame: {output_path}")
+
+    # Stream frames (FRAMES per second) and save each processed frame as an image file
+    frame_count = 0
+    dropped = 0
+    motion_log = os.path.join(output_dir, base_name + '_motion.csv')
+    for idx, timestamp, frame in load_video_frames(video_path, motion_log=motion_log):
+        frame_count += 1
+        output_filename = f"{base_name}_frame_{idx}.{IMAGE_FORMAT}"
         output_path = os.path.join(video_output_dir, output_filename)
-        print(f"Processing frame {idx + 1}/{len(frames)}: {output_filename}")
+        # Frames written by an interrupted earlier run are kept (the mask store is rewritten as a whole)
+        if OUTPUT_BACKEND == 'files' and not SAVE_MASKS and manifest.is_up_to_date(output_path, video_hash, STAGE, params):
+            inst.count('frames_up_to_date')
+            continue
+        print(f"Processing frame {frame_count}: {output_filename}")
 
         # Apply preprocessing steps
 
-        # Apply watershed algorithm
-        watershed_img = watershed(frame)
-        # Apply Hough Circle Transform
-        circles = houghCircle(watershed_img, 40, 20, 990, 1030)
+        # Look up the well circle (cached, Hough only on first frame or drift)
+        circle = registry.get(frame)
         
-        if circles is not None:
-            print(f"Circle detected in {output_filename}")
-            circles = np.uint16(np.around(circles))
-            max_circle = max(circles[0, :], key=lambda x: x[2])
-            x, y, r = max_circle
-            # Crop the image to the region of interest
-            cropped_img = crop_image(watershed_img, x, y, r, 10)
-            masked_image = mask_image(cropped_img, r)
-            masked_image = clahe(masked_image)
+        if circle is not None:
+            x, y, r = circle
+            if ROI_GRAY:
+                # Crop first; watershed only sees the (single-channel) well ROI
+                with inst.stage('crop'):
+                    cropped_img = crop_image(frame, x, y, r, 10)
+                with inst.stage('watershed'):
+                    cropped_img = segment(cropped_img)
+            else:
+                # Apply watershed algorithm
+                with inst.stage('watershed'):
+                    watershed_img = segment(frame)
+                # Crop the image to the region of interest
+                with inst.stage('crop'):
+                    cropped_img = crop_image(watershed_img, x, y, r, 10)
+            with inst.stage('mask'):
+                masked_image = ctx.mask_image(cropped_img, r)
+            if SAVE_MASKS:
+                with inst.stage('rle'):
+                    if masks is None:
+                        masks = MaskWriter(video_output_dir + '.masks', masked_image.shape, source=video_path)
+                    masks.append_mask(idx, masked_image)
+            with inst.stage('clahe'):
+                masked_image = ctx.apply_clahe(masked_image)
             # Save the processed image
-            cv2.imwrite(output_path, masked_image)
-            print(f"Saved preprocessed frame: {output_path}")
+            with inst.stage('write'):
+                if OUTPUT_BACKEND == 'store':
+                    if store is None:
+                        store = FrameStoreWriter(video_output_dir + '.frames', masked_image.shape, source=video_path)
+                    store.append(masked_image, name=output_filename, source=video_path,
+                                 frame_idx=idx, timestamp=timestamp, circle=circle)
+                else:
+                    # The CLAHE output buffer is reused for the next frame
+                    writer.write(output_path, masked_image.copy(), done=lambda path=output_path: saved(path))
+            inst.count('frames_written')
         else:
+            inst.count('frames_dropped')
+            dropped += 1
             print(f"No circles detected in {output_filename}")        
 
+    if writer is not None:
+        writer.close()
+    if store is not None:
+        store.close()
+        print(f"Saved {store.count} frames to store: {store.path}")
+    if masks is not None:
+        masks.close()
+        print(f"Saved {masks.count} watershed masks to: {masks.path}")
+
+    if frame_count == 0:
+        manifest.close()
+        print(f"WARNING: No frames extracted from video.")
+        return 0
+
+    if dropped or (writer is not None and writer.failed):
+        # Only the frames that were written are recorded; the next run retries the rest
+        print(f"WARNING: {dropped} frames dropped, {len(writer.failed) if writer else 0} failed to write; "
+              f"{artifact} stays incomplete")
+    else:
+        manifest.record(artifact, video_path, video_hash, STAGE, params)
+    manifest.close()
+    report_path = os.path.join(output_dir, base_name + '_run_report')
+    inst.write_report(report_path + '.json', prometheus_path=report_path + '.prom')
+    return frame_count
+
+def main():
+    if PROFILE:
+        inst.enable(STAGE)
+    if process_video(video_path, output_dir) == 0:
+        exit(1)
+
 if __name__ == "__main__":
     main()
@@ -8,12 +8,16 @@ containing nematodes. It applies several image processing techniques including:
 - Optional CLAHE enhancement for contrast improvement
 The script processes all images in a specified input directory and saves the 
 processed images to an output directory with '_cropped' suffix.
+Images are processed in parallel by WORKERS processes in chunks of CHUNK_SIZE
+images; progress is reported in images/sec. Each worker encodes its output
+images on a background thread (see asyncWriter.py). Inputs are hashed for the
+manifest by the workers; the parent only stats files it has seen before.
 Dependencies:
     - OpenCV (cv2)
     - NumPy
     - OS
 Input:
-    - Directory containing .jpg or .png microscopy images
+    - Directory containing .jpg or .png microscopy images, or a frame store (see frameStore.py)
 Output:
     - Processed images saved in a new directory with '_cropped' suffix
     - Each output image is cropped and masked to the detected circular well
@@ -22,8 +26,25 @@ Example:
 """
 
 import os
+import time
+import hashlib
+import multiprocessing
 import cv2
 import numpy as np
+from circleCache import CircleRegistry
+from preprocessContext import get_context
+from frameStore import FrameStore, FrameStoreWriter, is_frame_store
+from manifest import Manifest, content_hash, file_stat
+from asyncWriter import AsyncImageWriter
+import instrumentation as inst
+
+IMG_DIR = 'NematodeAI/Data/C0105.MP4_processedFrames/C0105'
+WORKERS = os.cpu_count()  # Number of worker processes (1 = run in this process)
+CHUNK_SIZE = 32           # Images per work unit sent to a worker
+OUTPUT_BACKEND = 'files'  # 'files': one image per frame, 'store': chunked frame store
+STAGE = '2_CropFrames'    # Stage name recorded in the output manifest
+DETECT_ATTEMPTS = 3       # Images the parent tries to detect the well on before leaving it to the workers
+PROFILE = False           # Write a per-stage timing report (<output_dir>_run_report.json/.prom)
 
 # -------------------------------
 # Helper Functions
@@ -47,7 +68,7 @@ def houghCircle (img, param1, param2, minRadius, maxRadius):
     Apply Hough Circle Transform to an image. Returns array of circles detected [centerx, centery, radius].
     """""
     circles = cv2.HoughCircles(img,cv2.HOUGH_GRADIENT,1,20,
-                            param1=40,param2=20,minRadius=900,maxRadius=1100)
+                            param1=param1,param2=param2,minRadius=minRadius,maxRadius=maxRadius)
     return circles
 
 def crop_image(img, x, y, r, tolerance):
@@ -76,47 +97,293 @@ def clahe(img):
     img = clahe.apply(gray)
     return img
 
+# -------------------------------
+# Batch Processing
+# -------------------------------
+
+_registry = None  # Per-process circle registry (set by init_worker)
+_store = None     # Per-process input frame store, if the input is a store
+
+def init_worker(img_dir, profile=False, circle_params=None):
+    """
+    Pool initializer: every worker process loads the shared circle cache
+    (and opens the input frame store) once.
+    """
+    global _registry, _store
+    if profile:
+        # Fresh recorder per worker; metrics are sent back with every chunk
+        inst.enable(STAGE)
+    _registry = CircleRegistry(img_dir, params=circle_params)
+    _store = FrameStore(img_dir) if is_frame_store(img_dir) else None
+
+def load_name(item):
+    """
+    Output filename for an image path or a position in the input frame store.
+    """
+    if isinstance(item, int):
+        return _store.index[item]['name']
+    return os.path.basename(item)
+
+def load_image(item):
+    """
+    (name, BGR image or None) for an image path or a position in the input frame store.
+    """
+    with inst.stage('read'):
+        if isinstance(item, int):
+            return _store.index[item]['name'], np.asarray(_store[item])
+        return os.path.basename(item), cv2.imread(item, cv2.IMREAD_COLOR)
+
+def process_image(item, output_dir, registry, keep=False, writer=None):
+    """
+    Read, crop, mask and CLAHE-enhance a single image and write it under the same
+    filename into output_dir (queued on an asyncWriter.AsyncImageWriter if one is
+    given). Returns (message, name, circle, image); message is None on success
+    and image is only returned (copied) when keep=True.
+    """
+    # Resolved before reading, so a failed read is still reported under the file name
+    filename = load_name(item)
+    try:
+        _, img = load_image(item)
+        if img is None:
+            return f"Error reading image: {filename}", filename, None, None
+
+        # Look up the well circle (cached, Hough only on first image or drift)
+        circle = registry.get(img)
+        if circle is None:
+            inst.count('frames_dropped')
+            return f"No circles detected in {filename}", filename, None, None
+
+        x, y, r = circle
+        # Crop the image to the region of interest
+        ctx = get_context()
+        with inst.stage('crop'):
+            cropped_img = crop_image(img, x, y, r, 10)
+        with inst.stage('mask'):
+            masked_image = ctx.mask_image(cropped_img, r)
+        with inst.stage('clahe'):
+            masked_image = ctx.apply_clahe(masked_image)
+        if keep:
+            return None, filename, circle, masked_image.copy()
+        # Save the processed image
+        output_path = os.path.join(output_dir, filename)
+        with inst.stage('write'):
+            if writer is not None:
+                # The CLAHE output buffer is reused for the next image
+                writer.write(output_path, masked_image.copy())
+            else:
+                cv2.imwrite(output_path, masked_image)
+        return None, filename, circle, None
+    except Exception as e:
+        inst.count('errors')
+        return f"Error processing {filename}: {str(e)}", filename, None, None
+
+def hash_item(item):
+    """
+    (content hash, file_stat or None) of an image file or of a frame in the input frame store.
+    """
+    if isinstance(item, int):
+        return hashlib.sha1(np.ascontiguousarray(_store[item]).data).hexdigest(), None
+    stat = file_stat(item)
+    return content_hash(item), stat
+
+def hash_chunk(items):
+    """
+    Worker entry point: content hashes of one chunk of images.
+    """
+    return [hash_item(item)[0] for item in items]
+
+def process_chunk(args):
+    """
+    Worker entry point: hash and process one chunk of images. An image whose
+    hash equals the one its output was recorded with (expected) is skipped.
+    Returns (count, skipped, results, metrics); every result ends with the
+    input hash and stat for the manifest.
+    """
+    items, output_dir, keep, known, expected = args
+    if _registry.circle is None and known[0] is not None:
+        # Start from the parent's detection instead of running Hough in every worker
+        _registry.seed(*known)
+    skipped = 0
+
+    def run(writer):
+        nonlocal skipped
+        results = []
+        for item, recorded in zip(items, expected):
+            with inst.stage('hash'):
+                h, stat = hash_item(item)
+            if recorded is not None and h == recorded:
+                skipped += 1
+                result = (None, load_name(item), None, None)
+            else:
+                result = process_image(item, output_dir, _registry, keep, writer)
+            results.append(result + (h, stat))
+        return results
+
+    if keep:
+        results = run(None)
+    else:
+        # One encoder thread per process overlaps writing with reading the next image;
+        # the chunk is only reported once all of its files are on disk
+        with AsyncImageWriter(workers=1) as writer:
+            results = run(writer)
+        for i, (message, name, _, _, h, stat) in enumerate(results):
+            error = writer.failed.get(os.path.join(output_dir, name))
+            if message is None and error:
+                results[i] = (f"Error writing {name}: {error}", name, None, None, h, stat)
+    return len(items), skipped, results, inst.drain()
+
+def run_chunks(fn, chunks, workers, initargs, ordered=True):
+    """
+    fn(chunk) for every chunk, in this process (workers=1) or on a pool of
+    workers set up by init_worker(*initargs); in chunk order unless ordered=False.
+    """
+    if workers == 1:
+        yield from map(fn, chunks)
+        return
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+        yield from (pool.imap(fn, chunks) if ordered else pool.imap_unordered(fn, chunks))
+
+def list_images(img_dir):
+    """
+    Sorted list of the .jpg/.png images in a directory, or the frame
+    positions if img_dir is a frame store.
+    """
+    if is_frame_store(img_dir):
+        return list(range(len(FrameStore(img_dir))))
+    return [os.path.join(img_dir, f) for f in sorted(os.listdir(img_dir))
+            if f.endswith('.jpg') or f.endswith('.png')]
+
+def crop_directory(img_dir, output_dir=None, workers=WORKERS, chunk_size=CHUNK_SIZE, backend=OUTPUT_BACKEND,
+                   circle_params=None):
+    """
+    Crop and mask every image of img_dir (an image folder or a frame store) into
+    output_dir (default img_dir + '_cropped'), spread over `workers` processes in
+    chunks of `chunk_size` images. Output files keep their input filename, so
+    results do not depend on scheduling. With backend='store' the crops are
+    written in input order to the frame store output_dir + '.frames'.
+    circle_params overrides the Hough parameters of the well detection
+    (default circleCache.CIRCLE_PARAMS). Returns the number of images cropped.
+    """
+    output_dir = output_dir or img_dir.removesuffix('.frames') + '_cropped'
+    keep = backend == 'store'
+    if not keep:
+        os.makedirs(output_dir, exist_ok=True)
+
+    items = list_images(img_dir)
+    if not items:
+        print(f"No images found in {img_dir}")
+        return 0
+
+    # Skip outputs that are up to date for their input content and parameters. The parent
+    # only stats the inputs; anything it cannot decide is hashed by the workers
+    if PROFILE:
+        inst.enable(STAGE)
+    init_worker(img_dir, circle_params=circle_params)
+    initargs = (img_dir, inst.enabled(), circle_params)
+    manifest = Manifest(os.path.join(os.path.dirname(os.path.abspath(output_dir)), '.manifest.json'))
+    params = {'circle': _registry.params, 'tolerance': 10, 'clahe': [2.0, [8, 8]], 'backend': backend}
+    names = {load_name(item): item for item in items}
+    expected = {}
+    if keep:
+        store_path = output_dir + '.frames'
+        recorded = manifest.recorded_hash(store_path, STAGE, params)
+        if recorded is not None:
+            if _store is None:
+                # A changed file (None) means the store is rebuilt anyway
+                hashes = [manifest.known_hash(item) for item in items]
+            else:
+                hash_chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+                hashes = [h for chunk_hashes in run_chunks(hash_chunk, hash_chunks,
+                                                           max(1, min(workers or 1, len(hash_chunks))), initargs)
+                          for h in chunk_hashes]
+            if None not in hashes and hashlib.sha1(''.join(hashes).encode()).hexdigest() == recorded:
+                print(f"Up to date, skipping: {store_path}")
+                manifest.close()
+                return 0
+    else:
+        pending = []
+        for item in items:
+            recorded = manifest.recorded_hash(os.path.join(output_dir, load_name(item)), STAGE, params)
+            if recorded is not None and isinstance(item, str) and manifest.known_hash(item) == recorded:
+                continue
+            pending.append(item)
+            expected[item] = recorded
+        print(f"{len(items) - len(pending)} images up to date")
+        items = pending
+    total = len(items)
+    if total == 0:
+        manifest.close()
+        return 0
+
+    # Try to detect the well on a few images in the parent; every chunk carries it to its
+    # worker. If it is not found there, the workers keep trying on their own images
+    if _registry.circle is None:
+        for item in items[:DETECT_ATTEMPTS]:
+            _, img = load_image(item)
+            if img is not None and _registry.get(img) is not None:
+                break
+    known = (_registry.circle, _registry.reference)
+
+    chunks = [(chunk, output_dir, keep, known, [expected.get(item) for item in chunk])
+              for chunk in (items[i:i + chunk_size] for i in range(0, total, chunk_size))]
+    workers = max(1, min(workers or 1, len(chunks)))
+    print(f"Processing {total} images with {workers} worker(s)")
+
+    done = 0
+    failed = 0
+    skipped = 0
+    store = None
+    store_hashes = []
+    start = time.perf_counter()
+
+    def report(count, chunk_skipped, results, metrics):
+        nonlocal done, failed, skipped, store
+        inst.merge(metrics)
+        done += count
+        skipped += chunk_skipped
+        for message, name, circle, image, h, stat in results:
+            store_hashes.append(h)
+            if message:
+                failed += 1
+                print(message)
+            elif image is not None:
+                if store is None:
+                    store = FrameStoreWriter(store_path, image.shape, source=img_dir)
+                store.append(image, name=name, source=img_dir, circle=circle)
+            else:
+                item = names[name]
+                manifest.record(os.path.join(output_dir, name), item if isinstance(item, str) else img_dir,
+                                h, STAGE, params, input_stat=stat)
+        elapsed = time.perf_counter() - start
+        print(f"Processed {done}/{total} images ({done / elapsed:.1f} images/sec)")
+
+    # The store is appended in input order; image files can be written in any order
+    for chunk_result in run_chunks(process_chunk, chunks, workers, initargs, ordered=keep):
+        report(*chunk_result)
+
+    if store is not None:
+        store.close()
+        print(f"Saved {store.count} frames to store: {store.path}")
+        # A store missing failed images is not recorded, so the next run rebuilds it
+        if failed == 0:
+            store_hash = hashlib.sha1(''.join(store_hashes).encode()).hexdigest()
+            manifest.record(store_path, img_dir, store_hash, STAGE, params)
+    manifest.close()
+    elapsed = time.perf_counter() - start
+    print(f"Finished {total} images in {elapsed:.1f} s ({total / elapsed:.1f} images/sec, {failed} failed, "
+          f"{skipped} unchanged)")
+    report_path = output_dir + '_run_report'
+    inst.write_report(report_path + '.json', prometheus_path=report_path + '.prom')
+    return total - failed - skipped
+
 def main():
     try:
-        img_dir = os.path.abspath('NematodeAI/Data/C0105.MP4_processedFrames/C0105')
+        img_dir = os.path.abspath(IMG_DIR)
         if not os.path.exists(img_dir):
             raise FileNotFoundError(f"Directory not found: {img_dir}")
-            
-        output_dir = img_dir + '_cropped'
-        os.makedirs(output_dir, exist_ok=True)
-        
-        for filename in os.listdir(img_dir):
-            if filename.endswith('.jpg') or filename.endswith('.png'):
-                try:
-                    img_path = os.path.join(img_dir, filename)
-                    img = cv2.imread(img_path, cv2.IMREAD_COLOR)
-                    if img is None:
-                        print(f"Error reading image: {filename}")
-                        continue
-                        
-                    # Apply watershed algorithm
-                    watershed_img = watershed(img)
-                    # Apply Hough Circle Transform
-                    circles = houghCircle(watershed_img, 40, 20, 990, 1030)
-                    
-                    if circles is not None:
-                        print(f"Circle detected in {filename}")
-                        circles = np.uint16(np.around(circles))
-                        max_circle = max(circles[0, :], key=lambda x: x[2])
-                        x, y, r = max_circle
-                        # Crop the image to the region of interest
-                        cropped_img = crop_image(img, x, y, r, 10)
-                        masked_image = mask_image(cropped_img, r)
-                        masked_image = clahe(masked_image)
-                        # Save the processed image
-                        output_path = os.path.join(output_dir, filename)
-                        cv2.imwrite(output_path, masked_image)
-                    else:
-                        print(f"No circles detected in {filename}")
-                except Exception as e:
-                    print(f"Error processing {filename}: {str(e)}")
+        crop_directory(img_dir, workers=WORKERS, chunk_size=CHUNK_SIZE)
     except Exception as e:
         print(f"Error: {str(e)}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
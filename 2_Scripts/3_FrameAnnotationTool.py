@@ -1,9 +1,10 @@
-
 """
 Frame Annotation Tool for Image Processing
 This script provides a graphical interface for manually annotating points in images.
-Users can click on specific locations in images to mark points with different labels (0, 1, 2).
-The clicked coordinates along with their corresponding labels are saved to a CSV file.
+Users can click on specific locations in images to mark points with different labels (0, 1, 2, 3).
+Every click is committed immediately to an annotation store (SQLite, see
+annotationStore.py), so an interrupted session loses nothing; the classic CSV
+is exported from the store at the end.
 Lables:
 - 0: Bakground (B)
 - 1: Juvenils (J)
@@ -11,95 +12,281 @@ Lables:
 - 3: Adult (A)
 Features:
 - Support for multiple image formats (PNG, JPG, JPEG, BMP)
+- One persistent window; the label is switched with the keys 0-3 instead of reopening the image
 - Interactive point marking with different colors per label
+- Points are drawn with blitting (only the markers are redrawn, not the image)
+- The next images are loaded and downscaled on a background thread while you annotate
 - Backspace to undo last point
 - ESC key to exit the annotation process
-- Automatic saving of annotations to CSV
+- Every click is saved immediately; reopening an image shows its earlier points
+- Automatic export of annotations to CSV
 Usage:
-1. Set IMAGE_DIR to the folder containing your images
+1. Set IMAGE_DIR to the folder containing your images (or a frame store, see frameStore.py)
 2. Run the script
-3. Click points on images for each label category
-4. Close window when done with current label
-5. Press ESC to exit completely
-6. Results are saved to '_clicked_points.csv' in the image directory
+3. Press 0-3 to choose the label, click points on the image
+4. Press 'n' (or Enter / right arrow) for the next image
+5. Press ESC or close the window to exit
+6. Points are stored in '_annotations.db' next to the image directory and
+   exported to '_clicked_points.csv' (an existing CSV is imported into a new store)
+Coordinates are always stored in the resolution of the original image, even
+though large images are displayed downscaled to DISPLAY_SIZE.
 Dependencies:
     - matplotlib
-    - csv
+    - OpenCV
+    - sqlite3
     - os
     - pathlib
 """
 import os
+import queue
+import threading
+import cv2
 import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-import csv
 from pathlib import Path
+from frameStore import FrameStore, is_frame_store
+from annotationStore import AnnotationStore, default_store_path
 
 # Configuration
 IMAGE_DIR = 'C:/Users/linus/NematodeAI/NematodeAI/Data/C0105.MP4_processedFrames/C0105_cropped'  # Change this to your image folder path
 OUTPUT_CSV = IMAGE_DIR + '_clicked_points.csv'
+ANNOTATIONS_DB = default_store_path(IMAGE_DIR)
+DISPLAY_SIZE = 1024   # Longest displayed side in pixels; larger images are downscaled for display
+PREFETCH = 3          # Images loaded ahead on the background thread
 
 # Supported image formats
 IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.bmp']
 
-clicked_data = []
-exit_requested = False
-
-def onclick(event, img_name, label):
-    if event.xdata is not None and event.ydata is not None:
-        x, y = event.xdata, event.ydata
-        print(f"Clicked on {img_name} (Label {label}): ({x:.2f}, {y:.2f})")
-        clicked_data.append((img_name, label, x, y))
-        plt.plot(x, y, 'rx' if label == 0 else 'bx')
-        plt.draw()
-
-def onkey(event):
-    global exit_requested
-    if event.key == 'escape':
-        print("Escape key pressed. Exiting labeling process.")
-        exit_requested = True
-        plt.close()
-
-def clear_last_clicked_data(event):
-    global exit_requested
-    if len(clicked_data) > 0 & event.key == 'backspace':
-        clicked_data.pop()
-        plt.cla()
-        for row in clicked_data:
-            label = row[1]
-            x, y = row[2], row[3]
-            plt.plot(x, y, 'rx' if label == 0 else 'bx')
-        plt.draw()
-
-def process_images(image_dir):
-    global exit_requested
+LABELS = {0: 'Background (B)', 1: 'Juvenile (J)', 2: 'Dauer Juvenile (DJ)', 3: 'Adult (A)'}
+LABEL_MARKERS = {0: 'rx', 1: 'bx', 2: 'gx', 3: 'mx'}
+NEXT_KEYS = ('n', 'enter', 'right')
+UNDO_KEYS = ('backspace',)
+
+# -------------------------------
+# Image Loading
+# -------------------------------
+
+def load_store_frame(store, position):
+    """
+    Frame from a frame store as RGB (stores hold OpenCV BGR frames).
+    """
+    frame = store[position]
+    return frame[..., ::-1] if frame.ndim == 3 else frame
+
+def load_image_file(path):
+    """
+    Image file as RGB (or grayscale) array.
+    """
+    img = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError(f"Could not read {path}")
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB if img.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+    return img
+
+def list_images(image_dir):
+    """
+    (name, loader) pairs for the images of a folder or a frame store.
+    """
+    if is_frame_store(image_dir):
+        store = FrameStore(image_dir)
+        return [(row['name'], lambda i=row['position']: load_store_frame(store, i)) for row in store.index]
     image_files = [f for f in sorted(Path(image_dir).iterdir()) if f.suffix.lower() in IMAGE_EXTENSIONS]
-    for img_path in image_files:
-        if exit_requested:
-            break
-        img_name = img_path.name
-        for label in [0, 1, 2]:  # Only two sets/labels: 0 and 1
-            if exit_requested:
-                break
-            img = mpimg.imread(img_path)
-            fig, ax = plt.subplots()
-            ax.imshow(img)
-            ax.set_title(f"Click points for Label {label} on: {img_name}\nPress ESC to exit\nClose window when done")
-
-            cid_click = fig.canvas.mpl_connect('button_press_event', lambda event: onclick(event, img_name, label))
-            cid_key = fig.canvas.mpl_connect('key_press_event', onkey)
-            cid_key = fig.canvas.mpl_connect('key_press_event', lambda event: clear_last_clicked_data(event))
-            plt.show()
-            fig.canvas.mpl_disconnect(cid_click)
-            fig.canvas.mpl_disconnect(cid_key)
-
-def save_points_to_csv(output_csv):
-    with open(output_csv, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['filename', 'label', 'x', 'y'])
-        for row in clicked_data:
-            writer.writerow(row)
-    print(f"Saved clicked points to {output_csv}")
+    return [(f.name, lambda f=f: load_image_file(f)) for f in image_files]
+
+def downscale(img, max_size=DISPLAY_SIZE):
+    """
+    Shrink an image so its longest side is at most max_size.
+    Returns (display_image, scale) with original = display * scale.
+    """
+    h, w = img.shape[:2]
+    scale = max(h, w) / float(max_size)
+    if scale <= 1:
+        return img, 1.0
+    size = (max(int(round(w / scale)), 1), max(int(round(h / scale)), 1))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA), scale
+
+class Prefetcher:
+    """
+    Loads and downscales the next images on a background thread.
+    Iterating yields (name, display_image, scale) in order.
+    """
+
+    def __init__(self, images, max_size=DISPLAY_SIZE, depth=PREFETCH):
+        self.images = images
+        self.max_size = max_size
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        for name, load in self.images:
+            if self.stop.is_set():
+                return
+            try:
+                img, scale = downscale(load(), self.max_size)
+            except Exception as e:
+                print(f"WARNING: Skipping {name}: {e}")
+                continue
+            if not self._put((name, img, scale)):
+                return
+        self._put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        self.stop.set()
+        self.thread.join(timeout=5)
+
+# -------------------------------
+# Annotation Window
+# -------------------------------
+
+class Annotator:
+    """
+    One persistent figure for all images. Points are drawn with blitting: the
+    rendered image is cached on every full draw and only the marker artists
+    are redrawn when points are added or removed.
+    """
+
+    def __init__(self, images, store, label=0):
+        self.images = iter(images)
+        self.store = store
+        self.label = label
+        self.name = None
+        self.scale = 1.0
+        self.points = []        # (id, label, x, y) of the current image in display coordinates
+        self.background = None
+
+        # The tool's keys must not also trigger matplotlib's toolbar history (forward: 'right', back: 'backspace')
+        for keymap in ('keymap.forward', 'keymap.back'):
+            plt.rcParams[keymap] = [k for k in plt.rcParams[keymap] if k not in NEXT_KEYS + UNDO_KEYS]
+        self.fig, self.ax = plt.subplots()
+        self.ax.set_axis_off()
+        self.image_artist = None
+        self.markers = {l: self.ax.plot([], [], m, animated=True)[0] for l, m in LABEL_MARKERS.items()}
+        canvas = self.fig.canvas
+        canvas.mpl_connect('draw_event', self.on_draw)
+        canvas.mpl_connect('button_press_event', self.onclick)
+        canvas.mpl_connect('key_press_event', self.onkey)
+
+    def next_image(self):
+        """
+        Show the next image. Returns False when there are no images left.
+        """
+        item = next(self.images, None)
+        if item is None:
+            return False
+        self.name, img, self.scale = item
+        self.points = [(i, l, x / self.scale, y / self.scale)
+                       for i, _, l, x, y in self.store.points(self.name, with_ids=True)]
+        if self.points:
+            print(f"{self.name}: {len(self.points)} points from an earlier session")
+        if self.image_artist is None:
+            self.image_artist = self.ax.imshow(img, cmap='gray' if img.ndim == 2 else None)
+        else:
+            self.image_artist.set_data(img)
+            self.image_artist.set_extent((-0.5, img.shape[1] - 0.5, img.shape[0] - 0.5, -0.5))
+            self.ax.set_xlim(-0.5, img.shape[1] - 0.5)
+            self.ax.set_ylim(img.shape[0] - 0.5, -0.5)
+        self.update_markers()
+        self.update_title()
+        return True
+
+    def update_title(self):
+        self.ax.set_title(f"{self.name} - Label {self.label}: {LABELS[self.label]}\n"
+                          f"Keys: 0-3 label, n next image, backspace undo, ESC exit")
+        self.fig.canvas.draw_idle()
+
+    def update_markers(self):
+        for label, line in self.markers.items():
+            xy = [(x, y) for _, l, x, y in self.points if l == label]
+            line.set_data([p[0] for p in xy], [p[1] for p in xy])
+
+    def on_draw(self, event):
+        # Full redraw (new image, title, zoom, resize): cache everything but the markers
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for line in self.markers.values():
+            self.ax.draw_artist(line)
+
+    def blit(self):
+        canvas = self.fig.canvas
+        if self.background is None:
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self.background)
+        for line in self.markers.values():
+            self.ax.draw_artist(line)
+        canvas.blit(self.fig.bbox)
+
+    def onclick(self, event):
+        toolbar = self.fig.canvas.toolbar
+        if event.inaxes is not self.ax or event.xdata is None or (toolbar is not None and toolbar.mode):
+            return
+        x, y = float(event.xdata * self.scale), float(event.ydata * self.scale)
+        print(f"Clicked on {self.name} (Label {self.label}): ({x:.2f}, {y:.2f})")
+        point_id = self.store.add(self.name, self.label, x, y)
+        self.points.append((point_id, self.label, event.xdata, event.ydata))
+        self.update_markers()
+        self.blit()
+
+    def undo(self):
+        if not self.points:
+            return
+        point_id, label, _, _ = self.points.pop()
+        self.store.remove(point_id)
+        print(f"Removed point on {self.name} (Label {label})")
+        self.update_markers()
+        self.blit()
+
+    def onkey(self, event):
+        if event.key == 'escape':
+            print("Escape key pressed. Exiting labeling process.")
+            plt.close(self.fig)
+        elif event.key in UNDO_KEYS:
+            self.undo()
+        elif event.key in NEXT_KEYS:
+            if not self.next_image():
+                print("All images annotated.")
+                plt.close(self.fig)
+        elif event.key is not None and event.key.isdigit() and int(event.key) in LABELS:
+            self.label = int(event.key)
+            self.update_title()
+
+def process_images(image_dir, store):
+    prefetcher = Prefetcher(list_images(image_dir))
+    try:
+        annotator = Annotator(prefetcher, store)
+        if not annotator.next_image():
+            print(f"No images found in {image_dir}")
+            plt.close(annotator.fig)
+            return
+        plt.show()
+    finally:
+        prefetcher.close()
+
+def save_points_to_csv(store, output_csv):
+    store.export_csv(output_csv)
 
 if __name__ == '__main__':
-    process_images(IMAGE_DIR)
-    save_points_to_csv(OUTPUT_CSV)
+    with AnnotationStore(ANNOTATIONS_DB) as store:
+        if store.count() == 0 and os.path.exists(OUTPUT_CSV):
+            store.import_csv(OUTPUT_CSV)
+        try:
+            process_images(IMAGE_DIR, store)
+        finally:
+            save_points_to_csv(store, OUTPUT_CSV)
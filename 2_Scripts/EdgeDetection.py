@@ -1,30 +1,312 @@
-import cv2 as cv
+"""
+Batch Edge Detection
+
+Writes a Canny edge image for every image of a folder (or frame store), e.g.
+the fixed-camera ("feste Kamera") frames of the dead/live counting data.
+
+  - Thresholds are chosen per image from its median intensity m:
+    lower = (1 - SIGMA) * m, upper = (1 + SIGMA) * m, so dark and bright
+    recordings get comparable edge maps without hand-tuned 100/200 values.
+    AUTO_THRESHOLDS = False restores the fixed THRESHOLDS.
+  - Images are processed by WORKERS processes in chunks of CHUNK_SIZE images.
+  - ROI = True runs Canny only inside the well: the circle is detected once
+    (cached by circleCache.CircleRegistry in the input folder) and reused for
+    every image, since the camera does not move. The median is taken inside the
+    well, too, and everything outside it is written as black.
+  - Edge images are encoded on a background thread of each worker (see
+    asyncWriter.py) while the next image is read and processed.
+  - Outputs that are up to date for their input content and parameters are
+    skipped (see manifest.py), so a rerun only processes new or changed images.
+
+Output images keep their input filename.
+
+Usage:
+    python EdgeDetection.py
+    edge_directory(input_dir, output_dir, workers=4, roi=True)
+
+Requirements:
+  - OpenCV
+  - NumPy
+  - Python 3.x
+"""
+
 import os
+import time
+import hashlib
+import multiprocessing
+import cv2 as cv
+import numpy as np
+from frameStore import FrameStore, is_frame_store, IMAGE_EXTENSIONS
+from manifest import Manifest
+from asyncWriter import AsyncImageWriter
+import instrumentation as inst
+
+INPUT_DIR = 'NematodeAI/Data/Images DeadLiveCounting/feste Kamera 1'
+OUTPUT_DIR = 'NematodeAI/Data/Images DeadLiveCounting Edges'
+WORKERS = os.cpu_count()  # Number of worker processes (1 = run in this process)
+CHUNK_SIZE = 32           # Images per work unit sent to a worker
+AUTO_THRESHOLDS = True    # Canny thresholds from the median intensity of each image
+SIGMA = 0.33              # Width of the automatic threshold band around the median
+MEDIAN_STEP = 4           # The median is taken on every 4th pixel in both directions
+THRESHOLDS = (100, 200)   # Fixed Canny thresholds (AUTO_THRESHOLDS = False)
+ROI = False               # Only detect edges inside the (once detected) well circle
+STAGE = 'EdgeDetection'   # Stage name recorded in the output manifest
+PROFILE = False           # Write a per-stage timing report (<output_dir>_run_report.json/.prom)
+
+# -------------------------------
+# Edge Detection
+# -------------------------------
+
+def median_intensity(gray, mask=None, step=MEDIAN_STEP):
+    """
+    Median of a uint8 image (inside mask) from the histogram of every step-th
+    pixel in both directions, much cheaper than np.median over all pixels.
+    """
+    gray = np.ascontiguousarray(gray[::step, ::step])
+    mask = np.ascontiguousarray(mask[::step, ::step]) if mask is not None else None
+    hist = cv.calcHist([gray], [0], mask, [256], [0, 256]).ravel()
+    cumulative = np.cumsum(hist)
+    if cumulative[-1] == 0:
+        return 0
+    return int(np.searchsorted(cumulative, cumulative[-1] / 2))
+
+def auto_thresholds(gray, sigma=SIGMA, mask=None):
+    """
+    (lower, upper) Canny thresholds around the median intensity.
+    """
+    median = median_intensity(gray, mask)
+    return int(max(0, (1 - sigma) * median)), int(min(255, (1 + sigma) * median))
+
+def roi_mask(shape, circle):
+    """
+    Bounding box (x1, y1, x2, y2) of the circle clipped to the image and the
+    circle mask of that box.
+    """
+    h, w = shape[:2]
+    x, y, r = circle
+    x1, y1, x2, y2 = max(x - r, 0), max(y - r, 0), min(x + r + 1, w), min(y + r + 1, h)
+    mask = np.zeros((y2 - y1, x2 - x1), np.uint8)
+    cv.circle(mask, (x - x1, y - y1), r, 255, -1)
+    return (x1, y1, x2, y2), mask
+
+def detect_edges(gray, params, roi=None):
+    """
+    Canny edge image of a grayscale image. roi is (box, mask) from roi_mask;
+    edges are then only computed inside the circle and the rest stays black.
+    """
+    if roi is None:
+        window, mask = gray, None
+    else:
+        (x1, y1, x2, y2), mask = roi
+        window = gray[y1:y2, x1:x2]
+    if params['auto']:
+        with inst.stage('thresholds'):
+            lower, upper = auto_thresholds(window, params['sigma'], mask)
+    else:
+        lower, upper = params['thresholds']
+    with inst.stage('canny'):
+        edges = cv.Canny(window, lower, upper)
+    if roi is None:
+        return edges
+    output = np.zeros_like(gray)
+    cv.bitwise_and(edges, mask, dst=output[y1:y2, x1:x2])
+    return output
+
+# -------------------------------
+# Batch Processing
+# -------------------------------
+
+_store = None  # Per-process input frame store, if the input is a store
+_roi = {}      # Per-process (box, mask) per image shape
+
+def init_worker(input_dir, profile=False):
+    """
+    Pool initializer: open the input frame store once per worker.
+    """
+    global _store
+    if profile:
+        # Fresh recorder per worker; metrics are sent back with every chunk
+        inst.enable(STAGE)
+    _store = FrameStore(input_dir) if is_frame_store(input_dir) else None
+
+def list_images(input_dir):
+    """
+    Sorted image paths of a folder, or the frame positions of a frame store.
+    """
+    if is_frame_store(input_dir):
+        return list(range(len(FrameStore(input_dir))))
+    return [os.path.join(input_dir, f) for f in sorted(os.listdir(input_dir))
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS]
+
+def load_name(item):
+    if isinstance(item, int):
+        return _store.index[item]['name']
+    return os.path.basename(item)
+
+def load_gray(item):
+    """
+    (name, grayscale image or None) for an image path or a frame store position.
+    """
+    with inst.stage('read'):
+        if isinstance(item, int):
+            frame = np.asarray(_store[item])
+            return _store.index[item]['name'], cv.cvtColor(frame, cv.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        return os.path.basename(item), cv.imread(item, cv.IMREAD_GRAYSCALE)
+
+def item_hash(item, manifest):
+    """
+    Content hash of an image file (reused from the manifest while the file is
+    unchanged, see Manifest.input_hash) or of a frame in the input frame store.
+    """
+    if isinstance(item, int):
+        return hashlib.sha1(np.ascontiguousarray(_store[item]).data).hexdigest()
+    return manifest.input_hash(item)
+
+def process_image(item, output_dir, params, writer=None):
+    """
+    Read one image, detect its edges and write them under the same filename
+    (queued on an asyncWriter.AsyncImageWriter if one is given).
+    Returns (message, name); message is None on success.
+    """
+    # Resolved before reading, so a failed read is still reported under the file name
+    filename = load_name(item)
+    try:
+        _, gray = load_gray(item)
+        if gray is None:
+            return f"Error reading image: {filename}", filename
+        roi = None
+        if params['circle'] is not None:
+            if gray.shape not in _roi:
+                _roi[gray.shape] = roi_mask(gray.shape, params['circle'])
+            roi = _roi[gray.shape]
+        edges = detect_edges(gray, params, roi)
+        with inst.stage('write'):
+            if writer is not None:
+                writer.write(os.path.join(output_dir, filename), edges)
+            else:
+                cv.imwrite(os.path.join(output_dir, filename), edges)
+        return None, filename
+    except Exception as e:
+        inst.count('errors')
+        return f"Error processing {filename}: {str(e)}", filename
+
+def process_chunk(args):
+    """
+    Worker entry point: process one chunk of images. Returns (count, results, metrics).
+    """
+    items, output_dir, params = args
+    # The chunk is only reported once all of its files are on disk
+    with AsyncImageWriter(workers=1) as writer:
+        results = [process_image(item, output_dir, params, writer) for item in items]
+    for i, (message, name) in enumerate(results):
+        error = writer.failed.get(os.path.join(output_dir, name))
+        if message is None and error:
+            results[i] = (f"Error writing {name}: {error}", name)
+    return len(items), results, inst.drain()
+
+def detect_roi(input_dir, items):
+    """
+    Well circle (x, y, r) of the folder, from the circle cache or detected on
+    the first readable image. None if no circle is found; that result is
+    cached, too.
+    """
+    from circleCache import CircleRegistry
+
+    registry = CircleRegistry(input_dir)
+    if registry.circle is not None or registry.missing:
+        return registry.circle
+    for item in items:
+        if isinstance(item, int):
+            img = np.asarray(_store[item])
+            img = cv.cvtColor(img, cv.COLOR_GRAY2BGR) if img.ndim == 2 else img
+        else:
+            img = cv.imread(item, cv.IMREAD_COLOR)
+        if img is not None:
+            circle = registry.get(img)
+            if circle is None:
+                registry.mark_missing()
+            return circle
+    return None
+
+def edge_directory(input_dir, output_dir, workers=WORKERS, chunk_size=CHUNK_SIZE, roi=ROI,
+                   auto=AUTO_THRESHOLDS, sigma=SIGMA, thresholds=THRESHOLDS):
+    """
+    Write the edge image of every image of input_dir (an image folder or a frame
+    store) into output_dir, spread over `workers` processes. Images whose output
+    is up to date are skipped. Returns the number of images processed.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if PROFILE:
+        inst.enable(STAGE)
+    init_worker(input_dir)
+    items = list_images(input_dir)
+    if not items:
+        print(f"No images found in {input_dir}")
+        return 0
+
+    circle = None
+    if roi:
+        circle = detect_roi(input_dir, items)
+        if circle is None:
+            print("No well circle detected, processing full images")
+    params = {'auto': auto, 'sigma': sigma, 'thresholds': list(thresholds),
+              'circle': list(circle) if circle is not None else None}
+
+    # Skip outputs that are up to date for their input content and parameters
+    manifest = Manifest(os.path.join(output_dir, '.manifest.json'))
+    hashes = {load_name(item): item_hash(item, manifest) for item in items}
+    items = [item for item in items if not manifest.is_up_to_date(
+        os.path.join(output_dir, load_name(item)), hashes[load_name(item)], STAGE, params)]
+    print(f"{len(hashes) - len(items)} images up to date")
+    total = len(items)
+    if total == 0:
+        manifest.close()
+        return 0
+
+    chunks = [(items[i:i + chunk_size], output_dir, params) for i in range(0, total, chunk_size)]
+    workers = max(1, min(workers or 1, len(chunks)))
+    print(f"Processing {total} images from {input_dir} with {workers} worker(s)")
+
+    done = 0
+    failed = 0
+    start = time.perf_counter()
+
+    def report(count, results, metrics):
+        nonlocal done, failed
+        inst.merge(metrics)
+        done += count
+        for message, name in results:
+            if message:
+                failed += 1
+                print(message)
+            else:
+                manifest.record(os.path.join(output_dir, name), input_dir if _store is not None
+                                else os.path.join(input_dir, name), hashes[name], STAGE, params)
+        elapsed = time.perf_counter() - start
+        print(f"Processed {done}/{total} images ({done / elapsed:.1f} images/sec)")
+
+    try:
+        if workers == 1:
+            for chunk in chunks:
+                report(*process_chunk(chunk))
+        else:
+            with multiprocessing.Pool(workers, initializer=init_worker, initargs=(input_dir, inst.enabled())) as pool:
+                for chunk_result in pool.imap_unordered(process_chunk, chunks):
+                    report(*chunk_result)
+    finally:
+        manifest.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Edge detection completed in {elapsed:.1f} s ({total / elapsed:.1f} images/sec, {failed} failed), "
+          f"images saved to {output_dir}")
+    inst.write_report(output_dir + '_run_report.json', prometheus_path=output_dir + '_run_report.prom')
+    return total
+
+def main():
+    if not os.path.exists(INPUT_DIR):
+        print(f"Error: Directory not found: {INPUT_DIR}")
+        return
+    edge_directory(INPUT_DIR, OUTPUT_DIR)
 
-# Define the input and output directories
-input_dir = 'NematodeAI/Data/Images DeadLiveCounting/feste Kamera 1'
-output_dir = 'NematodeAI/Data/Images DeadLiveCounting Edges'
-
-# Create the output directory if it doesn't exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-# Loop through all files in the input directory
-for filename in os.listdir(input_dir):
-    if filename.endswith('.jpg') or filename.endswith('.png'):  # Add other image formats if needed
-        # Read the image
-        img_path = os.path.join(input_dir, filename)
-
-        print("Processing", img_path)
-
-        img = cv.imread(img_path, cv.IMREAD_GRAYSCALE)
-        
-        # Perform edge detection
-        edges = cv.Canny(img, 100, 200)
-        
-        # Save the result
-        
-        output_path = os.path.join(output_dir, filename)
-        cv.imwrite(output_path, edges)
-
-print("Edge detection completed and images saved to", output_dir)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,8 @@ This script performs the following steps:
   1. Iterates over each .avi file in the input directory.
   2. Loads the video frames (extracting one frame per second).
   3. Crops each frame to the region of interest and applies CLAHE enhancement.
-  4. Saves the processed frames to an output directory (organized by video filename).
+  4. Saves the processed frames to an output directory (organized by video filename),
+     encoding them on background threads (see asyncWriter.py).
 
 Requirements:
   - OpenCV
@@ -14,6 +15,15 @@ Requirements:
 
 import os
 import cv2
+from frameSampler import sample_video_frames
+from frameStore import FrameStoreWriter
+from manifest import Manifest, content_hash
+from asyncWriter import AsyncImageWriter
+
+OUTPUT_BACKEND = 'files'  # 'files': one PNG per frame, 'store': chunked frame store (<video>.frames)
+STAGE = 'VideoToFrames'   # Stage name recorded in the output manifest
+IMAGE_FORMAT = 'png'      # 'files' backend image format: 'png', 'jpg' or 'webp'
+PNG_COMPRESSION = None    # PNG compression level 0-9 (None = OpenCV default)
 
 # -------------------------------
 # Helper Functions
@@ -27,82 +37,107 @@ def preprocess_frame(frame, clahe):
     enhanced_frame = clahe.apply(gray_frame)
     return cv2.cvtColor(enhanced_frame, cv2.COLOR_GRAY2BGR)
 
-def load_video_frames(video_path):
+def load_video_frames(video_path, frames_per_second=1):
     """
-    Load video frames into a list of numpy arrays.
-    Extracts one frame per second.
+    Lazily load video frames as numpy arrays.
+    Yields (frame_idx, timestamp_s, frame), one frame per second by default;
+    skipped frames are never decoded (see frameSampler.sample_video_frames).
     """
-    cap = cv2.VideoCapture(str(video_path))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))  # Frames per second
-    frame_interval = fps                  # One frame per second
-    frame_count = 0
-    frames = []
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        if frame_count % frame_interval == 0:
-            frames.append(frame)
-        frame_count += 1
-
-    cap.release()
-    return frames
+    yield from sample_video_frames(video_path, frames_per_second)
 
 def preprocess_video_frames(video_frames, window_left, window_right, clahe):
     """
     Preprocess video frames by cropping to the region of interest and applying CLAHE.
-    Returns a list of processed frames in 3-channel format.
+    Lazily yields (frame_idx, timestamp_s, processed_frame) with frames in 3-channel format.
     """
-    processed_frames = [
-        preprocess_frame(frame[:, window_left:window_right, :], clahe) for frame in video_frames
-    ]
-    return processed_frames
+    for frame_idx, timestamp, frame in video_frames:
+        yield frame_idx, timestamp, preprocess_frame(frame[:, window_left:window_right, :], clahe)
 
 # -------------------------------
 # Main Processing Script
 # -------------------------------
 
+def process_video(video_path, output_dir, window_left=400, window_right=1520, manifest=None):
+    """
+    Extract one frame per second of a video, crop it to the horizontal window
+    and enhance it with CLAHE. Returns the number of frames saved, or None if
+    the video was up to date.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Create a CLAHE object (for contrast enhancement)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(20, 20))
+
+    # Videos already processed from the same content with the same parameters are skipped
+    own_manifest = manifest is None
+    manifest = manifest or Manifest(os.path.join(output_dir, '.manifest.json'))
+    params = {'frames_per_second': 1, 'window': [window_left, window_right],
+              'clahe': [2.0, [20, 20]], 'backend': OUTPUT_BACKEND}
+    if OUTPUT_BACKEND == 'files' and (IMAGE_FORMAT, PNG_COMPRESSION) != ('png', None):
+        params['format'] = [IMAGE_FORMAT, PNG_COMPRESSION]
+
+    video_file = os.path.basename(video_path)
+    base_name = os.path.splitext(video_file)[0]
+    video_output_dir = os.path.join(output_dir, base_name)
+    artifact = video_output_dir + '.frames' if OUTPUT_BACKEND == 'store' else video_output_dir
+    video_hash = content_hash(video_path)
+    if manifest.is_up_to_date(artifact, video_hash, STAGE, params):
+        print(f"Up to date, skipping: {video_path}")
+        return None
+    print(f"Processing video: {video_path}")
+
+    # Stream frames (one frame per second) through cropping and CLAHE
+    raw_frames = load_video_frames(video_path)
+    processed_frames = preprocess_video_frames(raw_frames, window_left, window_right, clahe)
+
+    # Create a subdirectory for the current video
+    writer = None
+    if OUTPUT_BACKEND == 'files':
+        os.makedirs(video_output_dir, exist_ok=True)
+        writer = AsyncImageWriter(compression=PNG_COMPRESSION)
+    store = None
+
+    # Save each processed frame as an image file (named by its second in the video)
+    saved = 0
+    for idx, timestamp, frame in processed_frames:
+        output_filename = f"{base_name}_frame_{saved}.{IMAGE_FORMAT}"
+        if OUTPUT_BACKEND == 'store':
+            if store is None:
+                store = FrameStoreWriter(video_output_dir + '.frames', frame.shape, source=video_path)
+            store.append(frame, name=output_filename, source=video_path, frame_idx=idx, timestamp=timestamp)
+        else:
+            output_path = os.path.join(video_output_dir, output_filename)
+            writer.write(output_path, frame, done=lambda path=output_path: print(f"Saved preprocessed frame: {path}"))
+        saved += 1
+    if writer is not None:
+        writer.close()
+        saved -= len(writer.failed)
+    if store is not None:
+        store.close()
+        print(f"Saved {store.count} frames to store: {store.path}")
+    if saved == 0:
+        print(f"WARNING: No frames extracted from {video_file}.")
+    elif writer is not None and writer.failed:
+        # Not recorded, so the next run processes the video again
+        print(f"WARNING: {len(writer.failed)} frames of {video_file} could not be written")
+    else:
+        manifest.record(artifact, video_path, video_hash, STAGE, params)
+        manifest.save()
+    if own_manifest:
+        manifest.close()
+    return saved
+
 def main():
     # Define input and output directories
     video_dir = 'NematodeAI\Data\Videos DeadLiveCounting'      # Directory containing .avi files
     output_dir = 'NematodeAI\Data\Images DeadLiveCounting'     # Directory to save processed frames
     os.makedirs(output_dir, exist_ok=True)
-    
-    # Define the region of interest (horizontal cropping)
-    window_left, window_right = 400, 1520
-    
-    # Create a CLAHE object (for contrast enhancement)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(20, 20))
-    
-    # Process each .avi file in the input directory
+    manifest = Manifest(os.path.join(output_dir, '.manifest.json'))
+
+    # Process each .avi file in the input directory (scheduler.py runs them in parallel)
     for video_file in os.listdir(video_dir):
         if not video_file.lower().endswith('.avi'):
             continue
-        
-        video_path = os.path.join(video_dir, video_file)
-        print(f"Processing video: {video_path}")
-        
-        # Load frames (one frame per second)
-        raw_frames = load_video_frames(video_path)
-        if not raw_frames:
-            print(f"WARNING: No frames extracted from {video_file}.")
-            continue
-        
-        # Preprocess the frames (crop and apply CLAHE)
-        processed_frames = preprocess_video_frames(raw_frames, window_left, window_right, clahe)
-        
-        # Create a subdirectory for the current video
-        base_name = os.path.splitext(video_file)[0]
-        video_output_dir = os.path.join(output_dir, base_name)
-        os.makedirs(video_output_dir, exist_ok=True)
-        
-        # Save each processed frame as an image file
-        for idx, frame in enumerate(processed_frames):
-            output_filename = f"{base_name}_frame_{idx}.png"
-            output_path = os.path.join(video_output_dir, output_filename)
-            cv2.imwrite(output_path, frame)
-            print(f"Saved preprocessed frame: {output_path}")
+        process_video(os.path.join(video_dir, video_file), output_dir, manifest=manifest)
 
 if __name__ == "__main__":
     main()
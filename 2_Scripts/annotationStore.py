@@ -0,0 +1,171 @@
+"""
+Annotation Store
+
+Append-only store for the points clicked in 3_FrameAnnotationTool. Every click
+is committed to a SQLite database in WAL mode as soon as it is made, so a crash
+or a closed terminal loses nothing, and consumers query the points they need
+through the (filename, label) index instead of scanning a whole CSV.
+
+Table layout:
+    points(id, filename, label, x, y, created)
+
+Undo deletes the row of the undone point; everything else only appends.
+export_csv() writes the classic filename,label,x,y CSV of the annotation tool
+and import_csv() loads such a CSV into a store.
+
+Usage:
+    with AnnotationStore('C0105_cropped_annotations.db') as store:
+        point_id = store.add('frame_0.jpg', 1, 512.0, 640.0)
+        store.points('frame_0.jpg', labels=[1, 2])    # [(filename, label, x, y), ...]
+        store.export_csv('C0105_cropped_clicked_points.csv')
+
+Requirements:
+  - Python 3.x (sqlite3 is part of the standard library)
+"""
+
+import os
+import csv
+import time
+import sqlite3
+
+CSV_FIELDS = ['filename', 'label', 'x', 'y']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    label INTEGER NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS points_filename_label ON points (filename, label);
+CREATE INDEX IF NOT EXISTS points_label ON points (label);
+"""
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def default_store_path(image_dir):
+    """
+    Store next to an image folder / frame store: <image_dir>_annotations.db
+    """
+    return os.path.normpath(str(image_dir)).rstrip('/\\') + '_annotations.db'
+
+def _where(filename=None, labels=None):
+    clauses, args = [], []
+    if filename is not None:
+        clauses.append('filename = ?')
+        args.append(filename)
+    if labels is not None:
+        labels = [int(l) for l in labels]
+        clauses.append(f"label IN ({','.join('?' * len(labels))})")
+        args.extend(labels)
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), args
+
+# -------------------------------
+# Annotation Store
+# -------------------------------
+
+class AnnotationStore:
+    """
+    SQLite (WAL) backed point annotations with one durable commit per write.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')  # a committed click survives a power loss, too
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def add(self, filename, label, x, y):
+        """
+        Store one point and commit it. Returns the id of the point.
+        """
+        with self.conn:
+            cur = self.conn.execute('INSERT INTO points (filename, label, x, y, created) VALUES (?, ?, ?, ?, ?)',
+                                    (filename, int(label), float(x), float(y), time.time()))
+        return cur.lastrowid
+
+    def add_many(self, rows):
+        """
+        Store (filename, label, x, y) rows in one transaction. Returns the number of rows.
+        """
+        now = time.time()
+        with self.conn:
+            cur = self.conn.executemany('INSERT INTO points (filename, label, x, y, created) VALUES (?, ?, ?, ?, ?)',
+                                        ((f, int(l), float(x), float(y), now) for f, l, x, y in rows))
+        return cur.rowcount
+
+    def remove(self, point_id):
+        """
+        Delete one point. Returns True if it existed.
+        """
+        with self.conn:
+            cur = self.conn.execute('DELETE FROM points WHERE id = ?', (point_id,))
+        return cur.rowcount > 0
+
+    def undo(self, filename=None):
+        """
+        Delete the most recent point (of one file). Returns it as (filename, label, x, y) or None.
+        """
+        where, args = _where(filename)
+        row = self.conn.execute(f'SELECT id, filename, label, x, y FROM points{where} ORDER BY id DESC LIMIT 1',
+                                args).fetchone()
+        if row is None:
+            return None
+        self.remove(row[0])
+        return row[1:]
+
+    def points(self, filename=None, labels=None, with_ids=False):
+        """
+        Points as (filename, label, x, y) tuples in click order, optionally only
+        those of one file and/or of some labels. with_ids=True prepends the id.
+        """
+        where, args = _where(filename, labels)
+        columns = 'id, filename, label, x, y' if with_ids else 'filename, label, x, y'
+        return self.conn.execute(f'SELECT {columns} FROM points{where} ORDER BY id', args).fetchall()
+
+    def filenames(self, labels=None):
+        """
+        Files that have at least one point (of the given labels).
+        """
+        where, args = _where(labels=labels)
+        return [r[0] for r in self.conn.execute(f'SELECT DISTINCT filename FROM points{where} ORDER BY filename', args)]
+
+    def count(self, filename=None, labels=None):
+        where, args = _where(filename, labels)
+        return self.conn.execute(f'SELECT COUNT(*) FROM points{where}', args).fetchone()[0]
+
+    def export_csv(self, output_csv, labels=None):
+        """
+        Write the points as the annotation tool's filename,label,x,y CSV.
+        """
+        with open(output_csv, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_FIELDS)
+            writer.writerows(self.points(labels=labels))
+        print(f"Saved clicked points to {output_csv}")
+
+    def import_csv(self, input_csv):
+        """
+        Append the points of a filename,label,x,y CSV (older sessions). Returns the number of points.
+        """
+        with open(input_csv, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            label_field = 'label' if 'label' in reader.fieldnames else 'class'
+            n = self.add_many((r['filename'], r[label_field], r['x'], r['y']) for r in reader)
+        print(f"Imported {n} points from {input_csv}")
+        return n
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
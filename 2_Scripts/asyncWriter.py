@@ -0,0 +1,238 @@
+"""
+Asynchronous Frame Writers
+
+Moves image / video encoding off the frame loops: write() only hands the frame
+to a bounded queue and returns, background threads run the encoder.
+
+  - AsyncImageWriter: WORKERS threads calling cv2.imwrite in parallel (OpenCV
+    releases the GIL while encoding). The format follows the file extension;
+    JPEG / WebP quality and PNG compression level are options.
+  - AsyncVideoWriter: one thread feeding a cv2.VideoWriter in order, opened
+    with the source frame rate instead of a fixed 20 fps. A container has one
+    constant rate, so the timestamp of every written frame is also saved to
+    <video>_timestamps.csv (frame, frame_idx, timestamp).
+  - At most QUEUE_SIZE frames wait for the encoder (backpressure); write()
+    blocks when the encoder falls behind, so memory stays capped.
+  - Frames are not copied: pass a copy if the caller reuses the buffer
+    (e.g. PreprocessContext outputs).
+  - Everything queued is written on close(), at the end of a `with` block and,
+    for writers that were never closed, at interpreter exit.
+
+A failed write is printed and listed in `failed` (path -> error) instead of
+raising, like the synchronous cv2.imwrite calls it replaces. The optional
+`done` callback of write() runs on the calling thread, during a later write()
+or close(), once the file is on disk, so e.g. manifest entries are only
+recorded for frames that were actually written.
+
+Usage:
+    with AsyncImageWriter(quality=95) as writer:
+        for name, frame in frames:
+            writer.write(os.path.join(output_dir, name + '.jpg'), frame)
+
+    with AsyncVideoWriter('out.mp4', fps, (1024, 1024)) as out:
+        out.write(frame, timestamp)
+
+Requirements:
+  - OpenCV
+  - Python 3.x
+"""
+
+import os
+import csv
+import queue
+import atexit
+import weakref
+import threading
+import cv2
+import instrumentation as inst
+
+WORKERS = min(4, os.cpu_count() or 1)  # Encoder threads of an AsyncImageWriter
+QUEUE_SIZE = 32                         # Frames waiting for the encoder, at most
+JPEG_QUALITY = 95                       # cv2.IMWRITE_JPEG_QUALITY (0-100)
+WEBP_QUALITY = 95                       # cv2.IMWRITE_WEBP_QUALITY (1-100, above 100 = lossless)
+PNG_COMPRESSION = None                  # cv2.IMWRITE_PNG_COMPRESSION (0-9, higher = smaller; None = OpenCV default)
+FOURCC = 'mp4v'                         # Codec of AsyncVideoWriter
+
+_DONE = object()
+_open_writers = weakref.WeakSet()
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def encode_params(path, quality=None, compression=None):
+    """
+    cv2.imwrite parameters for the format of path (its extension). For WebP,
+    whose only setting is the quality, compression is ignored.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.jpg', '.jpeg'):
+        return [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY if quality is None else int(quality)]
+    if ext == '.png':
+        compression = PNG_COMPRESSION if compression is None else compression
+        return [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, int(compression)]
+    if ext == '.webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY if quality is None else int(quality)]
+    return []
+
+@atexit.register
+def close_all():
+    """
+    Flush and close every writer that is still open (registered with atexit).
+    """
+    for writer in list(_open_writers):
+        writer.close()
+
+# -------------------------------
+# Writers
+# -------------------------------
+
+class _AsyncWriter:
+    """
+    Bounded job queue, encoder threads and completion bookkeeping shared by
+    the image and video writer.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.jobs = queue.Queue(maxsize=max(queue_size, 1))
+        self.completed = queue.SimpleQueue()
+        self.failed = {}
+        self.count = 0
+        self.closed = False
+        self.threads = [threading.Thread(target=self._run, name=f'writer-{i}', daemon=True)
+                        for i in range(max(workers, 1))]
+        for t in self.threads:
+            t.start()
+        _open_writers.add(self)
+
+    def _encode(self, job):
+        raise NotImplementedError
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is _DONE:
+                break
+            error = None
+            try:
+                with inst.stage('encode'):
+                    error = self._encode(job)
+            except Exception as e:
+                error = str(e)
+            self.completed.put((job, error))
+
+    def _submit(self, job):
+        if self.closed:
+            raise ValueError("write to a closed writer")
+        self._drain()
+        with inst.stage('write_wait'):
+            self.jobs.put(job)
+        inst.gauge('writer_queue_depth', self.jobs.qsize())
+
+    def _drain(self):
+        # Runs on the calling thread: report failures, call the done callbacks
+        while True:
+            try:
+                job, error = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            if error:
+                inst.count('write_errors')
+                self.failed[job[0]] = error
+                print(f"Error writing {job[0]}: {error}")
+            else:
+                self.count += 1
+                if job[-1] is not None:
+                    job[-1]()
+
+    def close(self):
+        """
+        Wait until every queued frame is written and stop the threads.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.threads:
+            self.jobs.put(_DONE)
+        for t in self.threads:
+            t.join()
+        self._drain()
+        _open_writers.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AsyncImageWriter(_AsyncWriter):
+    """
+    Writes image files on background threads.
+    """
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, quality=None, compression=None):
+        self.quality = quality
+        self.compression = compression
+        super().__init__(workers, queue_size)
+
+    def write(self, path, image, done=None):
+        """
+        Queue image to be written to path (format from the extension). done()
+        is called once the file is written.
+        """
+        self._submit((path, image, done))
+
+    def _encode(self, job):
+        path, image, _ = job
+        if not cv2.imwrite(path, image, encode_params(path, self.quality, self.compression)):
+            return "cv2.imwrite failed"
+        return None
+
+class AsyncVideoWriter(_AsyncWriter):
+    """
+    Writes video frames in order on one background thread, with the source
+    frame rate and a timestamp sidecar CSV.
+    """
+
+    def __init__(self, path, fps, size, is_color=True, fourcc=FOURCC, queue_size=QUEUE_SIZE,
+                 quality=None, timestamps=True):
+        self.path = path
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size, is_color)
+        if quality is not None:
+            # Only honoured by some codecs (e.g. MJPG)
+            self.writer.set(cv2.VIDEOWRITER_PROP_QUALITY, quality)
+        self.timestamps = None
+        if timestamps:
+            self.timestamps_path = os.path.splitext(path)[0] + '_timestamps.csv'
+            self.timestamps = open(self.timestamps_path, 'w', newline='')
+            self._csv = csv.writer(self.timestamps)
+            self._csv.writerow(['frame', 'frame_idx', 'timestamp'])
+        self.written = 0
+        super().__init__(1, queue_size)
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def write(self, frame, timestamp=None, frame_idx=None, done=None):
+        """
+        Queue the next frame (source frame index and timestamp in seconds for
+        the timestamp CSV). done() is called once it is encoded.
+        """
+        self._submit((self.path, frame, timestamp, frame_idx, done))
+
+    def _encode(self, job):
+        _, frame, timestamp, frame_idx, _ = job
+        self.writer.write(frame)
+        if self.timestamps is not None:
+            self._csv.writerow([self.written, self.written if frame_idx is None else frame_idx,
+                                '' if timestamp is None else f"{timestamp:.6f}"])
+        self.written += 1
+        return None
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.writer.release()
+        if self.timestamps is not None:
+            self.timestamps.close()
@@ -0,0 +1,265 @@
+"""
+Temporal Background Model
+
+Streaming background estimate for fixed-camera ("feste Kamera") videos, whose
+background (well, debris, scratches) stays in place while the worms move.
+Instead of thresholding every frame on its own (Otsu + opening, which also
+picks up dark debris), the foreground of a frame is everything that is
+clearly darker than the background.
+
+  1. The last WINDOW frames are kept in a ring buffer, downscaled by the
+     integer factor DOWNSCALE (O(WINDOW) memory: ~10 MB for 31 frames of
+     2560x2160 at 1/4; an integer factor keeps cv2.INTER_AREA on its fast path).
+  2. Every UPDATE_EVERY frames the background is recomputed as the per-pixel
+     PERCENTILE (median by default) of the ring. The selection is a bitwise
+     radix search: 8 vectorized counting passes over the ring, exact for
+     uint8 and ~4x faster than np.partition along the time axis.
+  3. The background is upscaled once per update; a frame's foreground is
+     every pixel more than THRESHOLD grey levels darker than it (one
+     comparison per pixel), opened with a 3x3 kernel against single-pixel noise.
+  4. Until MIN_FRAMES frames are buffered the per-frame Otsu foreground
+     (counting.foreground) is returned instead.
+
+Worms that do not move for more than half the window become background, so
+the masks only contain moving worms; dead worms are counted on the Otsu path.
+A frame of another size (e.g. a new well crop) resets the model.
+
+The masks feed the existing steps: 1_VideoToFrames (SEGMENTATION =
+'background') uses them in place of its Otsu watershed, counting.Counter.count
+accepts them as `mask`, and running this file writes them to a mask store
+(<video>.masks, see maskRLE.py).
+
+Usage:
+    model = BackgroundModel()
+    for frame in frames:
+        mask = model.apply(frame)      # uint8 0/255, same size as the frame
+
+    python backgroundModel.py "feste Kamera 1.avi"
+    python backgroundModel.py --benchmark
+
+Requirements:
+  - OpenCV
+  - NumPy
+  - Python 3.x
+"""
+
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+from counting import foreground as otsu_foreground
+
+WINDOW = 31          # Frames in the sliding window (at most 255)
+DOWNSCALE = 4        # Buffered frames are 1/DOWNSCALE of the frame size
+UPDATE_EVERY = 8     # Frames between two background updates
+PERCENTILE = 50      # Per-pixel percentile of the window used as background
+THRESHOLD = 40       # Grey levels darker than the background that count as foreground
+MIN_FRAMES = 5       # Frames needed before the background is used
+
+KERNEL = np.ones((3, 3), np.uint8)
+
+# -------------------------------
+# Background Estimation
+# -------------------------------
+
+def select_kth(stack, k):
+    """
+    Per-pixel k-th smallest value (0-based) of a (n, h, w) uint8 stack, n <= 255.
+    Builds the result bit by bit from the most significant one: a bit is set
+    if at most k values are below the candidate.
+    """
+    value = np.zeros(stack.shape[1:], np.uint8)
+    below = np.empty(stack.shape[1:], np.uint8)
+    for bit in range(7, -1, -1):
+        candidate = value | np.uint8(1 << bit)
+        below[...] = 0
+        for frame in stack:
+            below += frame < candidate
+        np.copyto(value, candidate, where=below <= k)
+    return value
+
+class BackgroundModel:
+    """
+    Sliding-window percentile background with foreground masks.
+    """
+
+    def __init__(self, window=WINDOW, downscale=DOWNSCALE, update_every=UPDATE_EVERY, percentile=PERCENTILE,
+                 threshold=THRESHOLD, min_frames=MIN_FRAMES):
+        if not 1 <= window <= 255:
+            raise ValueError(f"window must be between 1 and 255 frames, got {window}")
+        self.window = window
+        self.downscale = max(int(downscale), 1)
+        self.update_every = update_every
+        self.percentile = percentile
+        self.threshold = threshold
+        self.min_frames = min(min_frames, window)
+        self.reset()
+
+    def reset(self):
+        self.shape = None
+        self.ring = None
+        self.filled = 0
+        self.position = 0
+        self.since_update = 0
+        self.background = None
+
+    def add(self, frame):
+        """
+        Add a frame (BGR or gray) to the window. Returns it as gray.
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if gray.shape != self.shape:
+            self.reset()
+            self.shape = gray.shape
+            h, w = gray.shape
+            self.factor = min(self.downscale, h, w)
+            self.small_size = (w // self.factor, h // self.factor)
+            self.ring = np.empty((self.window, self.small_size[1], self.small_size[0]), np.uint8)
+        # The last rows / columns that do not fill a whole block are left out
+        sw, sh = self.small_size
+        cv2.resize(gray[:sh * self.factor, :sw * self.factor], self.small_size, dst=self.ring[self.position],
+                   interpolation=cv2.INTER_AREA)
+        self.position = (self.position + 1) % self.window
+        self.filled = min(self.filled + 1, self.window)
+        self.since_update += 1
+        if self.filled >= self.min_frames and (self.background is None or self.since_update >= self.update_every):
+            self.update()
+        return gray
+
+    def update(self):
+        """
+        Recompute the background from the buffered frames.
+        """
+        k = int(round(self.percentile / 100 * (self.filled - 1)))
+        small = select_kth(self.ring[:self.filled], k)
+        sw, sh = self.small_size
+        background = cv2.resize(small, (sw * self.factor, sh * self.factor), interpolation=cv2.INTER_LINEAR)
+        h, w = self.shape
+        self.background = cv2.copyMakeBorder(background, 0, h - background.shape[0], 0, w - background.shape[1],
+                                             cv2.BORDER_REPLICATE)
+        # Foreground test against background - threshold is then one comparison per frame
+        self.limit = cv2.subtract(self.background, self.threshold)
+        self.since_update = 0
+
+    def foreground(self, gray):
+        """
+        Mask (0/255) of the pixels darker than the background by at least
+        threshold, or the Otsu foreground while there is no background yet.
+        """
+        if self.background is None or gray.shape != self.shape:
+            return otsu_foreground(gray)
+        mask = cv2.compare(gray, self.limit, cv2.CMP_LT)
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, KERNEL)
+
+    def apply(self, frame):
+        """
+        Add a frame and return its foreground mask.
+        """
+        return self.foreground(self.add(frame))
+
+# -------------------------------
+# Video Masks
+# -------------------------------
+
+def video_masks(video_path, output_path=None, model=None):
+    """
+    Write the foreground mask of every frame of a video to a mask store
+    (default <video>.masks). Returns the number of frames.
+    """
+    from maskRLE import MaskWriter
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Could not open video {video_path}")
+        return 0
+    output_path = output_path or os.path.splitext(video_path)[0] + '.masks'
+    model = model or BackgroundModel()
+    writer = None
+    frame_idx = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            mask = model.apply(frame)
+            if writer is None:
+                writer = MaskWriter(output_path, mask.shape, source=video_path, window=model.window,
+                                    downscale=model.downscale, percentile=model.percentile, threshold=model.threshold)
+            writer.append_mask(frame_idx, mask)
+            frame_idx += 1
+            if frame_idx % 100 == 0:
+                print(f"Processed {frame_idx} frames ({frame_idx / (time.perf_counter() - start):.1f} frames/sec)")
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.close()
+    print(f"Saved {frame_idx} foreground masks to: {output_path}")
+    return frame_idx
+
+# -------------------------------
+# Benchmark
+# -------------------------------
+
+def benchmark(n_frames=120, size=1024, n_worms=40, n_debris=40, seed=0):
+    """
+    Synthetic moving worms (benchmark.synthetic_frames) plus static dark
+    debris streaks. Pixel precision / recall of the Otsu foreground and of the
+    background model against the worm pixels (difference to the known clean
+    background), and the time per frame of both.
+    """
+    from benchmark import synthetic_frames, synthetic_well, synthetic_background
+
+    rng = np.random.default_rng(seed)
+    x0, y0, radius = synthetic_well((size, size))
+    clean = cv2.cvtColor(synthetic_background((size, size), (x0, y0), radius), cv2.COLOR_BGR2GRAY)
+    well = np.zeros((size, size), np.uint8)
+    cv2.circle(well, (x0, y0), radius - 8, 255, -1)
+    debris = np.zeros((size, size), np.uint8)
+    for _ in range(n_debris):
+        cx, cy = np.array([x0, y0]) + rng.uniform(-0.6, 0.6, 2) * radius
+        angle = rng.uniform(0, np.pi)
+        dx, dy = 15 * np.cos(angle), 15 * np.sin(angle)
+        cv2.line(debris, (int(cx - dx), int(cy - dy)), (int(cx + dx), int(cy + dy)), 255, 4)
+
+    model = BackgroundModel()
+    methods = {'otsu': otsu_foreground, 'background': model.apply}
+    results = {name: {'precision': [], 'recall': [], 'seconds': 0.0} for name in methods}
+    for frame_idx, (frame, _) in enumerate(synthetic_frames(n_frames, (size, size), n_worms, seed=seed)):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        _, truth = cv2.threshold(cv2.subtract(clean, gray), THRESHOLD, 255, cv2.THRESH_BINARY)
+        truth = cv2.bitwise_and(cv2.morphologyEx(truth, cv2.MORPH_OPEN, KERNEL), well)
+        gray[debris > 0] = 70
+        for name, method in methods.items():
+            t0 = time.perf_counter()
+            mask = method(gray)
+            results[name]['seconds'] += time.perf_counter() - t0
+            if frame_idx < WINDOW:
+                # Compare once the window is full
+                continue
+            mask = cv2.bitwise_and(mask, well)
+            hits = cv2.countNonZero(cv2.bitwise_and(mask, truth))
+            results[name]['precision'].append(hits / max(cv2.countNonZero(mask), 1))
+            results[name]['recall'].append(hits / max(cv2.countNonZero(truth), 1))
+
+    print(f"{n_worms} moving worms, {n_debris} static debris streaks, {size}x{size}, {n_frames} frames")
+    for name, r in results.items():
+        r['precision'], r['recall'] = float(np.mean(r['precision'])), float(np.mean(r['recall']))
+        r['ms_per_frame'] = 1000 * r.pop('seconds') / n_frames
+        print(f"{name:<12} precision {r['precision']:.3f}   recall {r['recall']:.3f}   {r['ms_per_frame']:6.2f} ms/frame")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Foreground masks of a fixed-camera video from a temporal background model.')
+    parser.add_argument('video', nargs='?', help='video to process')
+    parser.add_argument('--output', help='mask store to write (default: <video>.masks)')
+    parser.add_argument('--benchmark', action='store_true', help='compare against Otsu on a synthetic video')
+    args = parser.parse_args()
+    if args.benchmark or args.video is None:
+        benchmark()
+    else:
+        video_masks(args.video, args.output)
+
+if __name__ == "__main__":
+    main()
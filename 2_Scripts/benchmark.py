@@ -0,0 +1,338 @@
+"""
+Preprocessing Benchmark Suite
+
+Measures the throughput of the preprocessing stages on synthetic data, so
+speedups can be proven on any machine without the lab recordings.
+
+Synthetic microscope-like frames contain a bright circular well on a dark
+background, sensor noise and dark worm-like curves that move between frames.
+
+Stages:
+  - per frame: watershed, houghCircle, houghCirclePyramid, crop_image,
+    mask_image, clahe, context_mask_clahe (PreprocessContext), canny
+  - end to end: sample_video_frames, pipelineVideo, 2_CropFrames
+
+For every stage the suite reports mean/median latency, frames/sec and peak
+traced memory (measured in a separate run, tracing slows the timed one down).
+The well detection of the end-to-end stages is scaled to the synthetic well
+of the chosen size, and a stage that processes no frame is an error.
+
+Results can be stored as a baseline and later runs print the fps delta
+against it. The baseline is machine-specific and not part of the repository;
+create it once per machine with --save-baseline.
+
+Usage:
+    python benchmark.py                        # run all stages at 2560x2160
+    python benchmark.py --size 3840x2160 --frames 60 --stages watershed,clahe
+    python benchmark.py --save-baseline        # store results as the new baseline
+    python benchmark.py --output run.json      # also write results as JSON
+
+Requirements:
+  - OpenCV
+  - NumPy
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+import importlib
+import tracemalloc
+import cv2
+import numpy as np
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+REGRESSION_THRESHOLD = -10.0  # fps change in percent flagged as a regression
+
+# -------------------------------
+# Synthetic Data
+# -------------------------------
+
+class SyntheticWorms:
+    """
+    Worm-like sinusoidal curves that crawl inside a circular well.
+    """
+
+    def __init__(self, n_worms, center, radius, rng, length=(60, 160), speed=(0.5, 4.0)):
+        self.center = np.array(center, np.float32)
+        self.radius = radius
+        self.rng = rng
+        angle = rng.uniform(0, 2 * np.pi, n_worms)
+        dist = radius * 0.8 * np.sqrt(rng.uniform(0, 1, n_worms))
+        self.positions = self.center + np.column_stack([np.cos(angle), np.sin(angle)]) * dist[:, None]
+        self.headings = rng.uniform(0, 2 * np.pi, n_worms)
+        self.speeds = rng.uniform(*speed, n_worms)
+        self.lengths = rng.uniform(*length, n_worms)
+        self.phases = rng.uniform(0, 2 * np.pi, n_worms)
+
+    def step(self):
+        """
+        Move every worm one frame forward; worms turn back at the well edge.
+        """
+        self.headings += self.rng.normal(0, 0.15, len(self.headings))
+        self.phases += 0.4
+        step = np.column_stack([np.cos(self.headings), np.sin(self.headings)]) * self.speeds[:, None]
+        new_positions = self.positions + step
+        outside = np.linalg.norm(new_positions - self.center, axis=1) > self.radius * 0.85
+        self.headings[outside] += np.pi
+        self.positions[~outside] = new_positions[~outside]
+
+    def polylines(self, n_points=12):
+        """
+        Body of every worm as an (n_worms, n_points, 2) int32 array.
+        """
+        t = np.linspace(-0.5, 0.5, n_points)
+        along = t[None, :] * self.lengths[:, None]
+        across = 6 * np.sin(2 * np.pi * t[None, :] * 1.5 + self.phases[:, None])
+        cos, sin = np.cos(self.headings)[:, None], np.sin(self.headings)[:, None]
+        xs = self.positions[:, 0:1] + along * cos - across * sin
+        ys = self.positions[:, 1:2] + along * sin + across * cos
+        return np.stack([xs, ys], axis=2).astype(np.int32)
+
+def synthetic_background(shape, center, radius):
+    """
+    Static frame: dark surroundings, bright well with a slight vignette.
+    """
+    h, w = shape[:2]
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    dist = np.hypot(xx - center[0], yy - center[1]) / radius
+    well = np.clip(200 - 40 * dist ** 2, 0, 255)
+    frame = np.where(dist <= 1.0, well, 25).astype(np.uint8)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+def synthetic_frames(n_frames, shape=(2160, 2560), n_worms=60, noise=8, seed=0):
+    """
+    Generator yielding (frame, worm_positions) for a synthetic microscope video.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = shape[:2]
+    radius = int(min(h, w) * 0.46)
+    center = (w // 2, h // 2)
+    background = synthetic_background(shape, center, radius)
+    worms = SyntheticWorms(n_worms, center, radius, rng)
+    noise_buffer = np.empty(background.shape, np.int16)
+
+    for _ in range(n_frames):
+        frame = background.copy()
+        cv2.polylines(frame, list(worms.polylines()), False, (60, 60, 60), 5, cv2.LINE_AA)
+        noise_buffer[...] = rng.normal(0, noise, background.shape)
+        frame = np.clip(frame.astype(np.int16) + noise_buffer, 0, 255).astype(np.uint8)
+        yield frame, worms.positions.copy()
+        worms.step()
+
+def synthetic_well(shape=(2160, 2560)):
+    """
+    Centre and radius of the well used by synthetic_frames for this shape.
+    """
+    h, w = shape[:2]
+    return w // 2, h // 2, int(min(h, w) * 0.46)
+
+def write_synthetic_video(path, n_frames, shape=(2160, 2560), fps=20.0, **kwargs):
+    """
+    Write a synthetic video (MJPG .avi) and return its path.
+    """
+    h, w = shape[:2]
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+    for frame, _ in synthetic_frames(n_frames, shape, **kwargs):
+        out.write(frame)
+    out.release()
+    return path
+
+def write_synthetic_images(img_dir, n_frames, shape=(2160, 2560), **kwargs):
+    """
+    Write synthetic frames as numbered JPEGs into img_dir and return it.
+    """
+    os.makedirs(img_dir, exist_ok=True)
+    for idx, (frame, _) in enumerate(synthetic_frames(n_frames, shape, **kwargs)):
+        cv2.imwrite(os.path.join(img_dir, f"synthetic_frame_{idx}.jpg"), frame)
+    return img_dir
+
+# -------------------------------
+# Measurement
+# -------------------------------
+
+def measure(fn, items, repeat=1):
+    """
+    Time fn(item) over all items (repeat times) and measure the peak traced
+    memory of one extra call. Returns a result dictionary.
+    """
+    latencies = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            fn(item)
+            latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(items[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    return {'mean_ms': float(latencies.mean() * 1000), 'median_ms': float(np.median(latencies) * 1000),
+            'fps': float(len(latencies) / latencies.sum()), 'peak_mb': peak / 1e6}
+
+def measure_end_to_end(name, fn):
+    """
+    Time a whole-run function that returns the number of frames it processed,
+    then measure its peak traced memory in a second run. Raises RuntimeError
+    if it processed no frame.
+    """
+    start = time.perf_counter()
+    n_frames = fn()
+    elapsed = time.perf_counter() - start
+    if not n_frames:
+        raise RuntimeError(f"{name} processed no frames, the result would be meaningless")
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'mean_ms': elapsed / n_frames * 1000, 'median_ms': elapsed / n_frames * 1000,
+            'fps': n_frames / elapsed, 'peak_mb': peak / 1e6}
+
+def frame_stages(shape):
+    """
+    Per-frame stages as name -> (prepare(frame) -> input, fn(input)).
+    """
+    from pipelineVideo import watershed, houghCircle, crop_image, mask_image, clahe
+    from houghPyramid import houghCirclePyramid
+    from preprocessContext import PreprocessContext
+
+    x, y, r = synthetic_well(shape)
+    hough = (40, 20, int(r * 0.9), int(r * 1.1))
+    ctx = PreprocessContext()
+
+    return {
+        'watershed': (lambda f: f, watershed),
+        'houghCircle': (watershed, lambda m: houghCircle(m, *hough)),
+        'houghCirclePyramid': (watershed, lambda m: houghCirclePyramid(m, *hough)),
+        'crop_image': (lambda f: f, lambda f: crop_image(f, x, y, r, 10).copy()),
+        'mask_image': (lambda f: crop_image(f, x, y, r, 10), lambda c: mask_image(c, r)),
+        'clahe': (lambda f: mask_image(crop_image(f, x, y, r, 10), r), clahe),
+        'context_mask_clahe': (lambda f: crop_image(f, x, y, r, 10),
+                               lambda c: ctx.apply_clahe(ctx.mask_image(c, r))),
+        'canny': (lambda f: cv2.cvtColor(f, cv2.COLOR_BGR2GRAY), lambda g: cv2.Canny(g, 100, 200)),
+    }
+
+def end_to_end_stages(shape, n_frames, workdir):
+    """
+    Whole-script stages as name -> fn() on synthetic data written to workdir.
+    Every fn returns the number of frames it processed.
+    """
+    video_path = os.path.join(workdir, 'synthetic.avi')
+    img_dir = os.path.join(workdir, 'synthetic_frames')
+    # Well radii of this frame size (the scripts' defaults fit 2560x2160 recordings)
+    _, _, r = synthetic_well(shape)
+    circle_params = {'param1': 40, 'param2': 20, 'minRadius': int(r * 0.9), 'maxRadius': int(r * 1.1)}
+
+    def sampler():
+        from frameSampler import sample_video_frames
+        return sum(1 for _ in sample_video_frames(video_path, None))
+
+    def pipeline():
+        import pipelineVideo
+        output_path = pipelineVideo.process_video(video_path, os.path.join(workdir, 'synthetic_cropped.avi'),
+                                                  circle_params=circle_params)
+        if output_path is None:
+            return 0
+        with open(os.path.splitext(output_path)[0] + '_timestamps.csv') as f:
+            return sum(1 for _ in f) - 1
+
+    def crop_frames():
+        crop = importlib.import_module('2_CropFrames')
+        output_dir = os.path.join(workdir, f"cropped_{time.monotonic_ns()}")
+        return crop.crop_directory(img_dir, output_dir, circle_params=circle_params)
+
+    def prepare():
+        if not os.path.exists(video_path):
+            write_synthetic_video(video_path, n_frames, shape)
+            write_synthetic_images(img_dir, n_frames, shape)
+
+    return prepare, {'sample_video_frames': sampler, 'pipelineVideo': pipeline, '2_CropFrames': crop_frames}
+
+# -------------------------------
+# Reporting
+# -------------------------------
+
+def compare(results, baseline):
+    """
+    Add fps deltas (percent) against the baseline results of the same stage and size.
+    """
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and base.get('size') == result['size'] and base['fps'] > 0:
+            result['fps_delta_pct'] = (result['fps'] - base['fps']) / base['fps'] * 100
+    return results
+
+def print_report(results):
+    print(f"\n{'stage':<22}{'mean ms':>10}{'median ms':>11}{'fps':>9}{'peak MB':>9}{'vs base':>9}")
+    for name, r in results.items():
+        delta = r.get('fps_delta_pct')
+        delta_text = f"{delta:+.1f}%" if delta is not None else '-'
+        flag = '  REGRESSION' if delta is not None and delta < REGRESSION_THRESHOLD else ''
+        print(f"{name:<22}{r['mean_ms']:>10.2f}{r['median_ms']:>11.2f}{r['fps']:>9.1f}"
+              f"{r['peak_mb']:>9.1f}{delta_text:>9}{flag}")
+
+def parse_size(text):
+    w, h = (int(v) for v in text.lower().split('x'))
+    return h, w
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing stages on synthetic data.')
+    parser.add_argument('--size', default='2560x2160', help='frame size WIDTHxHEIGHT')
+    parser.add_argument('--frames', type=int, default=30, help='synthetic frames per stage')
+    parser.add_argument('--repeat', type=int, default=1, help='repetitions of the per-frame stages')
+    parser.add_argument('--stages', default='', help='comma separated subset of stages')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    shape = parse_size(args.size)
+    selected = set(filter(None, args.stages.split(',')))
+    results = {}
+
+    frames = [frame for frame, _ in synthetic_frames(args.frames, shape)]
+    for name, (prepare, fn) in frame_stages(shape).items():
+        if selected and name not in selected:
+            continue
+        print(f"Benchmarking {name} ...")
+        inputs = [prepare(frame) for frame in frames]
+        results[name] = measure(fn, inputs, args.repeat)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare, stages = end_to_end_stages(shape, args.frames, workdir)
+        for name, fn in stages.items():
+            if selected and name not in selected:
+                continue
+            prepare()
+            print(f"Benchmarking {name} ...")
+            results[name] = measure_end_to_end(name, fn)
+
+    for result in results.values():
+        result['size'] = args.size
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    elif not args.save_baseline:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update({name: {k: v for k, v in r.items() if k != 'fps_delta_pct'} for name, r in results.items()})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+if __name__ == "__main__":
+    main()
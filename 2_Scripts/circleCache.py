@@ -0,0 +1,246 @@
+"""
+Well Circle Registry
+
+Detects the circular well once per video (or per image folder of one camera
+session) and remembers it, instead of running watershed + Hough on every frame.
+
+  - The detected circle is stored in a sidecar JSON cache next to the source
+    (<video>.circle.json, or .circle.json inside an image folder), keyed by a
+    fingerprint of the source file and the detection parameters.
+  - Every `recheck_interval` frames the circle is re-validated with a cheap
+    narrow-band Hough on a downscaled window around the known circle. The
+    result is compared with the same check run right after detection, so the
+    downscaling error cancels out.
+  - A full re-detection only happens when the measured drift exceeds
+    `drift_tolerance` pixels (e.g. after the stage was bumped).
+  - Callers that only detect once (EdgeDetection's ROI) can also cache that a
+    source has no circle (mark_missing), so Hough does not rerun on every call.
+
+Usage:
+    registry = CircleRegistry(video_path)
+    for frame in frames:
+        circle = registry.get(frame)   # (x, y, r) or None
+
+Requirements:
+  - OpenCV
+  - NumPy
+"""
+
+import os
+import json
+import hashlib
+import cv2
+import numpy as np
+import instrumentation as inst
+from pipelineVideo import watershed
+from houghPyramid import houghCirclePyramid
+
+# Default detection parameters (well radius ~1000 px at full resolution)
+CIRCLE_PARAMS = {'param1': 40, 'param2': 20, 'minRadius': 900, 'maxRadius': 1100}
+RECHECK_INTERVAL = 100   # Frames between two drift checks
+DRIFT_TOLERANCE = 15     # Pixels of centre/radius drift before re-detecting
+CHECK_SCALE = 4          # Downscale factor used for the drift check
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def file_fingerprint(path, block_size=1 << 20):
+    """
+    Cheap content fingerprint of a file: SHA-1 over its size plus the first and
+    last `block_size` bytes. For a directory (image folder or frame store), the
+    first image or chunk file it contains is fingerprinted together with the
+    directory name.
+    """
+    sha = hashlib.sha1()
+    if os.path.isdir(path):
+        sha.update(os.path.basename(os.path.normpath(path)).encode())
+        files = sorted(f for f in os.listdir(path)
+                       if f.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.npy', '.npz')))
+        if not files:
+            return sha.hexdigest()
+        path = os.path.join(path, files[0])
+
+    size = os.path.getsize(path)
+    sha.update(str(size).encode())
+    with open(path, 'rb') as f:
+        sha.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(size - block_size, block_size))
+            sha.update(f.read(block_size))
+    return sha.hexdigest()
+
+def params_key(params):
+    """
+    Stable string key for a parameter dictionary.
+    """
+    return json.dumps(params, sort_keys=True)
+
+def default_cache_path(source_path):
+    """
+    Sidecar cache location for a video file or an image directory.
+    """
+    if os.path.isdir(source_path):
+        return os.path.join(source_path, '.circle.json')
+    return source_path + '.circle.json'
+
+def detect_circle(img, params=CIRCLE_PARAMS):
+    """
+    Full detection: watershed + coarse-to-fine Hough on the full-resolution frame.
+    Returns the strongest circle as (x, y, r) ints, or None.
+    """
+    watershed_img = watershed(img)
+    circles = houghCirclePyramid(watershed_img, params['param1'], params['param2'],
+                                 params['minRadius'], params['maxRadius'])
+    if circles is None:
+        return None
+    # HoughCircles sorts by accumulator votes; the largest radius is often a spurious ring
+    x, y, r = circles[0, 0]
+    return int(round(x)), int(round(y)), int(round(r))
+
+def check_circle(img, circle, params=CIRCLE_PARAMS, scale=CHECK_SCALE):
+    """
+    Cheap re-validation of a known circle. Runs a narrow-band Hough on a
+    downscaled window around the circle and returns the circle found there in
+    full-resolution coordinates, or None if it could not be found again.
+    """
+    x, y, r = circle
+    small = cv2.resize(img, None, fx=1.0 / scale, fy=1.0 / scale, interpolation=cv2.INTER_AREA)
+    mask = watershed(small)
+
+    band = max(DRIFT_TOLERANCE * 2 // scale, 3)
+    xs, ys, rs = x / scale, y / scale, r / scale
+    margin = rs + band
+    h, w = mask.shape[:2]
+    x1, y1 = max(int(xs - margin), 0), max(int(ys - margin), 0)
+    x2, y2 = min(int(xs + margin), w), min(int(ys + margin), h)
+    window = mask[y1:y2, x1:x2]
+    if window.size == 0:
+        return None
+
+    circles = cv2.HoughCircles(window, cv2.HOUGH_GRADIENT, 1, 20,
+                               param1=params['param1'], param2=params['param2'],
+                               minRadius=max(int(rs) - band, 1), maxRadius=int(rs) + band)
+    if circles is None:
+        return None
+    cx, cy, cr = circles[0, 0]
+    return int(round((cx + x1) * scale)), int(round((cy + y1) * scale)), int(round(cr * scale))
+
+def circle_distance(a, b):
+    """
+    Drift between two circles in pixels: centre shift plus radius change.
+    """
+    return float(np.hypot(a[0] - b[0], a[1] - b[1]) + abs(a[2] - b[2]))
+
+# -------------------------------
+# Circle Registry
+# -------------------------------
+
+class CircleRegistry:
+    """
+    Per-source cache of the detected well circle with periodic drift checks.
+    """
+
+    def __init__(self, source_path, params=None, recheck_interval=RECHECK_INTERVAL,
+                 drift_tolerance=DRIFT_TOLERANCE, cache_path=None, detector=detect_circle):
+        self.source_path = source_path
+        self.params = dict(params or CIRCLE_PARAMS)
+        self.recheck_interval = recheck_interval
+        self.drift_tolerance = drift_tolerance
+        self.cache_path = cache_path or default_cache_path(source_path)
+        self.detector = detector
+        self.key = file_fingerprint(source_path) + ':' + params_key(self.params)
+
+        self.missing = False
+        self.circle, self.reference = self._load()
+        self.frames_since_check = 0
+        self.detections = 0
+        self.redetections = 0
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return None, None
+        try:
+            with open(self.cache_path) as f:
+                entry = json.load(f).get(self.key)
+        except (OSError, ValueError):
+            return None, None
+        if entry is None:
+            return None, None
+        if entry['circle'] is None:
+            print(f"Using cached result for {self.source_path}: no circle")
+            self.missing = True
+            return None, None
+        print(f"Using cached circle for {self.source_path}: {entry['circle']}")
+        reference = entry.get('reference')
+        return tuple(entry['circle']), tuple(reference) if reference else None
+
+    def _save(self):
+        cache = {}
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+        cache[self.key] = {'circle': list(self.circle) if self.circle else None,
+                           'reference': list(self.reference) if self.reference else None,
+                           'params': self.params}
+        # Per-process temporary file: workers of one pool may save at the same time
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, self.cache_path)
+
+    def mark_missing(self):
+        """
+        Cache that no circle was found in this source (cleared by the next
+        successful detection).
+        """
+        self.missing = True
+        self.circle = self.reference = None
+        self._save()
+
+    def seed(self, circle, reference=None):
+        """
+        Use a circle detected elsewhere (e.g. by the parent of a worker pool)
+        without running Hough or writing the cache.
+        """
+        self.circle = tuple(circle)
+        self.reference = tuple(reference) if reference else None
+        self.frames_since_check = 0
+
+    def _detect(self, frame):
+        with inst.stage('hough'):
+            circle = self.detector(frame, self.params)
+        self.detections += 1
+        if circle is None:
+            inst.count('circles_missed')
+        if circle is not None:
+            self.circle = circle
+            self.missing = False
+            self.reference = check_circle(frame, circle, self.params)
+            self._save()
+        return circle
+
+    def get(self, frame):
+        """
+        Return the well circle (x, y, r) for this frame, or None if no circle is known.
+        """
+        if self.circle is None:
+            self.frames_since_check = 0
+            return self._detect(frame)
+
+        self.frames_since_check += 1
+        if self.recheck_interval and self.frames_since_check >= self.recheck_interval:
+            self.frames_since_check = 0
+            with inst.stage('circle_check'):
+                checked = check_circle(frame, self.circle, self.params)
+            drift = None if checked is None else circle_distance(checked, self.reference or self.circle)
+            if drift is None or drift > self.drift_tolerance:
+                print(f"Circle drift detected ({'lost' if drift is None else f'{drift:.1f} px'}), re-detecting")
+                self.redetections += 1
+                inst.count('circle_redetections')
+                if self._detect(frame) is None:
+                    print("Re-detection failed, keeping previous circle")
+        return self.circle
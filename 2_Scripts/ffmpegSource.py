@@ -0,0 +1,339 @@
+"""
+FFmpeg Frame Source
+
+Alternative to cv2.VideoCapture that decodes through a local ffmpeg
+subprocess and lets the decoder do the per-frame pixel work:
+  - crop to a rectangle (e.g. the well ROI),
+  - scale to the output size,
+  - convert to gray8 (or bgr24),
+  - select frames (every n-th source frame for FRAMES per second sampling),
+all inside ffmpeg's multi-threaded decoder/filter graph, so the pipe only
+carries the small frames that are actually used.
+
+The first frame is read when the source is opened, so isOpened() is False
+if ffmpeg cannot decode the video (it exited without a frame); `failed` is
+set if it later exits with an error before the end of the video.
+
+Frames are read with readinto() straight from the pipe into a ring of
+`buffers` preallocated numpy arrays, without an intermediate bytes object. A
+returned frame is overwritten `buffers` frames later; copy it if it must live
+longer (pipelineVideo sizes the ring to its frames in flight).
+
+Drop-in use:
+  - sample_ffmpeg_frames() yields (frame_idx, timestamp_s, frame) like
+    frameSampler.sample_video_frames
+  - FFmpegSource.read() / isOpened() / get() / release() behave like
+    cv2.VideoCapture for the existing `while True: ret, frame = cap.read()` loops
+
+Frame selection keeps source frames round-half-up(k * source_fps / fps), which
+can differ by one frame from sample_video_frames where k * interval ends in .5.
+
+Running this file benchmarks it against cv2.VideoCapture (+ crop, gray, resize
+in OpenCV) on a video, or on a synthetic one:
+    python ffmpegSource.py C0098.MP4
+    python ffmpegSource.py --frames 60
+
+Requirements:
+  - ffmpeg on the PATH (or FFMPEG_BINARY)
+  - OpenCV (video metadata)
+  - NumPy
+  - Python 3.x
+"""
+
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+
+FFMPEG_BINARY = 'ffmpeg'  # ffmpeg executable (name on the PATH or full path)
+THREADS = 0               # Decoder threads (0 = ffmpeg chooses)
+BUFFERS = 4               # Frames in the reusable ring of output buffers
+SCALE_FLAGS = 'bilinear'  # swscale interpolation, bilinear matches cv2.resize's default
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+_fps_mode_options = {}
+
+def ffmpeg_available(binary=FFMPEG_BINARY):
+    return shutil.which(binary) is not None
+
+def fps_mode_option(binary=FFMPEG_BINARY):
+    """
+    Output option that sets the frame rate mode: -fps_mode since ffmpeg 5.1,
+    -vsync before (deprecated since, so only used for versions that need it).
+    """
+    if binary not in _fps_mode_options:
+        option = '-fps_mode'
+        try:
+            banner = subprocess.run([binary, '-hide_banner', '-version'], capture_output=True, text=True).stdout
+            # Release builds report "ffmpeg version 4.4.2-...", git builds "N-1234-g..." (always new)
+            match = re.match(r'ffmpeg version n?(\d+)\.(\d+)', banner)
+            if match and (int(match.group(1)), int(match.group(2))) < (5, 1):
+                option = '-vsync'
+        except OSError:
+            pass
+        _fps_mode_options[binary] = option
+    return _fps_mode_options[binary]
+
+def video_info(video_path):
+    """
+    {'width', 'height', 'fps', 'frames'} of a video from its container metadata.
+    """
+    cap = cv2.VideoCapture(str(video_path))
+    try:
+        if not cap.isOpened():
+            return None
+        return {'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                'fps': cap.get(cv2.CAP_PROP_FPS), 'frames': int(cap.get(cv2.CAP_PROP_FRAME_COUNT))}
+    finally:
+        cap.release()
+
+def roi_crop(circle, tolerance, width, height):
+    """
+    Square crop (x, y, w, h) around a well circle (x, y, r) plus tolerance, as
+    pipelineVideo.crop_image cuts it, or None if it does not fit in the frame.
+    """
+    x, y, r = circle
+    r = r + tolerance
+    if x - r < 0 or y - r < 0 or x + r > width or y + r > height:
+        return None
+    return x - r, y - r, 2 * r, 2 * r
+
+def filter_graph(crop=None, size=None, interval=1.0):
+    """
+    ffmpeg -vf chain: frame selection first (so dropped frames are never
+    cropped or scaled), then crop, then scale.
+    """
+    filters = []
+    if interval > 1:
+        # Keep frame n if it is the nearest frame to some k * interval (rounded half up)
+        filters.append(f"select='eq(floor(floor(n/{interval}+0.5)*{interval}+0.5),n)'")
+    if crop is not None:
+        x, y, w, h = crop
+        filters.append(f"crop={w}:{h}:{x}:{y}")
+    if size is not None:
+        filters.append(f"scale={size[0]}:{size[1]}:flags={SCALE_FLAGS}")
+    return ','.join(filters)
+
+def selected_frames(interval):
+    """
+    Source frame indices emitted by the select filter, in order.
+    """
+    k = 0
+    while True:
+        yield int(np.floor(k * interval + 0.5))
+        k += 1
+
+# -------------------------------
+# Frame Source
+# -------------------------------
+
+class FFmpegSource:
+    """
+    Frames of a video decoded, cropped, scaled and converted by ffmpeg.
+    """
+
+    def __init__(self, video_path, crop=None, size=None, gray=False, frames_per_second=None,
+                 threads=THREADS, buffers=BUFFERS, binary=FFMPEG_BINARY):
+        self.video_path = str(video_path)
+        self.info = video_info(video_path)
+        self.proc = None
+        self.frame_count = 0
+        self.finished = False
+        self.failed = False
+        self.pending = None
+        if self.info is None:
+            print(f"Error: Could not open video file: {video_path}")
+            return
+        if not ffmpeg_available(binary):
+            print(f"Error: {binary} not found on the PATH")
+            return
+
+        source_fps = self.info['fps']
+        self.interval = max(source_fps / float(frames_per_second), 1.0) \
+            if frames_per_second and source_fps > 0 else 1.0
+        w, h = size if size is not None else (crop[2:] if crop is not None else (self.info['width'], self.info['height']))
+        self.shape = (h, w) if gray else (h, w, 3)
+        self.ring = [np.empty(self.shape, np.uint8) for _ in range(max(buffers, 1))]
+        self.indices = selected_frames(self.interval)
+
+        cmd = [binary, '-hide_banner', '-loglevel', 'error', '-nostdin', '-threads', str(threads),
+               '-i', self.video_path]
+        graph = filter_graph(crop, size, self.interval)
+        if graph:
+            cmd += ['-vf', graph]
+        # passthrough: emit exactly the selected frames, no duplication to a constant rate
+        cmd += [fps_mode_option(binary), 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'gray' if gray else 'bgr24',
+                'pipe:1']
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self.stderr, bufsize=0)
+        # Fails here (and closes the source) if ffmpeg cannot decode the video at all
+        self.pending = self._read_frame()
+
+    def isOpened(self):
+        return self.proc is not None
+
+    def get(self, prop):
+        """
+        The cv2.CAP_PROP_* values the scripts use (of the source video).
+        """
+        if self.info is None:
+            return 0.0
+        return {cv2.CAP_PROP_FPS: self.info['fps'], cv2.CAP_PROP_FRAME_COUNT: self.info['frames'],
+                cv2.CAP_PROP_FRAME_WIDTH: self.info['width'],
+                cv2.CAP_PROP_FRAME_HEIGHT: self.info['height']}.get(prop, 0.0)
+
+    def _read_frame(self):
+        # Next frame from the pipe into the ring, or None at the end
+        if self.proc is None:
+            return None
+        frame = self.ring[self.frame_count % len(self.ring)]
+        view = memoryview(frame).cast('B')
+        filled = 0
+        while filled < len(view):
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        if filled < len(view):
+            self.finished = True
+            self.release()
+            return None
+        self.frame_count += 1
+        return frame
+
+    def read_indexed(self):
+        """
+        (frame_idx, frame) of the next frame, or (None, None) at the end of the video.
+        """
+        frame, self.pending = self.pending, None
+        if frame is None:
+            frame = self._read_frame()
+        if frame is None:
+            return None, None
+        return next(self.indices), frame
+
+    def read(self):
+        """
+        (ret, frame) like cv2.VideoCapture.read().
+        """
+        _, frame = self.read_indexed()
+        return frame is not None, frame
+
+    def __iter__(self):
+        """
+        (frame_idx, timestamp_s, frame) like frameSampler.sample_video_frames.
+        """
+        fps = self.info['fps'] if self.info else 0
+        try:
+            while True:
+                frame_idx, frame = self.read_indexed()
+                if frame is None:
+                    break
+                yield frame_idx, frame_idx / fps if fps > 0 else 0.0, frame
+        finally:
+            self.release()
+
+    def release(self):
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.terminate()
+        returncode = proc.wait()
+        self.stderr.seek(0)
+        message = self.stderr.read().decode(errors='replace').strip()
+        self.stderr.close()
+        # Stopping before the end closes the pipe under ffmpeg, which is not an error
+        if self.finished and returncode != 0:
+            self.failed = True
+            print(f"ffmpeg error for {self.video_path}: "
+                  f"{message.splitlines()[-1] if message else f'exit code {returncode}'}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def sample_ffmpeg_frames(video_path, frames_per_second=None, crop=None, size=None, gray=False, **kwargs):
+    """
+    Generator yielding (frame_idx, timestamp_s, frame) like
+    frameSampler.sample_video_frames, with crop / scale / gray done by ffmpeg.
+    """
+    yield from FFmpegSource(video_path, crop, size, gray, frames_per_second, **kwargs)
+
+# -------------------------------
+# Benchmark
+# -------------------------------
+
+def benchmark(video_path, circle, output_size=(1024, 1024), tolerance=10, frames_per_second=4):
+    """
+    Frames per second of cv2.VideoCapture + OpenCV crop/gray/resize against
+    FFmpegSource doing the same in the decoder, for every frame and for
+    frames_per_second sampling.
+    """
+    from frameSampler import sample_video_frames
+
+    info = video_info(video_path)
+    crop = roi_crop(circle, tolerance, info['width'], info['height'])
+    x, y, w, h = crop
+
+    def opencv(fps=None):
+        for _, _, frame in sample_video_frames(video_path, fps):
+            roi = cv2.cvtColor(frame[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY)
+            yield cv2.resize(roi, output_size)
+
+    def ffmpeg(fps=None):
+        for _, _, frame in sample_ffmpeg_frames(video_path, fps, crop, output_size, gray=True):
+            yield frame
+
+    results = {}
+    for name, frames in (('opencv all frames', opencv()), ('ffmpeg all frames', ffmpeg()),
+                         (f'opencv {frames_per_second} fps', opencv(frames_per_second)),
+                         (f'ffmpeg {frames_per_second} fps', ffmpeg(frames_per_second))):
+        start = time.perf_counter()
+        count = sum(1 for _ in frames)
+        elapsed = time.perf_counter() - start
+        results[name] = {'frames': count, 'seconds': elapsed, 'fps': count / max(elapsed, 1e-9)}
+        print(f"{name:<22}{count:>7} frames {elapsed:>8.2f} s {count / max(elapsed, 1e-9):>8.1f} fps")
+
+    # Same frames from both paths?
+    a, b = next(opencv()), next(ffmpeg())
+    print(f"Mean absolute difference of the first frame: {np.abs(a.astype(np.int16) - b).mean():.2f} grey levels")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ffmpeg frame source against cv2.VideoCapture.')
+    parser.add_argument('video', nargs='?', help='video to decode (default: a synthetic video)')
+    parser.add_argument('--frames', type=int, default=60, help='frames of the synthetic video')
+    parser.add_argument('--fps', type=float, default=4, help='sampling rate for the sampled runs')
+    args = parser.parse_args()
+
+    from benchmark import write_synthetic_video, synthetic_well
+    with tempfile.TemporaryDirectory() as workdir:
+        video_path = args.video
+        if video_path is None:
+            video_path = write_synthetic_video(os.path.join(workdir, 'synthetic.avi'), args.frames)
+            circle = synthetic_well()
+        else:
+            from circleCache import CircleRegistry
+            cap = cv2.VideoCapture(video_path)
+            ret, frame = cap.read()
+            cap.release()
+            circle = CircleRegistry(video_path).get(frame) if ret else None
+            if circle is None:
+                print("No circle detected")
+                return
+        benchmark(video_path, circle, frames_per_second=args.fps)
+
+if __name__ == "__main__":
+    main()
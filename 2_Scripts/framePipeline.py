@@ -0,0 +1,131 @@
+"""
+Threaded Frame Pipeline
+
+Runs decode -> process -> encode as overlapping stages instead of one serial loop:
+
+    decoder thread --(bounded queue)--> N processing threads --(bounded queue)--> ordered writer
+
+  - The decoder consumes any frame iterable (e.g. a cv2.VideoCapture loop).
+  - OpenCV releases the GIL inside its C++ calls, so processing threads run in parallel.
+  - The writer (calling thread) re-orders results by frame index, so output is
+    identical to the serial loop.
+  - At most `max_in_flight` frames exist between decoder and writer at any time
+    (backpressure), so memory stays capped even if one stage stalls.
+
+Usage:
+    run_pipeline(frames, process, write, workers=4)
+
+Requirements:
+  - Python 3.x
+"""
+
+import os
+import queue
+import threading
+import instrumentation as inst
+
+WORKERS = min(4, os.cpu_count() or 1)  # Processing threads
+QUEUE_SIZE = 16                         # Capacity of each queue between stages
+
+_DONE = object()
+
+# -------------------------------
+# Pipeline
+# -------------------------------
+
+def run_pipeline(frames, process, write, workers=WORKERS, queue_size=QUEUE_SIZE):
+    """
+    Decode `frames` on a background thread, apply `process(item)` on `workers`
+    threads and call `write(result)` on the calling thread in the original order.
+    Returns the number of frames written. Exceptions of any stage are re-raised.
+    """
+    workers = max(1, workers)
+    max_in_flight = 2 * queue_size + workers
+    in_q = queue.Queue(maxsize=queue_size)
+    out_q = queue.Queue(maxsize=queue_size)
+    slots = threading.Semaphore(max_in_flight)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # Blocking put that gives up when the pipeline is being torn down
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decoder():
+        count = 0
+        try:
+            for item in frames:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if not put(in_q, (count, item)):
+                    return
+                count += 1
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for _ in range(workers):
+                put(in_q, _DONE)
+
+    def worker():
+        try:
+            while not stop.is_set():
+                try:
+                    item = in_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                idx, frame = item
+                if not put(out_q, (idx, process(frame))):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(out_q, _DONE)
+
+    threads = [threading.Thread(target=decoder, name='decoder', daemon=True)]
+    threads += [threading.Thread(target=worker, name=f'worker-{i}', daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+
+    pending = {}
+    next_idx = 0
+    finished_workers = 0
+    try:
+        while finished_workers < workers and not stop.is_set():
+            try:
+                item = out_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                finished_workers += 1
+                continue
+            idx, result = item
+            pending[idx] = result
+            inst.gauge('decode_queue_depth', in_q.qsize())
+            inst.gauge('output_queue_depth', out_q.qsize())
+            inst.gauge('reorder_buffer', len(pending))
+            while next_idx in pending:
+                write(pending.pop(next_idx))
+                next_idx += 1
+                slots.release()
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return next_idx
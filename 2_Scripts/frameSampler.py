@@ -0,0 +1,266 @@
+"""
+Streaming Frame Sampler
+
+Yields frames from a video lazily instead of collecting them in a list, so
+memory stays flat no matter how long the recording is.
+
+Frames that are not wanted are skipped without decoding them:
+  - small gaps are skipped with cap.grab() (demux only, no retrieve/convert)
+  - large gaps are skipped by seeking (CAP_PROP_POS_FRAMES), which lets the
+    decoder jump to the nearest keyframe
+
+With gray=True frames come out single-channel. Where the backend allows it
+(CAP_PROP_CONVERT_RGB off), the luma plane of the decoded picture is handed
+out directly, skipping the YUV -> BGR conversion and the BGR -> gray
+conversion after it; limited-range video is stretched to full range with a
+lookup table fitted on the first frame. OpenCV's FFmpeg backend does not
+support this (it prints a warning for every frame), so with it frames are
+decoded as BGR and converted; this is decided once per video. For decoding
+straight to gray through ffmpeg see ffmpegSource.py.
+
+Adaptive (motion-aware) sampling probes the video at `probe_fps`, scores every
+probe by its downscaled difference to the last kept frame and only emits
+frames whose content changed beyond a threshold, bounded by a minimum and
+maximum interval between kept frames.
+
+Usage:
+    for frame_idx, timestamp, frame in sample_video_frames(path, frames_per_second=4):
+        ...
+    for frame_idx, timestamp, gray in sample_video_frames(path, 4, gray=True):
+        ...
+    for frame_idx, timestamp, frame, info in adaptive_sample_video_frames(path, log_path='motion.csv'):
+        print(info['reason'], info['motion'])
+
+Requirements:
+  - OpenCV
+  - Python 3.x
+"""
+
+import os
+import csv
+import cv2
+import numpy as np
+import instrumentation as inst
+
+# Gaps (in source frames) larger than this are skipped by seeking instead of grabbing
+SEEK_THRESHOLD = 60
+
+# Adaptive sampling defaults
+PROBE_FPS = 4            # Frames per second that are scored for motion
+MOTION_THRESHOLD = 2.0   # Mean absolute grey-level change that counts as new content
+MIN_INTERVAL = 0.5       # Seconds between two kept frames, at least
+MAX_INTERVAL = 10.0      # Seconds between two kept frames, at most
+MOTION_WIDTH = 160       # Width of the downscaled frame used for scoring
+
+GRAY_FIT_ERROR = 2.0     # Mean grey-level error of the luma plane vs. BGR -> gray above which it is not used
+NO_LUMA_BACKENDS = ('FFMPEG',)  # Capture backends without usable CAP_PROP_CONVERT_RGB = 0
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def open_video(video_path):
+    """
+    Open a video file. Returns the capture object or None if it could not be opened.
+    """
+    if not os.path.exists(video_path):
+        print(f"Error: File does not exist at {video_path}")
+        return None
+
+    cap = cv2.VideoCapture(str(video_path))
+    if not cap.isOpened():
+        print(f"Error: Could not open video file: {video_path}")
+        cap.release()
+        return None
+    return cap
+
+def luma_lut(video_path, max_error=GRAY_FIT_ERROR):
+    """
+    Check whether the backend hands out the luma plane of a video as a
+    single-channel frame. Compares the first frame decoded both ways and fits
+    gray = a * luma + b. Returns the uint8 lookup table that maps luma to gray
+    (None if luma already is gray), or False if the luma plane is not usable.
+    """
+    bgr_cap, luma_cap = cv2.VideoCapture(str(video_path)), cv2.VideoCapture(str(video_path))
+    try:
+        luma_cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        ret_bgr, bgr = bgr_cap.read()
+        ret_luma, luma = luma_cap.read()
+    finally:
+        bgr_cap.release()
+        luma_cap.release()
+    if not (ret_bgr and ret_luma) or luma.ndim != 2 or luma.dtype != np.uint8 or luma.shape != bgr.shape[:2]:
+        return False
+    # Every 7th pixel is plenty for a two-parameter fit
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY).ravel()[::7].astype(np.float64)
+    y = luma.ravel()[::7].astype(np.float64)
+    a, b = np.polyfit(y, gray, 1) if y.std() > 0 else (1.0, float(gray.mean() - y.mean()))
+    if np.abs(a * y + b - gray).mean() > max_error:
+        return False
+    if abs(a - 1) < 0.02 and abs(b) < 1:
+        return None
+    return np.clip(np.round(a * np.arange(256) + b), 0, 255).astype(np.uint8)
+
+def open_gray_video(video_path, convert=True):
+    """
+    Open a video for single-channel reading. Returns (cap, to_gray) where
+    to_gray(frame) turns a frame read from cap into grayscale, or (None, None).
+    If the backend cannot decode to gray and convert=False, to_gray is None:
+    frames stay BGR for the caller to convert, e.g. only the cropped ROI.
+    """
+    cap = open_video(video_path)
+    if cap is None:
+        return None, None
+    # Checked once per video: the FFmpeg backend would warn on every frame
+    lut = False if cap.getBackendName() in NO_LUMA_BACKENDS else luma_lut(video_path)
+    if lut is False:
+        print("Decoding to gray is not supported for this video, converting BGR frames")
+        return cap, (lambda frame: cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)) if convert else None
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    if lut is None:
+        return cap, lambda frame: frame
+    return cap, lambda frame: cv2.LUT(frame, lut)
+
+def frame_interval_for(source_fps, frames_per_second):
+    """
+    Number of source frames between two sampled frames (at least 1).
+    frames_per_second=None keeps every frame.
+    """
+    if not frames_per_second or source_fps <= 0:
+        return 1.0
+    return max(source_fps / float(frames_per_second), 1.0)
+
+def skip_frames(cap, current, target, seek_threshold=SEEK_THRESHOLD):
+    """
+    Advance the capture from frame index `current` to `target` without decoding
+    the frames in between. Returns False if the end of the video was reached.
+    """
+    gap = target - current
+    if gap <= 0:
+        return True
+    if gap > seek_threshold:
+        return cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+    for _ in range(gap):
+        if not cap.grab():
+            return False
+    return True
+
+def sample_video_frames(video_path, frames_per_second=None, start_frame=0, seek_threshold=SEEK_THRESHOLD,
+                        gray=False):
+    """
+    Generator yielding (frame_idx, timestamp_s, frame) for the sampled frames of a video.
+
+    frame_idx is the index of the frame in the source video and timestamp_s its
+    position in seconds. frames_per_second=None yields every frame.
+    gray=True yields single-channel frames (see open_gray_video).
+    """
+    if gray:
+        cap, to_gray = open_gray_video(video_path)
+    else:
+        cap, to_gray = open_video(video_path), None
+    if cap is None:
+        return
+
+    try:
+        source_fps = cap.get(cv2.CAP_PROP_FPS)
+        interval = frame_interval_for(source_fps, frames_per_second)
+
+        if start_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        position = start_frame   # index of the next frame the capture will return
+        next_sample = float(start_frame)
+
+        while True:
+            target = int(round(next_sample))
+            with inst.stage('decode'):
+                if not skip_frames(cap, position, target, seek_threshold):
+                    break
+                position = max(position, target)
+                ret, frame = cap.read()
+            if not ret:
+                break
+            if to_gray is not None:
+                frame = to_gray(frame)
+            timestamp = position / source_fps if source_fps > 0 else cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            yield position, timestamp, frame
+            position += 1
+            next_sample += interval
+    finally:
+        cap.release()
+
+# -------------------------------
+# Adaptive Sampling
+# -------------------------------
+
+def motion_thumbnail(frame, width=MOTION_WIDTH):
+    """
+    Small blurred grayscale version of a frame used for motion scoring.
+    """
+    h, w = frame.shape[:2]
+    small = cv2.resize(frame, (width, max(int(h * width / w), 1)), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(small, (5, 5), 0)
+
+def motion_score(a, b):
+    """
+    Mean absolute grey-level difference between two thumbnails.
+    """
+    return float(cv2.absdiff(a, b).mean())
+
+def adaptive_sample_video_frames(video_path, threshold=MOTION_THRESHOLD, min_interval=MIN_INTERVAL,
+                                 max_interval=MAX_INTERVAL, probe_fps=PROBE_FPS, log_path=None, gray=False):
+    """
+    Generator yielding (frame_idx, timestamp_s, frame, info) only for frames whose
+    content changed since the last kept frame.
+
+    info holds 'motion' (score against the previous probe), 'change' (score
+    against the last kept frame) and 'reason' ('first', 'motion' or
+    'max_interval'). A frame is kept when change >= threshold and at least
+    min_interval seconds passed, or when max_interval seconds passed without
+    a kept frame. If log_path is given, every probed frame is written to a CSV
+    (frame_idx, timestamp, motion, change, kept, reason). gray=True yields
+    single-channel frames.
+    """
+    log_file = open(log_path, 'w', newline='') if log_path else None
+    log = csv.writer(log_file) if log_file else None
+    if log:
+        log.writerow(['frame_idx', 'timestamp', 'motion', 'change', 'kept', 'reason'])
+
+    kept_thumb = None
+    kept_time = None
+    previous_thumb = None
+    probed = kept = 0
+    try:
+        for frame_idx, timestamp, frame in sample_video_frames(video_path, probe_fps, gray=gray):
+            with inst.stage('motion'):
+                thumb = motion_thumbnail(frame)
+                motion = motion_score(thumb, previous_thumb) if previous_thumb is not None else 0.0
+                change = motion_score(thumb, kept_thumb) if kept_thumb is not None else np.inf
+            previous_thumb = thumb
+            probed += 1
+
+            reason = ''
+            if kept_thumb is None:
+                reason = 'first'
+            elif timestamp - kept_time >= max_interval:
+                reason = 'max_interval'
+            elif timestamp - kept_time >= min_interval and change >= threshold:
+                reason = 'motion'
+
+            if log:
+                log.writerow([frame_idx, f"{timestamp:.3f}", f"{motion:.3f}",
+                              f"{change:.3f}" if np.isfinite(change) else '', int(bool(reason)), reason])
+            if not reason:
+                inst.count('frames_redundant')
+                continue
+
+            kept += 1
+            kept_thumb, kept_time = thumb, timestamp
+            print(f"Keeping frame {frame_idx} at {timestamp:.2f} s ({reason}, change {change:.2f}, motion {motion:.2f})")
+            yield frame_idx, timestamp, frame, {'motion': motion, 'change': change, 'reason': reason}
+    finally:
+        if log_file:
+            log_file.close()
+        if probed:
+            print(f"Adaptive sampling kept {kept}/{probed} probed frames")
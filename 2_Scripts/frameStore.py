@@ -0,0 +1,218 @@
+"""
+Chunked Frame Store
+
+On-disk alternative to writing one JPEG/PNG per frame. A store is a directory
+(by convention named <video>.frames) containing:
+  - meta.json          frame shape, dtype, chunk size, compression and free-form attributes
+  - chunk_00000.npy    up to `chunk_size` frames as one (N, H, W[, C]) uint8 array
+                       (chunk_00000.npz when compressed)
+  - index.csv          one row per frame: position, name, chunk, offset, source video,
+                       source frame index, timestamp and well circle (x, y, r)
+
+Uncompressed chunks are opened with np.load(mmap_mode='r'), so reading a frame
+is a zero-copy view into the page cache and random access costs no decoding.
+Compressed chunks trade that for disk space (lossless, unlike JPEG).
+
+Usage:
+    with FrameStoreWriter('C0134.frames', (2048, 2048), source='C0134.MP4') as store:
+        store.append(frame, name='C0134_frame_0.jpg', frame_idx=0, timestamp=0.0, circle=(x, y, r))
+
+    store = FrameStore('C0134.frames')
+    frame = store[10]
+    for name, frame in iter_images('C0134.frames'):   # also works on image folders
+        ...
+
+Requirements:
+  - OpenCV
+  - NumPy
+"""
+
+import os
+import csv
+import json
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.bmp']
+CHUNK_SIZE = 256  # Frames per chunk file
+INDEX_FIELDS = ['position', 'name', 'chunk', 'offset', 'source', 'frame_idx', 'timestamp', 'x', 'y', 'r']
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def is_frame_store(path):
+    """
+    True if path is a frame store directory.
+    """
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+def chunk_path(path, chunk, compress):
+    return os.path.join(path, f"chunk_{chunk:05d}.{'npz' if compress else 'npy'}")
+
+def iter_images(path, color=True):
+    """
+    Yield (name, image) from either a frame store or a directory of image files.
+    Images are BGR (or grayscale if color=False / the store holds gray frames).
+    """
+    if is_frame_store(path):
+        store = FrameStore(path)
+        for i in range(len(store)):
+            frame = store[i]
+            if not color and frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            yield store.index[i]['name'], frame
+        return
+
+    flag = cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE
+    for filename in sorted(os.listdir(path)):
+        if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+            img = cv2.imread(os.path.join(path, filename), flag)
+            if img is None:
+                print(f"Error reading image: {filename}")
+                continue
+            yield filename, img
+
+# -------------------------------
+# Writer
+# -------------------------------
+
+class FrameStoreWriter:
+    """
+    Appends fixed-size frames to a frame store, one chunk file at a time.
+    Frames with a different height/width are resized to `frame_shape`.
+    """
+
+    def __init__(self, path, frame_shape, chunk_size=CHUNK_SIZE, compress=False, **attrs):
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.chunk_size = chunk_size
+        self.compress = compress
+        os.makedirs(path, exist_ok=True)
+
+        self.meta = {'frame_shape': list(self.frame_shape), 'dtype': 'uint8',
+                     'chunk_size': chunk_size, 'compress': compress, 'attrs': attrs}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+        self.buffer = np.empty((chunk_size,) + self.frame_shape, np.uint8)
+        self.rows = []
+        self.chunk = 0
+        self.count = 0
+        self.index_file = open(os.path.join(path, 'index.csv'), 'w', newline='')
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(INDEX_FIELDS)
+
+    def append(self, frame, name=None, source='', frame_idx=-1, timestamp=float('nan'), circle=None):
+        """
+        Add one frame with its metadata. Returns the frame's position in the store.
+        """
+        if frame.ndim != len(self.frame_shape) or frame.shape[2:] != self.frame_shape[2:]:
+            raise ValueError(f"Frame shape {frame.shape} does not match store shape {self.frame_shape}")
+        if frame.shape[:2] != self.frame_shape[:2]:
+            frame = cv2.resize(frame, (self.frame_shape[1], self.frame_shape[0]), interpolation=cv2.INTER_AREA)
+
+        offset = len(self.rows)
+        self.buffer[offset] = frame
+        x, y, r = circle if circle is not None else ('', '', '')
+        self.rows.append([self.count, name or f"frame_{self.count}", self.chunk, offset,
+                          source, frame_idx, timestamp, x, y, r])
+        self.count += 1
+        if len(self.rows) == self.chunk_size:
+            self.flush()
+        return self.count - 1
+
+    def flush(self):
+        """
+        Write the buffered frames as a chunk file and their index rows.
+        """
+        if not self.rows:
+            return
+        data = self.buffer[:len(self.rows)]
+        final_path = chunk_path(self.path, self.chunk, self.compress)
+        tmp_path = final_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            if self.compress:
+                np.savez_compressed(f, frames=data)
+            else:
+                np.save(f, data)
+        os.replace(tmp_path, final_path)
+
+        # Index rows only become visible once their chunk is on disk
+        self.index_writer.writerows(self.rows)
+        self.index_file.flush()
+        self.rows = []
+        self.chunk += 1
+
+    def close(self):
+        self.flush()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# -------------------------------
+# Reader
+# -------------------------------
+
+class FrameStore:
+    """
+    Random-access reader for a frame store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.frame_shape = tuple(self.meta['frame_shape'])
+        self.compress = self.meta['compress']
+        self.attrs = self.meta.get('attrs', {})
+
+        with open(os.path.join(path, 'index.csv'), newline='') as f:
+            self.index = list(csv.DictReader(f))
+        for row in self.index:
+            for field in ('position', 'chunk', 'offset', 'frame_idx'):
+                row[field] = int(row[field])
+            row['timestamp'] = float(row['timestamp'])
+            row['circle'] = tuple(int(float(row[k])) for k in ('x', 'y', 'r')) if row['r'] else None
+        self._positions = {row['name']: row['position'] for row in self.index}
+        self._chunks = {}
+        self._cached_chunk = (None, None)  # last decompressed chunk
+
+    def __len__(self):
+        return len(self.index)
+
+    def _chunk(self, chunk):
+        if not self.compress:
+            data = self._chunks.get(chunk)
+            if data is None:
+                data = self._chunks[chunk] = np.load(chunk_path(self.path, chunk, False), mmap_mode='r')
+            return data
+        if self._cached_chunk[0] != chunk:
+            with np.load(chunk_path(self.path, chunk, True)) as npz:
+                self._cached_chunk = (chunk, npz['frames'])
+        return self._cached_chunk[1]
+
+    def __getitem__(self, position):
+        """
+        Frame at `position` (read-only view for uncompressed stores).
+        """
+        row = self.index[position]
+        return self._chunk(row['chunk'])[row['offset']]
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def get(self, name):
+        """
+        Frame by name, or None if the store has no frame of that name.
+        """
+        position = self._positions.get(name)
+        return None if position is None else self[position]
+
+    def names(self):
+        return [row['name'] for row in self.index]
@@ -0,0 +1,169 @@
+"""
+Coarse-to-fine Hough Circle Detector
+
+Drop-in replacement for houghCircle() on the full-resolution watershed mask.
+  1. Finds candidate circles with HOUGH_GRADIENT on a heavily downscaled mask.
+  2. Refines centre and radius at full resolution, but only from edge points
+     sampled inside a narrow annulus around the candidate (least-squares fit).
+
+Returns the same contract as cv2.HoughCircles / houghCircle: an array of shape
+(1, N, 3) with [centerx, centery, radius] rows, strongest first, or None.
+
+Running this file prints an accuracy/speed report against the single-scale
+houghCircle() on synthetic well masks:
+    python houghPyramid.py
+
+Requirements:
+  - OpenCV
+  - NumPy
+"""
+
+import time
+import cv2
+import numpy as np
+
+PYRAMID_SCALE = 8   # Downscale factor of the coarse search
+REFINE_BAND = 12    # Half width (full resolution px) of the refinement annulus
+MAX_CANDIDATES = 3  # Coarse candidates that are refined
+RAYS = 360          # Radial samples used for the refinement
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def houghCircle(img, param1, param2, minRadius, maxRadius):
+    """
+    Reference single-scale Hough Circle Transform (dp=1, full resolution).
+    """
+    return cv2.HoughCircles(img, cv2.HOUGH_GRADIENT, 1, 20,
+                            param1=param1, param2=param2, minRadius=minRadius, maxRadius=maxRadius)
+
+def coarse_candidates(img, param1, param2, minRadius, maxRadius, scale=PYRAMID_SCALE):
+    """
+    Candidate circles found on the mask downscaled by `scale`, in full-resolution coordinates.
+    """
+    small = cv2.resize(img, None, fx=1.0 / scale, fy=1.0 / scale, interpolation=cv2.INTER_AREA)
+    min_r = max(int(minRadius / scale), 1)
+    max_r = max(int(np.ceil(maxRadius / scale)), min_r + 1)
+    circles = cv2.HoughCircles(small, cv2.HOUGH_GRADIENT, 1, max(min_r, 1),
+                               param1=param1, param2=max(param2 // 2, 1),
+                               minRadius=min_r, maxRadius=max_r)
+    if circles is None:
+        return None
+    return circles[0, :MAX_CANDIDATES] * scale
+
+def fit_circle(xs, ys):
+    """
+    Algebraic least-squares circle fit (Kasa). Returns (x, y, r).
+    """
+    A = np.column_stack([xs, ys, np.ones_like(xs)])
+    b = xs ** 2 + ys ** 2
+    (a0, a1, a2), *_ = np.linalg.lstsq(A, b, rcond=None)
+    cx, cy = a0 / 2, a1 / 2
+    return cx, cy, np.sqrt(a2 + cx ** 2 + cy ** 2)
+
+def refine_circle(img, candidate, band=REFINE_BAND, scale=PYRAMID_SCALE, n_rays=RAYS):
+    """
+    Refine one candidate at full resolution. Samples the mask along `n_rays`
+    radial lines inside an annulus of +/- (band + scale) px around the candidate,
+    takes the strongest transition on each ray as an edge point and fits a
+    circle to those points (twice, dropping outliers such as noise blobs
+    touching the well edge). Returns [x, y, r] or None.
+    """
+    x, y, r = candidate
+    tolerance = band + scale
+    h, w = img.shape[:2]
+
+    angles = np.linspace(0, 2 * np.pi, n_rays, endpoint=False)
+    offsets = np.arange(-tolerance, tolerance + 1, dtype=np.float32)
+    radii = r + offsets
+    xs = x + np.cos(angles)[:, None] * radii[None, :]
+    ys = y + np.sin(angles)[:, None] * radii[None, :]
+
+    # Drop rays that leave the image (the well is often clipped by the frame)
+    inside = ((xs >= 0) & (xs <= w - 1) & (ys >= 0) & (ys <= h - 1)).all(axis=1)
+    if inside.sum() < 8:
+        return None
+    xs, ys = xs[inside], ys[inside]
+
+    profiles = img[np.rint(ys).astype(np.intp), np.rint(xs).astype(np.intp)].astype(np.int16)
+    steps = np.abs(np.diff(profiles, axis=1))
+    edge = steps.argmax(axis=1)
+    valid = steps[np.arange(len(edge)), edge] > 0
+    if valid.sum() < 8:
+        return None
+    rows = np.flatnonzero(valid)
+    ex = (xs[rows, edge[rows]] + xs[rows, edge[rows] + 1]) / 2
+    ey = (ys[rows, edge[rows]] + ys[rows, edge[rows] + 1]) / 2
+
+    cx, cy, cr = fit_circle(ex, ey)
+    residual = np.abs(np.hypot(ex - cx, ey - cy) - cr)
+    keep = residual <= max(np.median(residual) * 3, 1.0)
+    if keep.sum() >= 8:
+        cx, cy, cr = fit_circle(ex[keep], ey[keep])
+    return [cx, cy, cr]
+
+def houghCirclePyramid(img, param1, param2, minRadius, maxRadius, scale=PYRAMID_SCALE):
+    """
+    Coarse-to-fine Hough Circle Transform. Returns array of circles detected
+    [centerx, centery, radius] with shape (1, N, 3), like houghCircle, or None.
+    """
+    candidates = coarse_candidates(img, param1, param2, minRadius, maxRadius, scale)
+    if candidates is None:
+        return None
+
+    refined = []
+    for candidate in candidates:
+        circle = refine_circle(img, candidate, scale=scale)
+        # The refined radius may leave the search band by up to one coarse pixel
+        if circle is not None and minRadius - scale <= circle[2] <= maxRadius + scale:
+            refined.append(circle)
+    if not refined:
+        return None
+    return np.array([refined], dtype=np.float32)
+
+# -------------------------------
+# Accuracy / Speed Report
+# -------------------------------
+
+def synthetic_well_mask(shape, center, radius, rng):
+    """
+    Binary mask like the watershed output: a white ring of background outside
+    the well plus blobs of noise inside it.
+    """
+    mask = np.full(shape, 255, np.uint8)
+    cv2.circle(mask, center, radius, 0, -1)
+    for _ in range(40):
+        p = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        cv2.circle(mask, p, int(rng.integers(3, 25)), 255, -1)
+    return mask
+
+def report(trials=10, shape=(2160, 2560), seed=0):
+    rng = np.random.default_rng(seed)
+    params = (40, 20, 900, 1100)
+    rows = {'houghCircle': [], 'houghCirclePyramid': []}
+
+    for _ in range(trials):
+        radius = int(rng.integers(950, 1060))
+        center = (int(rng.integers(radius - 50, shape[1] - radius + 50)),
+                  int(rng.integers(shape[0] // 2 - 30, shape[0] // 2 + 30)))
+        mask = synthetic_well_mask(shape, center, radius, rng)
+
+        for name, fn in (('houghCircle', houghCircle), ('houghCirclePyramid', houghCirclePyramid)):
+            start = time.perf_counter()
+            circles = fn(mask, *params)
+            elapsed = time.perf_counter() - start
+            if circles is None:
+                rows[name].append((elapsed, np.nan, np.nan))
+                continue
+            x, y, r = circles[0, 0]
+            rows[name].append((elapsed, np.hypot(x - center[0], y - center[1]), abs(r - radius)))
+
+    print(f"{'detector':<20}{'ms/frame':>10}{'centre err px':>15}{'radius err px':>15}{'missed':>8}")
+    for name, values in rows.items():
+        values = np.array(values)
+        print(f"{name:<20}{values[:, 0].mean() * 1000:>10.1f}{np.nanmean(values[:, 1]):>15.2f}"
+              f"{np.nanmean(values[:, 2]):>15.2f}{int(np.isnan(values[:, 1]).sum()):>8}")
+
+if __name__ == "__main__":
+    report()
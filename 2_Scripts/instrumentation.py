@@ -0,0 +1,282 @@
+"""
+Pipeline Instrumentation
+
+Shared timing / counter layer for the preprocessing scripts. Each stage
+(decode, watershed, hough, crop, mask, clahe, encode, write, ...) is wrapped in
+a timer; the layer collects per-stage latency histograms, counters (frames
+dropped, circles missed, ...) and gauges such as queue depths, and exports a
+JSON run report and optionally a Prometheus text file.
+
+Disabled by default. While disabled, stage() returns a shared no-op context
+manager and count()/gauge() return immediately, so instrumented loops cost
+practically nothing.
+
+Usage:
+    import instrumentation as inst
+    inst.enable()                     # or set NEMATODE_PROFILE=1
+    with inst.stage('watershed'):
+        mask = watershed(frame)
+    inst.count('circles_missed')
+    inst.gauge('queue_depth', q.qsize())
+    inst.write_report('run_report.json', prometheus_path='run_report.prom')
+
+Requirements:
+  - Python 3.x
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf')]
+
+# -------------------------------
+# Metrics
+# -------------------------------
+
+class StageStats:
+    """
+    Latency histogram and summary of one stage.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        return {'count': self.count, 'total_s': self.total,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'min_ms': self.min * 1000 if self.count else 0.0, 'max_ms': self.max * 1000,
+                'histogram': {('+Inf' if b == float('inf') else str(b)): n for b, n in zip(BUCKETS, self.buckets)}}
+
+class GaugeStats:
+    """
+    Last / max / mean of a sampled value such as a queue depth.
+    """
+
+    def __init__(self):
+        self.last = 0
+        self.max = 0
+        self.total = 0.0
+        self.samples = 0
+
+    def add(self, value):
+        self.last = value
+        self.max = max(self.max, value)
+        self.total += value
+        self.samples += 1
+
+    def to_dict(self):
+        return {'last': self.last, 'max': self.max, 'mean': self.total / self.samples if self.samples else 0.0}
+
+class _Timer:
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class Recorder:
+    """
+    Thread-safe collection of stage timings, counters and gauges for one run.
+    """
+
+    def __init__(self, run_name=''):
+        self.run_name = run_name
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        return _Timer(self, name)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            stats = self.gauges.get(name)
+            if stats is None:
+                stats = self.gauges[name] = GaugeStats()
+            stats.add(value)
+
+    def drain(self):
+        """
+        Take the collected metrics (picklable, e.g. to send them from a worker
+        process to the parent) and start over.
+        """
+        with self.lock:
+            drained = {'stages': self.stages, 'counters': self.counters, 'gauges': self.gauges}
+            self.stages, self.counters, self.gauges = {}, {}, {}
+        return drained
+
+    def merge(self, drained):
+        """
+        Add metrics returned by drain() (of another process) to this recorder.
+        """
+        with self.lock:
+            for name, other in drained['stages'].items():
+                stats = self.stages.setdefault(name, StageStats())
+                stats.count += other.count
+                stats.total += other.total
+                stats.min = min(stats.min, other.min)
+                stats.max = max(stats.max, other.max)
+                stats.buckets = [a + b for a, b in zip(stats.buckets, other.buckets)]
+            for name, value in drained['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in drained['gauges'].items():
+                stats = self.gauges.setdefault(name, GaugeStats())
+                stats.last = other.last
+                stats.max = max(stats.max, other.max)
+                stats.total += other.total
+                stats.samples += other.samples
+
+    def report(self):
+        with self.lock:
+            return {'run': self.run_name, 'started': self.started, 'wall_s': time.time() - self.started,
+                    'stages': {k: v.to_dict() for k, v in self.stages.items()},
+                    'counters': dict(self.counters),
+                    'gauges': {k: v.to_dict() for k, v in self.gauges.items()}}
+
+    def prometheus(self, prefix='nematode'):
+        """
+        Report in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for name, stats in self.stages.items():
+                cumulative = 0
+                for bound, n in zip(BUCKETS, stats.buckets):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats.total}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats.count}')
+            lines.append(f"# TYPE {prefix}_events_total counter")
+            for name, value in self.counters.items():
+                lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+            lines.append(f"# TYPE {prefix}_gauge gauge")
+            for name, stats in self.gauges.items():
+                lines.append(f'{prefix}_gauge{{name="{name}",stat="last"}} {stats.last}')
+                lines.append(f'{prefix}_gauge{{name="{name}",stat="max"}} {stats.max}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Short human readable table of the stage timings.
+        """
+        report = self.report()
+        lines = [f"{'stage':<16}{'count':>8}{'mean ms':>10}{'max ms':>10}{'total s':>10}"]
+        for name, s in sorted(report['stages'].items(), key=lambda kv: -kv[1]['total_s']):
+            lines.append(f"{name:<16}{s['count']:>8}{s['mean_ms']:>10.2f}{s['max_ms']:>10.2f}{s['total_s']:>10.2f}")
+        for name, value in report['counters'].items():
+            lines.append(f"{name}: {value}")
+        return '\n'.join(lines)
+
+# -------------------------------
+# Module-level API
+# -------------------------------
+
+_recorder = None
+
+def enable(run_name=''):
+    """
+    Start collecting metrics (replaces any previous recorder). Returns the recorder.
+    """
+    global _recorder
+    _recorder = Recorder(run_name)
+    return _recorder
+
+def disable():
+    global _recorder
+    _recorder = None
+
+def enabled():
+    return _recorder is not None
+
+def stage(name):
+    """
+    Context manager timing one execution of a stage.
+    """
+    if _recorder is None:
+        return _NULL_TIMER
+    return _recorder.stage(name)
+
+def count(name, n=1):
+    if _recorder is not None:
+        _recorder.count(name, n)
+
+def gauge(name, value):
+    if _recorder is not None:
+        _recorder.gauge(name, value)
+
+def drain():
+    """
+    Metrics collected so far in this process (see Recorder.drain), or None while disabled.
+    """
+    return None if _recorder is None else _recorder.drain()
+
+def merge(drained):
+    if _recorder is not None and drained:
+        _recorder.merge(drained)
+
+def write_report(path, prometheus_path=None):
+    """
+    Write the JSON run report (and optionally a Prometheus text file) and print a summary.
+    Does nothing while disabled.
+    """
+    if _recorder is None:
+        return
+    with open(path, 'w') as f:
+        json.dump(_recorder.report(), f, indent=2)
+    if prometheus_path:
+        with open(prometheus_path, 'w') as f:
+            f.write(_recorder.prometheus())
+    print(_recorder.summary())
+    print(f"Saved run report to {path}")
+
+if os.environ.get('NEMATODE_PROFILE'):
+    enable(os.environ.get('NEMATODE_PROFILE_RUN', ''))
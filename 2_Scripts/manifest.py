@@ -0,0 +1,274 @@
+"""
+Processing Manifest
+
+Records, for every output artifact, which input (content hash), pipeline stage
+and parameter set produced it, so reruns only redo work that is new or was
+invalidated by a changed input or parameter.
+
+The manifest is a JSON file (by convention .manifest.json in the output
+directory) mapping output paths, relative to the manifest, to:
+    {"input": ..., "input_hash": ..., "input_stat": [size, mtime_ns], "stage": ...,
+     "params_hash": ..., "params": {...}}
+
+An output is up to date when it still exists and its entry matches the current
+input hash, stage and parameters. input_hash() reuses the recorded hash of an
+input whose size and modification time are unchanged, so a rerun does not
+read every input again.
+
+New entries are appended, every `save_every` records and on close, as JSON
+lines to <manifest>.journal (a crash loses at most that many entries), so
+saving costs the new entries only instead of a rewrite of the whole file.
+close() compacts the journal into the JSON file (written atomically) and
+removes it; reading applies a leftover journal on top of the file. Appending
+and compacting hold an exclusive lock on <manifest>.lock, so several
+processes (e.g. scheduler.py jobs writing into one output directory) can share
+a manifest without dropping each other's entries.
+
+Usage:
+    with Manifest(os.path.join(output_dir, '.manifest.json')) as manifest:
+        h = manifest.input_hash(input_path)
+        if manifest.is_up_to_date(output_path, h, 'crop', params):
+            continue
+        ...write output_path...
+        manifest.record(output_path, input_path, h, 'crop', params)
+
+Requirements:
+  - Python 3.x
+"""
+
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+from circleCache import file_fingerprint
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+FULL_HASH_LIMIT = 64 << 20  # Files up to this size are hashed completely
+SAVE_EVERY = 50             # Records between two journal appends
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def content_hash(path):
+    """
+    SHA-1 of a file's content. Large files (videos) use the cheaper
+    size + first/last MB fingerprint of circleCache.file_fingerprint.
+    """
+    if os.path.isdir(path) or os.path.getsize(path) > FULL_HASH_LIMIT:
+        return file_fingerprint(path)
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock on the file at path (created if missing) between processes.
+    Released when the block ends or the process dies.
+    """
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def file_stat(path):
+    """
+    [size, mtime_ns] of a file, recorded with its hash to detect changes without reading it.
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def params_hash(params):
+    """
+    Stable hash of a JSON-serializable parameter set.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+# -------------------------------
+# Manifest
+# -------------------------------
+
+class Manifest:
+    """
+    Output artifact -> (input hash, stage, parameters) records with a journal
+    of new entries and atomic compaction.
+    """
+
+    def __init__(self, path, save_every=SAVE_EVERY):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.save_every = save_every
+        self.entries = {}
+        self.pending = []
+        self._inputs = None
+        self._journaled = False
+        if os.path.exists(path) or os.path.exists(self.journal_path):
+            try:
+                self.entries = self._read()
+            except (OSError, ValueError):
+                print(f"WARNING: Could not read manifest {path}, starting a new one")
+
+    def _read(self):
+        entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                entries = json.load(f)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        key, entry = json.loads(line)
+                    except ValueError:
+                        # Line cut off by a crash while appending
+                        continue
+                    entries[key] = entry
+        return entries
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/')
+
+    def known_hash(self, input_path, stat=None):
+        """
+        The hash recorded for input_path if its size and modification time
+        (stat, from file_stat) are unchanged, else None. Does not read the file.
+        """
+        if self._inputs is None:
+            self._inputs = {e['input']: (e['input_stat'], e['input_hash'])
+                            for e in self.entries.values() if e.get('input_stat')}
+        known = self._inputs.get(self._key(input_path))
+        if known is not None and known[0] == (stat or file_stat(input_path)):
+            return known[1]
+        return None
+
+    def input_hash(self, input_path):
+        """
+        content_hash of input_path, or the hash recorded for it while its size
+        and modification time are unchanged.
+        """
+        stat = file_stat(input_path)
+        h = self.known_hash(input_path, stat)
+        if h is None:
+            h = content_hash(input_path)
+            self._inputs[self._key(input_path)] = (stat, h)
+        return h
+
+    def recorded_hash(self, output_path, stage, params):
+        """
+        Input hash output_path was recorded with, if it exists and was produced
+        by this stage with these parameters, else None. Lets the input be
+        hashed later (e.g. by a worker) and compared.
+        """
+        entry = self.entries.get(self._key(output_path))
+        if (entry is None or entry['stage'] != stage or entry['params_hash'] != params_hash(params)
+                or not os.path.exists(output_path)):
+            return None
+        return entry['input_hash']
+
+    def is_up_to_date(self, output_path, input_hash, stage, params):
+        """
+        True if output_path exists and was produced from the same input, stage and parameters.
+        """
+        return input_hash is not None and self.recorded_hash(output_path, stage, params) == input_hash
+
+    def record(self, output_path, input_path, input_hash, stage, params, input_stat=None):
+        """
+        Remember that output_path was produced from input_path with these
+        parameters. input_stat (file_stat of the input when it was hashed)
+        defaults to the one seen by input_hash.
+        """
+        key = self._key(output_path)
+        input_key = self._key(input_path)
+        entry = {
+            'input': input_key,
+            'input_hash': input_hash,
+            'stage': stage,
+            'params_hash': params_hash(params),
+            'params': params,
+        }
+        if input_stat is not None:
+            if self._inputs is not None:
+                self._inputs[input_key] = (input_stat, input_hash)
+            entry['input_stat'] = input_stat
+        else:
+            # Only a stat seen together with this hash (from input_hash) may vouch for it later
+            known = self._inputs.get(input_key) if self._inputs else None
+            if known is not None and known[1] == input_hash:
+                entry['input_stat'] = known[0]
+        self.entries[key] = entry
+        self.pending.append(json.dumps([key, entry], default=str))
+        if len(self.pending) >= self.save_every:
+            self.save()
+
+    def save(self):
+        """
+        Append the entries recorded since the last save to the journal.
+        """
+        if not self.pending:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        data = ('\n'.join(self.pending) + '\n').encode()
+        with file_lock(self.path + '.lock'):
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        self.pending = []
+        self._journaled = True
+
+    def compact(self):
+        """
+        Merge the journal (entries of every process sharing the manifest) into
+        the JSON file and remove it.
+        """
+        with file_lock(self.path + '.lock'):
+            if not os.path.exists(self.journal_path):
+                return
+            try:
+                entries = self._read()
+            except (OSError, ValueError):
+                print(f"WARNING: Could not read manifest {self.path}, keeping its journal")
+                return
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f, indent=1, default=str)
+            os.replace(tmp_path, self.path)
+            os.remove(self.journal_path)
+        self.entries = entries
+
+    def close(self):
+        self.save()
+        if self._journaled:
+            self.compact()
+            self._journaled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
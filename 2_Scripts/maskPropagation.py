@@ -0,0 +1,249 @@
+"""
+Mask Propagation Between Keyframes
+
+Cheap substitute for running the segmentation model on every frame: masks of a
+keyframe are carried to the following frames by warping them along dense
+optical flow (Farneback, computed on a downscaled grayscale frame).
+
+All objects of a frame are kept in one label image (pixel value = object id),
+so a frame costs one flow computation and one cv2.remap, independent of the
+number of objects.
+
+A new keyframe is requested when
+  - KEYFRAME_STRIDE frames passed since the last keyframe, or
+  - the tracked masks degrade: an object vanished, its area drifted by more
+    than AREA_TOLERANCE from the keyframe, or the warped previous frame no
+    longer matches the current one inside the masks: the warp error grew to
+    WARP_ERROR_RATIO times the error of the first frame after the keyframe
+    (which absorbs the sensor noise of the video).
+
+mask_quality() compares propagated masks with a reference (e.g. full per-frame
+inference) as per-object IoU, so the accuracy cost of a keyframe setting is known.
+
+Usage:
+    propagator = MaskPropagator(stride=10)
+    propagator.set_keyframe(frame, labels)
+    for frame in frames:
+        labels, reason = propagator.step(frame)
+        if reason:
+            labels = segment(frame, propagator.prompt_points())
+            propagator.set_keyframe(frame, labels)
+
+Requirements:
+  - OpenCV
+  - NumPy
+  - Python 3.x
+"""
+
+import cv2
+import numpy as np
+from maskRLE import MaskStore
+
+KEYFRAME_STRIDE = 10          # Frames between two keyframes, at most
+AREA_TOLERANCE = 0.35         # Relative area change (vs. the keyframe) that counts as degraded
+WARP_ERROR_RATIO = 1.5        # Warp error growth (vs. the first frame after the keyframe) that counts as degraded
+FLOW_SCALE = 0.5              # Optical flow is computed at this fraction of the resolution
+FLOW_PARAMS = dict(pyr_scale=0.5, levels=3, winsize=9, iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def to_gray(frame):
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+def backward_flow(gray, prev_gray, scale=FLOW_SCALE):
+    """
+    Dense flow from the current frame to the previous one, at full resolution:
+    pixel (x, y) of the current frame came from (x, y) + flow[y, x] of the previous frame.
+    """
+    h, w = gray.shape
+    if scale != 1:
+        size = (max(int(w * scale), 1), max(int(h * scale), 1))
+        small, prev_small = cv2.resize(gray, size, interpolation=cv2.INTER_AREA), \
+            cv2.resize(prev_gray, size, interpolation=cv2.INTER_AREA)
+        flow = cv2.calcOpticalFlowFarneback(small, prev_small, None, **FLOW_PARAMS)
+        return cv2.resize(flow, (w, h), interpolation=cv2.INTER_LINEAR) / scale
+    return cv2.calcOpticalFlowFarneback(gray, prev_gray, None, **FLOW_PARAMS)
+
+def pixel_grid(shape):
+    h, w = shape[:2]
+    return np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+
+def remap_maps(flow, grid=None):
+    """
+    Absolute sampling maps for cv2.remap from a backward flow field.
+    """
+    grid_x, grid_y = grid if grid is not None else pixel_grid(flow.shape)
+    return grid_x + flow[..., 0], grid_y + flow[..., 1]
+
+def warp_labels(labels, map_x, map_y):
+    """
+    Warp a label image (nearest neighbour, so object ids stay intact).
+    """
+    return cv2.remap(labels, map_x, map_y, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+def object_areas(labels):
+    """
+    {object_id: pixel count} of a label image.
+    """
+    counts = np.bincount(labels.ravel())
+    return {int(i): int(c) for i, c in enumerate(counts) if i and c}
+
+def labels_to_masks(labels, object_ids):
+    """
+    (N, H, W) boolean masks in the order of object_ids.
+    """
+    return np.stack([labels == i for i in object_ids]) if len(object_ids) else np.zeros((0,) + labels.shape, bool)
+
+def masks_to_labels(masks, object_ids):
+    labels = np.zeros(masks.shape[1:], np.uint16)
+    for mask, obj_id in zip(masks, object_ids):
+        labels[mask] = obj_id
+    return labels
+
+def interior_point(mask):
+    """
+    Point deep inside a mask (maximum of the distance transform), so that it
+    lies on the worm even for bent bodies whose centroid is outside the mask.
+    """
+    dist = cv2.distanceTransform(mask.astype(np.uint8), cv2.DIST_L2, 3)
+    y, x = np.unravel_index(np.argmax(dist), dist.shape)
+    return [float(x), float(y)]
+
+# -------------------------------
+# Propagation
+# -------------------------------
+
+class MaskPropagator:
+    """
+    Carries the label image of the last keyframe from frame to frame along the
+    optical flow and decides when a new keyframe is needed.
+    """
+
+    def __init__(self, stride=KEYFRAME_STRIDE, area_tolerance=AREA_TOLERANCE,
+                 error_ratio=WARP_ERROR_RATIO, flow_scale=FLOW_SCALE):
+        self.stride = stride
+        self.area_tolerance = area_tolerance
+        self.error_ratio = error_ratio
+        self.flow_scale = flow_scale
+        self.labels = None
+        self.prev_gray = None
+        self.object_ids = []
+        self.key_areas = {}
+        self.last_points = {}
+        self.since_keyframe = 0
+        self.key_error = None
+        self._grid = None
+
+    def set_keyframe(self, frame, labels, object_ids=None):
+        """
+        Start propagating from a fully segmented frame. object_ids are the
+        objects that were prompted (default: those in labels); objects the model
+        missed keep being prompted with their last known point.
+        """
+        self.prev_gray = to_gray(frame)
+        self.labels = labels
+        self.key_areas = object_areas(labels)
+        self.object_ids = list(object_ids) if object_ids is not None else sorted(self.key_areas)
+        for obj_id in self.key_areas:
+            self.last_points[obj_id] = interior_point(labels == obj_id)
+        self.since_keyframe = 0
+        self.key_error = None
+
+    def degraded(self, areas, error):
+        """
+        Reason the tracked masks are no longer trustworthy, or ''.
+        """
+        for obj_id, key_area in self.key_areas.items():
+            area = areas.get(obj_id, 0)
+            if area == 0:
+                return 'lost'
+            if abs(area - key_area) > self.area_tolerance * key_area:
+                return 'area'
+        if self.key_error is None:
+            self.key_error = max(error, 1.0)
+        elif error > self.error_ratio * self.key_error:
+            return 'warp_error'
+        return ''
+
+    def step(self, frame):
+        """
+        Propagate the masks to the next frame. Returns (labels, reason) where
+        reason is '' or why this frame should become a keyframe
+        ('stride', 'lost', 'area' or 'warp_error').
+        """
+        gray = to_gray(frame)
+        flow = backward_flow(gray, self.prev_gray, self.flow_scale)
+        if self._grid is None or self._grid[0].shape != gray.shape:
+            self._grid = pixel_grid(gray.shape)
+        map_x, map_y = remap_maps(flow, self._grid)
+        labels = warp_labels(self.labels, map_x, map_y)
+
+        inside = labels > 0
+        error = 0.0
+        if inside.any():
+            warped_prev = cv2.remap(self.prev_gray, map_x, map_y, cv2.INTER_LINEAR)
+            error = float(cv2.absdiff(warped_prev, gray)[inside].mean())
+
+        self.labels, self.prev_gray = labels, gray
+        self.since_keyframe += 1
+        areas = object_areas(labels)
+        reason = self.degraded(areas, error)
+        if not reason and self.since_keyframe >= self.stride:
+            reason = 'stride'
+        return labels, reason
+
+    def prompt_points(self):
+        """
+        {object_id: [x, y]} prompt for every tracked object: an interior point
+        of its propagated mask, or its last known point if it was lost.
+        """
+        points = dict(self.last_points)
+        for obj_id in object_areas(self.labels):
+            points[obj_id] = interior_point(self.labels == obj_id)
+        return {i: points[i] for i in self.object_ids if i in points}
+
+# -------------------------------
+# Quality
+# -------------------------------
+
+def object_iou(reference, test):
+    """
+    {object_id: IoU} of two label images for the objects of the reference.
+    """
+    n = int(max(reference.max(), test.max())) + 1
+    # Joint histogram of (reference id, test id) pairs
+    joint = np.bincount(reference.ravel().astype(np.int64) * n + test.ravel(), minlength=n * n).reshape(n, n)
+    ious = {}
+    for obj_id in range(1, n):
+        ref_area = joint[obj_id].sum()
+        if ref_area == 0:
+            continue
+        intersection = joint[obj_id, obj_id]
+        union = ref_area + joint[:, obj_id].sum() - intersection
+        ious[obj_id] = float(intersection / union)
+    return ious
+
+def mask_quality(reference_path, test_path):
+    """
+    Compare the masks of two mask stores (maskRLE.py), e.g. full per-frame
+    inference against keyframe propagation. Returns a summary with the
+    mean / median / 10th percentile object IoU and the per-frame mean IoU.
+    """
+    reference_store, test_store = MaskStore(reference_path), MaskStore(test_path)
+    per_frame = {}
+    values = []
+    for frame_idx in reference_store.frames():
+        reference = reference_store.labels(frame_idx)
+        test = test_store.labels(frame_idx) if frame_idx in test_store else np.zeros_like(reference)
+        ious = list(object_iou(reference, test).values())
+        if ious:
+            per_frame[frame_idx] = float(np.mean(ious))
+            values.extend(ious)
+    if not values:
+        return {'frames': 0, 'objects': 0}
+    values = np.array(values)
+    return {'frames': len(per_frame), 'objects': int(values.size), 'mean_iou': float(values.mean()),
+            'median_iou': float(np.median(values)), 'p10_iou': float(np.percentile(values, 10)),
+            'per_frame': per_frame}
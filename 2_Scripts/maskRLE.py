@@ -0,0 +1,272 @@
+"""
+Run-Length-Encoded Mask Store
+
+Compact on-disk container for segmentation masks (SAM2 object masks,
+watershed masks). A mask store is a directory containing:
+  - meta.json     default frame shape, encoding and free-form attributes
+  - runs.bin      run lengths of all masks, appended back to back
+  - index.csv     one row per mask: frame_idx, object_id, byte offset, number of
+                  runs and bytes per run (2 or 4) in runs.bin, bounding box
+                  (x, y, w, h), area and frame height/width
+
+Each mask is cropped to its bounding box and the crop is run-length encoded in
+row-major order, starting with a run of zeros (like COCO RLE). Runs are stored
+as uint16 unless a mask has a run longer than 65535 pixels (then uint32). A worm
+that covers a few hundred pixels of a 1024 x 1024 frame takes a few hundred
+bytes instead of 1 MB as a dense uint8 mask.
+
+The writer appends masks as they are produced (runs first, then the index row),
+so a crash loses at most the frame being written; `keep` reopens an existing
+store and discards everything after the first `keep` index rows (resume).
+The reader memory-maps runs.bin, so any frame or object is decoded on its own.
+
+Usage:
+    with MaskWriter('C0098_sam2/masks', (1024, 1024)) as writer:
+        writer.append_labels(frame_idx, labels)              # uint16 label image
+        writer.append_masks(frame_idx, masks, object_ids)    # (N, H, W) bool masks
+        writer.append_mask(frame_idx, watershed_mask)        # single binary mask
+
+    store = MaskStore('C0098_sam2/masks')
+    labels = store.labels(10)
+    mask = store.mask(10, object_id=3)
+
+Requirements:
+  - NumPy
+  - Python 3.x
+"""
+
+import os
+import csv
+import json
+import numpy as np
+
+INDEX_FIELDS = ['frame_idx', 'object_id', 'offset', 'length', 'itemsize', 'x', 'y', 'w', 'h', 'area', 'height', 'width']
+
+# -------------------------------
+# Encoding
+# -------------------------------
+
+def rle_encode(mask):
+    """
+    Run lengths of a boolean mask in row-major order, starting with a zero run
+    (uint16 if every run fits, otherwise uint32).
+    """
+    flat = np.asarray(mask).ravel() != 0
+    if flat.size == 0:
+        return np.zeros(0, np.uint32)
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], change, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.uint16 if counts.max() <= 0xFFFF else np.uint32)
+
+def rle_decode(counts, shape):
+    """
+    Boolean mask of `shape` from run lengths produced by rle_encode.
+    """
+    values = np.zeros(len(counts), bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape(shape)
+
+def label_bboxes(labels):
+    """
+    Object ids of a label image and their bounding boxes as (ids, x, y, w, h) arrays.
+    """
+    ys, xs = np.nonzero(labels)
+    if ys.size == 0:
+        empty = np.zeros(0, np.int64)
+        return empty, empty, empty, empty, empty
+    ids = labels[ys, xs]
+    order = np.argsort(ids, kind='stable')
+    ids, xs, ys = ids[order], xs[order], ys[order]
+    unique, starts = np.unique(ids, return_index=True)
+    x0, x1 = np.minimum.reduceat(xs, starts), np.maximum.reduceat(xs, starts)
+    y0, y1 = np.minimum.reduceat(ys, starts), np.maximum.reduceat(ys, starts)
+    return unique, x0, y0, x1 - x0 + 1, y1 - y0 + 1
+
+def mask_bboxes(masks):
+    """
+    Bounding boxes (x, y, w, h) of a stack of (N, H, W) masks; empty masks get w = h = 0.
+    """
+    masks = np.asarray(masks, bool)
+    rows, cols = masks.any(axis=2), masks.any(axis=1)
+    empty = ~rows.any(axis=1)
+    y0 = rows.argmax(axis=1)
+    y1 = masks.shape[1] - rows[:, ::-1].argmax(axis=1)
+    x0 = cols.argmax(axis=1)
+    x1 = masks.shape[2] - cols[:, ::-1].argmax(axis=1)
+    w, h = np.where(empty, 0, x1 - x0), np.where(empty, 0, y1 - y0)
+    return x0, y0, w, h
+
+def encode_labels(labels):
+    """
+    [(object_id, (x, y, w, h), counts, area), ...] for every object of a label image.
+    """
+    encoded = []
+    for obj_id, x, y, w, h in zip(*label_bboxes(labels)):
+        crop = labels[y:y + h, x:x + w] == obj_id
+        encoded.append((int(obj_id), (int(x), int(y), int(w), int(h)), rle_encode(crop), int(crop.sum())))
+    return encoded
+
+def encode_masks(masks, object_ids):
+    """
+    [(object_id, (x, y, w, h), counts, area), ...] for the non-empty masks of a (N, H, W) stack.
+    """
+    encoded = []
+    for mask, obj_id, x, y, w, h in zip(masks, object_ids, *mask_bboxes(masks)):
+        if w == 0:
+            continue
+        crop = mask[y:y + h, x:x + w] != 0
+        encoded.append((int(obj_id), (int(x), int(y), int(w), int(h)), rle_encode(crop), int(crop.sum())))
+    return encoded
+
+# -------------------------------
+# Writer
+# -------------------------------
+
+def is_mask_store(path):
+    """
+    True if path is a mask store directory.
+    """
+    return os.path.isfile(os.path.join(path, 'meta.json')) and os.path.isfile(os.path.join(path, 'runs.bin'))
+
+class MaskWriter:
+    """
+    Streaming append writer for a mask store.
+    """
+
+    def __init__(self, path, frame_shape, keep=0, **attrs):
+        self.path = path
+        self.frame_shape = tuple(frame_shape[:2])
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'frame_shape': list(self.frame_shape), 'encoding': 'rle-uint32-bbox', 'attrs': attrs},
+                      f, indent=2)
+
+        # Keep the first `keep` masks of an earlier run and drop everything after them
+        rows = []
+        index_path = os.path.join(path, 'index.csv')
+        runs_path = os.path.join(path, 'runs.bin')
+        if keep and os.path.exists(index_path) and os.path.exists(runs_path):
+            with open(index_path, newline='') as f:
+                rows = [row for _, row in zip(range(keep), csv.DictReader(f))]
+        self.offset = int(rows[-1]['offset']) + int(rows[-1]['length']) * int(rows[-1]['itemsize']) if rows else 0
+        self.count = len(rows)
+
+        self.runs_file = open(runs_path, 'r+b' if rows else 'wb')
+        self.runs_file.truncate(self.offset)
+        self.runs_file.seek(self.offset)
+        self.index_file = open(index_path, 'w', newline='')
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(INDEX_FIELDS)
+        self.index_writer.writerows([[r[k] for k in INDEX_FIELDS] for r in rows])
+
+    def _write(self, frame_idx, encoded, shape):
+        height, width = shape[:2]
+        rows = []
+        for obj_id, (x, y, w, h), counts, area in encoded:
+            self.runs_file.write(counts.tobytes())
+            rows.append([frame_idx, obj_id, self.offset, len(counts), counts.itemsize, x, y, w, h, area, height, width])
+            self.offset += counts.nbytes
+        # Index rows only become visible once their runs are written
+        self.runs_file.flush()
+        self.index_writer.writerows(rows)
+        self.index_file.flush()
+        self.count += len(rows)
+        return len(rows)
+
+    def append_labels(self, frame_idx, labels):
+        """
+        Add every object of a label image (pixel value = object id). Returns the number of masks written.
+        """
+        return self._write(frame_idx, encode_labels(labels), labels.shape)
+
+    def append_masks(self, frame_idx, masks, object_ids):
+        """
+        Add a (N, H, W) stack of object masks. Returns the number of masks written.
+        """
+        return self._write(frame_idx, encode_masks(masks, object_ids), masks.shape[1:])
+
+    def append_mask(self, frame_idx, mask, object_id=1):
+        """
+        Add one binary mask (e.g. a watershed mask). Returns the number of masks written.
+        """
+        return self._write(frame_idx, encode_masks(mask[None], [object_id]), mask.shape)
+
+    def close(self):
+        self.runs_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# -------------------------------
+# Reader
+# -------------------------------
+
+class MaskStore:
+    """
+    Random-access reader for a mask store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.frame_shape = tuple(self.meta['frame_shape'])
+        self.attrs = self.meta.get('attrs', {})
+
+        self.frame_rows = {}
+        with open(os.path.join(path, 'index.csv'), newline='') as f:
+            for row in csv.DictReader(f):
+                row = {k: int(v) for k, v in row.items()}
+                self.frame_rows.setdefault(row['frame_idx'], []).append(row)
+        runs_path = os.path.join(path, 'runs.bin')
+        self.runs = np.memmap(runs_path, np.uint8, mode='r') if os.path.getsize(runs_path) else np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.frame_rows)
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self.frame_rows
+
+    def frames(self):
+        return sorted(self.frame_rows)
+
+    def objects(self, frame_idx):
+        """
+        Index rows (object_id, bbox, area, ...) of the masks of one frame.
+        """
+        return self.frame_rows.get(frame_idx, [])
+
+    def _crop(self, row):
+        dtype = np.uint16 if row['itemsize'] == 2 else np.uint32
+        counts = np.frombuffer(self.runs, dtype, row['length'], row['offset'])
+        return rle_decode(counts, (row['h'], row['w']))
+
+    def mask(self, frame_idx, object_id=1):
+        """
+        Full-frame boolean mask of one object (all False if it is not in the frame).
+        """
+        rows = self.objects(frame_idx)
+        shape = (rows[0]['height'], rows[0]['width']) if rows else self.frame_shape
+        mask = np.zeros(shape, bool)
+        for row in rows:
+            if row['object_id'] == object_id:
+                mask[row['y']:row['y'] + row['h'], row['x']:row['x'] + row['w']] |= self._crop(row)
+        return mask
+
+    def labels(self, frame_idx):
+        """
+        uint16 label image of one frame (pixel value = object id, 0 = none).
+        """
+        rows = self.objects(frame_idx)
+        shape = (rows[0]['height'], rows[0]['width']) if rows else self.frame_shape
+        labels = np.zeros(shape, np.uint16)
+        for row in rows:
+            window = labels[row['y']:row['y'] + row['h'], row['x']:row['x'] + row['w']]
+            window[self._crop(row)] = row['object_id']
+        return labels
@@ -0,0 +1,508 @@
+"""
+Patch Dataset Exporter
+
+Turns the points clicked in 3_FrameAnnotationTool into training data: a
+PATCH_SIZE x PATCH_SIZE patch is cut around every annotated point, plus
+BACKGROUND_PER_IMAGE randomly sampled background patches (label 0) per
+annotated image, so a training loader never decodes a JPEG again.
+
+A patch dataset is a directory (by convention <image_dir>.patches) containing:
+  - meta.json          patch shape, shard size, label names, split settings,
+                       patch counts per split and label
+  - shard_00000.npy    up to SHARD_SIZE patches as one (N, P, P[, C]) uint8 array
+  - index.csv          one row per patch: position, shard, offset, split, label,
+                       source image, x, y (patch centre in the image) and kind
+                       ('click' or 'sampled')
+
+  - Images are read and cut by WORKERS processes in chunks of CHUNK_SIZE
+    images; shards are written in image order, so the output does not
+    depend on the number of workers.
+  - Points are read from the annotation store (<image_dir>_annotations.db) or,
+    without one, from <image_dir>_clicked_points.csv.
+  - Background patches are only sampled in annotated images, at least
+    MIN_DISTANCE pixels from every annotated worm and mostly inside the well
+    (at most half of the patch masked black). The positions come from a
+    generator seeded with the image name, so reruns give the same patches.
+  - Splits are assigned per source image by a hash of SPLIT_SEED and the
+    image name (VAL_FRACTION of the images go to 'val'), so all patches of a
+    frame land in the same split and adding images never moves old ones.
+  - Patches near the image border are padded with black, like the masked
+    outside of the well.
+  - The dataset is skipped when it is up to date for the same points,
+    annotated image contents and parameters (see manifest.py).
+
+PatchDataset opens the shards with np.load(mmap_mode='r'): a batch is a
+fancy-indexed read from the page cache, with no decoding.
+
+Usage:
+    python patchExporter.py "NematodeAI/Data/C0105.MP4_processedFrames/C0105_cropped"
+    python patchExporter.py --benchmark
+
+    dataset = PatchDataset('C0105_cropped.patches')
+    for patches, labels in dataset.batches('train', batch_size=256, shuffle=True, seed=epoch):
+        ...
+
+Requirements:
+  - OpenCV
+  - NumPy
+  - Python 3.x
+"""
+
+import os
+import csv
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+import cv2
+import numpy as np
+from frameStore import FrameStore, is_frame_store
+from annotationStore import AnnotationStore, default_store_path
+from manifest import Manifest
+
+IMAGE_DIR = 'NematodeAI/Data/C0105.MP4_processedFrames/C0105_cropped'
+PATCH_SIZE = 128               # Side of a square patch in pixels
+GRAY = True                    # Single-channel patches (the preprocessed frames are gray)
+BACKGROUND_PER_IMAGE = 4       # Sampled label-0 patches per annotated image
+MIN_DISTANCE = 64              # Pixels between a sampled background patch and any annotated worm
+VAL_FRACTION = 0.2             # Share of the images in the validation split
+SPLIT_SEED = 0                 # Seed of the image -> split hash and of the background sampling
+SHARD_SIZE = 4096              # Patches per shard file
+WORKERS = os.cpu_count()       # Number of worker processes (1 = run in this process)
+CHUNK_SIZE = 16                # Images per work unit sent to a worker
+STAGE = 'patchExporter'        # Stage name recorded in the output manifest
+
+LABELS = {0: 'Background (B)', 1: 'Juvenile (J)', 2: 'Dauer Juvenile (DJ)', 3: 'Adult (A)'}
+INDEX_FIELDS = ['position', 'shard', 'offset', 'split', 'label', 'filename', 'x', 'y', 'kind']
+SAMPLE_ATTEMPTS = 50           # Random positions tried per background patch
+
+# -------------------------------
+# Helper Functions
+# -------------------------------
+
+def shard_path(path, shard):
+    return os.path.join(path, f"shard_{shard:05d}.npy")
+
+def default_output_path(image_dir):
+    return os.path.normpath(str(image_dir)).rstrip('/\\') + '.patches'
+
+def stable_hash(*parts):
+    """
+    64-bit hash of the parts that is the same in every process and run
+    (unlike hash(), which is salted per interpreter).
+    """
+    return int.from_bytes(hashlib.sha1(':'.join(str(p) for p in parts).encode()).digest()[:8], 'little')
+
+def split_of(filename, val_fraction=VAL_FRACTION, seed=SPLIT_SEED):
+    """
+    'train' or 'val' for a source image, from a hash of its name.
+    """
+    return 'val' if stable_hash(seed, filename) / 2.0 ** 64 < val_fraction else 'train'
+
+def source_hashes(image_dir, filenames, manifest):
+    """
+    {filename: content hash} of the annotated images (None if missing), or of
+    every file of the input frame store, so re-preprocessed frames (new crop,
+    CLAHE, ...) under the same names invalidate the dataset. Unchanged files
+    are not read again (see Manifest.input_hash).
+    """
+    if is_frame_store(image_dir):
+        # Sidecars such as the circle cache (.circle.json) are not frame data
+        filenames = sorted(f for f in os.listdir(image_dir) if not f.startswith('.'))
+    paths = {f: os.path.join(image_dir, f) for f in filenames}
+    return {f: manifest.input_hash(p) if os.path.isfile(p) else None for f, p in paths.items()}
+
+def load_points(image_dir):
+    """
+    {filename: [(label, x, y), ...]} of the annotation store or, without one,
+    of the annotation tool's CSV. Empty if neither exists.
+    """
+    points = {}
+    db_path = default_store_path(image_dir)
+    csv_path = os.path.normpath(str(image_dir)).rstrip('/\\') + '_clicked_points.csv'
+    if os.path.exists(db_path):
+        with AnnotationStore(db_path) as store:
+            rows = store.points()
+    elif os.path.exists(csv_path):
+        with open(csv_path, newline='') as f:
+            reader = csv.DictReader(f)
+            label_field = 'label' if 'label' in reader.fieldnames else 'class'
+            rows = [(r['filename'], r[label_field], r['x'], r['y']) for r in reader]
+    else:
+        return points
+    for filename, label, x, y in rows:
+        points.setdefault(filename, []).append((int(label), float(x), float(y)))
+    return points
+
+def extract_patch(img, x, y, size):
+    """
+    size x size patch of img centred on (x, y), padded with black where it
+    leaves the image. Returns a new array.
+    """
+    h, w = img.shape[:2]
+    x0, y0 = int(round(x)) - size // 2, int(round(y)) - size // 2
+    x1, y1 = x0 + size, y0 + size
+    patch = img[max(y0, 0):min(y1, h), max(x0, 0):min(x1, w)]
+    if patch.shape[:2] == (size, size):
+        return patch.copy()
+    return cv2.copyMakeBorder(patch, max(-y0, 0), max(y1 - h, 0), max(-x0, 0), max(x1 - w, 0),
+                              cv2.BORDER_CONSTANT, value=0)
+
+def sample_background(img, filename, worms, n, size=PATCH_SIZE, min_distance=MIN_DISTANCE, seed=SPLIT_SEED):
+    """
+    Up to n (x, y) patch centres away from the annotated worms (an (N, 2)
+    array) and mostly inside the well. Deterministic per image name.
+    """
+    rng = np.random.default_rng(stable_hash(seed, 'background', filename))
+    h, w = img.shape[:2]
+    if h < size or w < size:
+        return []
+    candidates = rng.uniform((size / 2, size / 2), (w - size / 2, h - size / 2), (n * SAMPLE_ATTEMPTS, 2))
+    centres = []
+    for x, y in candidates:
+        if len(centres) == n:
+            break
+        if len(worms) and np.min(np.hypot(worms[:, 0] - x, worms[:, 1] - y)) < min_distance:
+            continue
+        if any(np.hypot(cx - x, cy - y) < min_distance for cx, cy in centres):
+            continue
+        x0, y0 = int(round(x)) - size // 2, int(round(y)) - size // 2
+        window = img[y0:y0 + size, x0:x0 + size]
+        if cv2.countNonZero(window.max(axis=2) if window.ndim == 3 else window) < size * size // 2:
+            # Mostly the black outside of the masked well
+            continue
+        centres.append((float(x), float(y)))
+    return centres
+
+# -------------------------------
+# Patch Extraction
+# -------------------------------
+
+_store = None  # Per-process input frame store, if the input is a store
+
+def init_worker(image_dir):
+    """
+    Pool initializer: open the input frame store once per worker.
+    """
+    global _store
+    _store = FrameStore(image_dir) if is_frame_store(image_dir) else None
+
+def load_image(image_dir, filename, gray):
+    """
+    Annotated image by name from a folder or frame store, or None.
+    """
+    if _store is not None:
+        img = _store.get(filename)
+        if img is None:
+            return None
+        img = np.asarray(img)
+        if gray and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+    return cv2.imread(os.path.join(image_dir, filename), cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR)
+
+def process_image(image_dir, filename, points, params):
+    """
+    Patches of one image: (message, rows, patches) with rows (label, x, y,
+    kind) in the order of the stacked patches; message is None on success.
+    """
+    try:
+        img = load_image(image_dir, filename, params['gray'])
+        if img is None:
+            return f"Error reading image: {filename}", [], None
+        size = params['patch_size']
+        rows = [(label, x, y, 'click') for label, x, y in points]
+        worms = np.array([(x, y) for label, x, y in points if label != 0], np.float64).reshape(-1, 2)
+        rows += [(0, x, y, 'sampled') for x, y in sample_background(
+            img, filename, worms, params['background_per_image'], size, params['min_distance'], params['seed'])]
+        patches = np.stack([extract_patch(img, x, y, size) for _, x, y, _ in rows]) if rows else None
+        return None, rows, patches
+    except Exception as e:
+        return f"Error processing {filename}: {str(e)}", [], None
+
+def process_chunk(args):
+    """
+    Worker entry point: cut the patches of a chunk of images. Returns a list
+    of (filename, message, rows, patches).
+    """
+    image_dir, items, params = args
+    return [(filename,) + process_image(image_dir, filename, points, params) for filename, points in items]
+
+# -------------------------------
+# Writer
+# -------------------------------
+
+class PatchWriter:
+    """
+    Appends patches to sharded .npy arrays with their index rows.
+    """
+
+    def __init__(self, path, patch_shape, shard_size=SHARD_SIZE, **attrs):
+        self.path = path
+        self.patch_shape = tuple(patch_shape)
+        self.shard_size = shard_size
+        os.makedirs(path, exist_ok=True)
+        for old in os.listdir(path):
+            if old.startswith('shard_'):
+                os.remove(os.path.join(path, old))
+        self.attrs = attrs
+        self.buffer = np.empty((shard_size,) + self.patch_shape, np.uint8)
+        self.rows = []
+        self.shard = 0
+        self.count = 0
+        self.counts = {}
+        self.index_file = open(os.path.join(path, 'index.csv'), 'w', newline='')
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(INDEX_FIELDS)
+
+    def append(self, patches, rows, filename, split):
+        """
+        Add the patches of one image (rows: label, x, y, kind per patch).
+        """
+        for patch, (label, x, y, kind) in zip(patches, rows):
+            offset = len(self.rows)
+            self.buffer[offset] = patch
+            self.rows.append([self.count, self.shard, offset, split, label, filename, f"{x:.2f}", f"{y:.2f}", kind])
+            key = f"{split}/{label}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.count += 1
+            if len(self.rows) == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered patches as a shard file and their index rows.
+        """
+        if not self.rows:
+            return
+        final_path = shard_path(self.path, self.shard)
+        tmp_path = final_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.buffer[:len(self.rows)])
+        os.replace(tmp_path, final_path)
+        # Index rows only become visible once their shard is on disk
+        self.index_writer.writerows(self.rows)
+        self.index_file.flush()
+        self.rows = []
+        self.shard += 1
+
+    def close(self):
+        self.flush()
+        self.index_file.close()
+        meta = {'patch_shape': list(self.patch_shape), 'dtype': 'uint8', 'shard_size': self.shard_size,
+                'count': self.count, 'counts': self.counts, 'labels': LABELS, 'attrs': self.attrs}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def export_patches(image_dir, output_path=None, patch_size=PATCH_SIZE, gray=GRAY,
+                   background_per_image=BACKGROUND_PER_IMAGE, min_distance=MIN_DISTANCE,
+                   val_fraction=VAL_FRACTION, seed=SPLIT_SEED, shard_size=SHARD_SIZE,
+                   workers=WORKERS, chunk_size=CHUNK_SIZE):
+    """
+    Cut the patches of every annotated image of image_dir (an image folder
+    or a frame store) into a patch dataset (default <image_dir>.patches).
+    Returns the number of patches, or None if the dataset was up to date.
+    """
+    output_path = output_path or default_output_path(image_dir)
+    points = load_points(image_dir)
+    if not points:
+        print(f"No annotations found for {image_dir}")
+        return 0
+
+    params = {'patch_size': patch_size, 'gray': gray, 'background_per_image': background_per_image,
+              'min_distance': min_distance, 'val_fraction': val_fraction, 'seed': seed}
+    manifest = Manifest(os.path.join(os.path.dirname(os.path.abspath(output_path)), '.manifest.json'))
+    # The dataset depends on the clicked points and on the pixels of the annotated images
+    sources = source_hashes(image_dir, points, manifest)
+    points_hash = hashlib.sha1(json.dumps([sorted(points.items()), sorted(sources.items())]).encode()).hexdigest()
+    if manifest.is_up_to_date(output_path, points_hash, STAGE, params):
+        print(f"Up to date, skipping: {output_path}")
+        manifest.close()
+        return None
+
+    items = sorted(points.items())
+    chunks = [(image_dir, items[i:i + chunk_size], params) for i in range(0, len(items), chunk_size)]
+    workers = max(1, min(workers or 1, len(chunks)))
+    print(f"Cutting patches of {len(items)} annotated images with {workers} worker(s)")
+
+    patch_shape = (patch_size, patch_size) if gray else (patch_size, patch_size, 3)
+    failed = 0
+    done = 0
+    start = time.perf_counter()
+    writer = PatchWriter(output_path, patch_shape, shard_size, source=str(image_dir), **params)
+
+    def report(results):
+        nonlocal failed, done
+        for filename, message, rows, patches in results:
+            done += 1
+            if message:
+                failed += 1
+                print(message)
+            elif rows:
+                writer.append(patches, rows, filename, split_of(filename, val_fraction, seed))
+        elapsed = time.perf_counter() - start
+        print(f"Processed {done}/{len(items)} images, {writer.count} patches ({done / elapsed:.1f} images/sec)")
+
+    try:
+        init_worker(image_dir)
+        if workers == 1:
+            for chunk in chunks:
+                report(process_chunk(chunk))
+        else:
+            with multiprocessing.Pool(workers, initializer=init_worker, initargs=(image_dir,)) as pool:
+                # Ordered results: the shards do not depend on scheduling
+                for results in pool.imap(process_chunk, chunks):
+                    report(results)
+    finally:
+        writer.close()
+
+    if failed == 0:
+        manifest.record(output_path, str(image_dir), points_hash, STAGE, params)
+    manifest.close()
+    elapsed = time.perf_counter() - start
+    print(f"Saved {writer.count} patches ({writer.counts}) to {output_path} in {elapsed:.1f} s, {failed} images failed")
+    return writer.count
+
+# -------------------------------
+# Reader
+# -------------------------------
+
+class PatchDataset:
+    """
+    Random-access reader for a patch dataset.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.patch_shape = tuple(self.meta['patch_shape'])
+        with open(os.path.join(path, 'index.csv'), newline='') as f:
+            self.index = list(csv.DictReader(f))
+        self.shards = np.array([int(r['shard']) for r in self.index], np.int64)
+        self.offsets = np.array([int(r['offset']) for r in self.index], np.int64)
+        self.labels = np.array([int(r['label']) for r in self.index], np.int64)
+        self.splits = np.array([r['split'] for r in self.index])
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard):
+        data = self._shards.get(shard)
+        if data is None:
+            data = self._shards[shard] = np.load(shard_path(self.path, shard), mmap_mode='r')
+        return data
+
+    def __getitem__(self, position):
+        """
+        (patch, label) at `position` (the patch is a read-only view).
+        """
+        return self._shard(self.shards[position])[self.offsets[position]], int(self.labels[position])
+
+    def positions(self, split=None, labels=None):
+        """
+        Positions of the patches of a split and/or of some labels.
+        """
+        keep = np.ones(len(self), bool)
+        if split is not None:
+            keep &= self.splits == split
+        if labels is not None:
+            keep &= np.isin(self.labels, list(labels))
+        return np.flatnonzero(keep)
+
+    def batch(self, positions):
+        """
+        (patches, labels) of the given positions, in that order, read shard
+        by shard with sorted offsets.
+        """
+        positions = np.asarray(positions, np.int64)
+        patches = np.empty((len(positions),) + self.patch_shape, np.uint8)
+        for shard in np.unique(self.shards[positions]):
+            where = np.flatnonzero(self.shards[positions] == shard)
+            order = np.argsort(self.offsets[positions[where]], kind='stable')
+            patches[where[order]] = self._shard(shard)[self.offsets[positions[where[order]]]]
+        return patches, self.labels[positions]
+
+    def batches(self, split=None, batch_size=256, shuffle=False, seed=0, labels=None):
+        """
+        Generator yielding (patches, labels) batches of a split, in a
+        permutation seeded by `seed` (e.g. the epoch) if shuffle=True.
+        """
+        positions = self.positions(split, labels)
+        if shuffle:
+            positions = np.random.default_rng(seed).permutation(positions)
+        for i in range(0, len(positions), batch_size):
+            yield self.batch(positions[i:i + batch_size])
+
+# -------------------------------
+# Benchmark
+# -------------------------------
+
+def benchmark(n_images=40, n_worms=30, size=1024, batch_size=256):
+    """
+    Export patches of synthetic JPEG frames annotated at the true worm
+    positions, then compare one training epoch read from the patch dataset
+    with decoding the JPEGs (once per image) and cutting the same patches.
+    """
+    from benchmark import synthetic_frames
+
+    with tempfile.TemporaryDirectory() as workdir:
+        image_dir = os.path.join(workdir, 'synthetic_cropped')
+        os.makedirs(image_dir)
+        with AnnotationStore(default_store_path(image_dir)) as store:
+            for idx, (frame, positions) in enumerate(synthetic_frames(n_images, (size, size), n_worms)):
+                filename = f"synthetic_frame_{idx}.jpg"
+                cv2.imwrite(os.path.join(image_dir, filename), frame)
+                store.add_many((filename, 1 + i % 3, x, y) for i, (x, y) in enumerate(positions))
+
+        export_patches(image_dir)
+        dataset = PatchDataset(default_output_path(image_dir))
+        print(f"{len(dataset)} patches: {dataset.meta['counts']}")
+
+        start = time.perf_counter()
+        seen = sum(len(labels) for _, labels in dataset.batches('train', batch_size, shuffle=True))
+        mmap_time = time.perf_counter() - start
+
+        # Without the dataset: decode every annotated image once per epoch and cut its patches
+        rows = [r for r in dataset.index if r['split'] == 'train']
+        by_image = {}
+        for r in rows:
+            by_image.setdefault(r['filename'], []).append((float(r['x']), float(r['y'])))
+        start = time.perf_counter()
+        for filename, centres in by_image.items():
+            img = cv2.imread(os.path.join(image_dir, filename), cv2.IMREAD_GRAYSCALE)
+            for x, y in centres:
+                extract_patch(img, x, y, PATCH_SIZE)
+        decode_time = time.perf_counter() - start
+
+        print(f"Patch dataset epoch: {seen} patches in {mmap_time:.3f} s ({seen / mmap_time:.0f} patches/sec)")
+        print(f"Decode JPEG + cut:   {len(rows)} patches in {decode_time:.3f} s ({len(rows) / decode_time:.0f} patches/sec)")
+        return {'patches': seen, 'mmap_per_sec': seen / mmap_time, 'decode_per_sec': len(rows) / decode_time}
+
+def main():
+    parser = argparse.ArgumentParser(description='Export annotated patches as a sharded, memory-mapped dataset.')
+    parser.add_argument('image_dir', nargs='?', default=IMAGE_DIR, help='annotated image folder or frame store')
+    parser.add_argument('--output', help='patch dataset to write (default: <image_dir>.patches)')
+    parser.add_argument('--patch-size', type=int, default=PATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--benchmark', action='store_true', help='export and read synthetic annotated frames')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark()
+        return
+    if not os.path.exists(args.image_dir):
+        print(f"Error: Directory not found: {args.image_dir}")
+        return
+    export_patches(args.image_dir, args.output, args.patch_size, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
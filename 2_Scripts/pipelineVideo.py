@@ -1,6 +1,23 @@
 import os
 import cv2
 import numpy as np
+from framePipeline import run_pipeline, QUEUE_SIZE
+from preprocessContext import get_context
+from frameSampler import open_gray_video
+from counting import Counter, CountWriter
+from asyncWriter import AsyncVideoWriter
+from ffmpegSource import FFmpegSource, ffmpeg_available, roi_crop
+import instrumentation as inst
+
+VIDEO_PATH = 'NematodeAI/Preprocessing/C0098.MP4'
+OUTPUT_SIZE = (1024, 1024)  # Dimensions of the output video
+WORKERS = 4                 # Processing threads between decoder and writer
+PROFILE = False             # Write a per-stage timing report (<output>_run_report.json/.prom)
+COUNT = False               # Count worms in every output frame (<output>_counts/, see counting.py)
+TOLERANCE = 10              # Pixels added to the well radius when cropping
+GRAY = False                # Single-channel output; frames are decoded to gray where the backend allows
+BACKEND = 'opencv'          # 'ffmpeg' = crop, resize and gray inside an ffmpeg decoder (see ffmpegSource.py)
+CIRCLE_PARAMS = {'param1': 40, 'param2': 20, 'minRadius': 990, 'maxRadius': 1030}  # Hough parameters of the well
 
 # -------------------------------
 # Helper Functions
@@ -8,9 +25,9 @@ import numpy as np
 
 def watershed(img):
     """
-    Apply watershed algorithm to an image.
+    Apply watershed algorithm to an image (BGR or grayscale).
     """
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
     ret, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     # noise removal
     kernel = np.ones((3, 3), np.uint8)
@@ -53,65 +70,177 @@ def clahe(img):
     img = clahe.apply(gray)
     return img
 
-def main():
-    video_path = 'NematodeAI/Preprocessing/C0098.MP4'
-    cap = cv2.VideoCapture(video_path)
-    
+def process_frame(item, output_size=OUTPUT_SIZE, counter=None, gray=False, prescaled=False):
+    """
+    Crop, mask and resize one frame. `item` is (frame, (x, y, r)).
+    Everything after the crop only touches the well ROI; with gray=True it is
+    single-channel (a BGR frame is converted after cropping, not before).
+    prescaled=True is for frames the ffmpeg backend already cropped and
+    resized: they are only masked (into a new array, the decoder reuses its
+    buffers). With a counting.Counter, returns (resized, count result) instead.
+    """
+    frame, (x, y, r) = item
+    # Thread-local mask cache and buffer; only the resized result leaves the worker
+    ctx = get_context()
+    if prescaled:
+        with inst.stage('mask'):
+            r_out = int(round(r * output_size[0] / (2 * (r + TOLERANCE))))
+            channels = frame.shape[2] if frame.ndim == 3 else 1
+            resized = cv2.bitwise_and(frame, ctx.mask(frame.shape, r_out, channels))
+    else:
+        with inst.stage('crop'):
+            cropped_img = crop_image(frame, x, y, r, TOLERANCE)
+        if gray and cropped_img.ndim == 3:
+            with inst.stage('gray'):
+                cropped_img = ctx.to_gray(cropped_img)
+        with inst.stage('mask_resize'):
+            resized = ctx.resize_masked(cropped_img, r, output_size)
+    if counter is None:
+        return resized
+    with inst.stage('count'):
+        # Well radius in output pixels
+        result = counter.count(resized, int(r * output_size[0] / (2 * (r + TOLERANCE))))
+    return resized, result
+
+def default_output_path(video_path):
+    """
+    <dir with 'Preprocessing' replaced by 'Processed'>/<name>_cropped.mp4
+    """
+    output_dir = os.path.dirname(video_path).replace('Preprocessing', 'Processed')
+    return os.path.join(output_dir, os.path.basename(video_path).replace('.MP4', '_cropped.mp4'))
+
+def process_video(video_path, output_path=None, output_size=OUTPUT_SIZE, workers=WORKERS, count=COUNT, gray=GRAY,
+                  backend=BACKEND, circle_params=None):
+    """
+    Crop and mask every frame of a video to the detected well and write it as a
+    output_size video. Decoding, processing and encoding run as overlapping
+    pipeline stages (see framePipeline.run_pipeline). With count=True the worms
+    of every frame are counted and written to <output>_counts/. With gray=True
+    frames are decoded to gray (see frameSampler.open_gray_video) and the
+    output video is single-channel. The output keeps the source frame rate, with
+    the frame timestamps in <output>_timestamps.csv. With backend='ffmpeg' the frames after the
+    first are decoded, cropped to the well and resized by ffmpeg (the well is
+    then not re-checked for drift); it falls back to OpenCV if ffmpeg is
+    missing, cannot decode the video or the well crop leaves the frame.
+    circle_params overrides the Hough parameters of the well detection
+    (default CIRCLE_PARAMS, radii of the 2560x2160 recordings).
+    Returns the output path, or None if no frame was written or ffmpeg failed
+    during the video.
+    """
+    from circleCache import CircleRegistry
+
+    if gray:
+        # BGR frames are converted in process_frame, after cropping to the well
+        cap, to_gray = open_gray_video(video_path, convert=False)
+        if cap is None:
+            return None
+    else:
+        cap, to_gray = cv2.VideoCapture(video_path), None
+
+    def read():
+        ret, frame = cap.read()
+        if ret and to_gray is not None:
+            frame = to_gray(frame)
+        return ret, frame
+
     # Read first frame and detect circle
-    ret, first_frame = cap.read()
+    ret, first_frame = read()
     if not ret:
-        return
+        cap.release()
+        return None
 
-    # Apply watershed algorithm
-    watershed_img = watershed(first_frame)
-    # Apply Hough Circle Transform
-    circles = houghCircle(watershed_img, 40, 20, 990, 1030)
-    if circles is not None:
+    # Detect the well (cached per video) and re-check it periodically for drift
+    registry = CircleRegistry(video_path, params=circle_params or CIRCLE_PARAMS)
+    circle = registry.get(first_frame)
+    if circle is not None:
         print("circle detected")
-        circles = np.uint16(np.around(circles))
-        max_circle = max(circles[0, :], key=lambda x: x[2])
-        x, y, r = max_circle
     else:
         print("No circle detected")
-        return
+        cap.release()
+        return None
+
+    source = None
+    if backend == 'ffmpeg':
+        crop = roi_crop(circle, TOLERANCE, first_frame.shape[1], first_frame.shape[0])
+        if crop is None or not ffmpeg_available():
+            print("ffmpeg backend unavailable for this video, decoding with OpenCV")
+        else:
+            # Enough ring buffers for every frame the pipeline can hold at once
+            source = FFmpegSource(video_path, crop, output_size, gray,
+                                  buffers=2 * QUEUE_SIZE + workers + 2)
+            if source.isOpened():
+                cap.release()
+            else:
+                # cap has only read the first frame, so OpenCV continues from there
+                print("ffmpeg could not decode the video, decoding with OpenCV")
+                source = None
 
-    # Get dimensions for output video (1024x1024)
-    output_size = (1024, 1024)
-    
     # Create output directory if it doesn't exist
-    output_dir = os.path.dirname(video_path).replace('Preprocessing', 'Processed')
-    os.makedirs(output_dir, exist_ok=True)
+    output_path = output_path or default_output_path(video_path)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
     
-    # Set output path
-    output_path = os.path.join(output_dir, os.path.basename(video_path).replace('.MP4', '_cropped.mp4'))
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, 20.0, output_size)
-
-    # Process first frame
-    cropped_img = crop_image(first_frame, x, y, r, 10)
-    masked_image = mask_image(cropped_img, r)
-    resized_image = cv2.resize(masked_image, output_size)
-    out.write(resized_image)
-
-    # Process remaining frames
+    # Keep the source frame rate; encoding runs on its own thread (see asyncWriter.py)
+    fps = (source or cap).get(cv2.CAP_PROP_FPS) or 20.0
+    out = AsyncVideoWriter(output_path, fps, output_size, not gray)
+    # Counter is stateless apart from its cached well mask, so it is shared by the workers
+    counter = Counter() if count else None
+    counts = CountWriter(os.path.splitext(output_path)[0] + '_counts', source=video_path) if count else None
+
+    def frames():
+        if source is not None:
+            for _, _, frame in source:
+                yield frame, circle
+            return
+        # Runs on the decoder thread; the registry is only touched from here
+        yield first_frame, circle
+        while cap.isOpened():
+            with inst.stage('decode'):
+                ret, frame = read()
+            if not ret:
+                break
+            yield frame, registry.get(frame)
+
     frame_count = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
 
-        cropped_img = crop_image(frame, x, y, r, 10)
-        masked_image = mask_image(cropped_img, r)
-        resized_image = cv2.resize(masked_image, output_size)
-        out.write(resized_image)
+    def write(result):
+        nonlocal frame_count
+        if counts is not None:
+            resized_image, frame_counts = result
+            counts.append(frame_count, frame_count / fps, frame_counts)
+        else:
+            resized_image = result
+        out.write(resized_image, frame_count / fps)
         frame_count += 1
         if frame_count % 100 == 0:
             print(f"Processed {frame_count} frames")
 
+    try:
+        run_pipeline(frames(), lambda item: process_frame(item, output_size, counter, gray, source is not None),
+                     write, workers=workers)
+    finally:
+        cap.release()
+        if source is not None:
+            source.release()
+        out.close()
+        if counts is not None:
+            counts.close()
+
+    if frame_count == 0:
+        print(f"Error: No frames written to {output_path}")
+        return None
+    if source is not None and source.failed:
+        print(f"Error: ffmpeg stopped after {frame_count} frames, {output_path} is incomplete")
+        return None
     print(f"Finished processing {frame_count} frames")
     print(f"Saved video to: {output_path}")
-    cap.release()
-    out.release()
+    report_path = os.path.splitext(output_path)[0] + '_run_report'
+    inst.write_report(report_path + '.json', prometheus_path=report_path + '.prom')
+    return output_path
+
+def main():
+    if PROFILE:
+        inst.enable('pipelineVideo')
+    process_video(VIDEO_PATH)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,166 @@
+"""
+Preprocessing Context
+
+Reusable state for the crop -> mask -> CLAHE hot path, so the per-frame loop
+does no large allocations once it reaches steady state:
+  - circular masks are memoized by (shape, radius)
+  - CLAHE objects are kept by (clipLimit, tileGridSize)
+  - grayscale / masked / enhanced images are written into preallocated buffers
+  - resize_masked() fuses mask and resize: the well is masked at the output
+    resolution, so only output pixels are touched instead of every ROI pixel
+
+Arrays returned by a context are overwritten by its next call. Write or copy
+them before processing the next frame, and use one context per thread
+(get_context() returns a thread-local one).
+
+Running this file prints the memory allocated per frame and the fps of the
+old helper functions against the context:
+    python preprocessContext.py
+
+Requirements:
+  - OpenCV
+  - NumPy
+"""
+
+import time
+import threading
+import tracemalloc
+import cv2
+import numpy as np
+
+# -------------------------------
+# Preprocessing Context
+# -------------------------------
+
+class PreprocessContext:
+    """
+    Caches masks, CLAHE objects and output buffers between frames.
+    """
+
+    def __init__(self, clip_limit=2.0, tile_grid=(8, 8)):
+        self.clip_limit = clip_limit
+        self.tile_grid = tuple(tile_grid)
+        self._masks = {}
+        self._clahes = {}
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        """
+        Preallocated array for `name`, reallocated only when shape or dtype change.
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self._buffers[name] = buf
+        return buf
+
+    def mask(self, shape, r, channels=1):
+        """
+        Circular mask of radius r centred in an image of `shape` (single-channel,
+        or with `channels` channels for use as a bitwise_and operand).
+        """
+        key = (tuple(shape[:2]), int(r), channels)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = np.zeros(shape[:2], np.uint8)
+            cv2.circle(mask, (mask.shape[1]//2, mask.shape[0]//2), int(r), 255, -1)
+            if channels > 1:
+                mask = cv2.merge([mask] * channels)
+            self._masks[key] = mask
+        return mask
+
+    def clahe(self, clip_limit=None, tile_grid=None):
+        """
+        Shared CLAHE object for (clipLimit, tileGridSize).
+        """
+        key = (clip_limit or self.clip_limit, tuple(tile_grid or self.tile_grid))
+        clahe = self._clahes.get(key)
+        if clahe is None:
+            clahe = cv2.createCLAHE(clipLimit=key[0], tileGridSize=key[1])
+            self._clahes[key] = clahe
+        return clahe
+
+    def mask_image(self, img, r, out='masked'):
+        """
+        Apply the circular mask to an image (1 or 3 channels) into a reused buffer.
+        """
+        dst = self.buffer(out, img.shape, img.dtype)
+        dst[...] = 0
+        return cv2.bitwise_and(img, img, dst=dst, mask=self.mask(img.shape, r))
+
+    def resize_masked(self, img, r, size):
+        """
+        Resize a cropped well image to `size` and mask it in one pass over the
+        output: the circle of radius r (in img pixels) is applied at the output
+        resolution. Returns a new array, so it may be handed to another thread.
+        """
+        resized = cv2.resize(img, size)
+        r_out = int(round(r * size[0] / img.shape[1]))
+        channels = resized.shape[2] if resized.ndim == 3 else 1
+        return cv2.bitwise_and(resized, self.mask(resized.shape, r_out, channels), dst=resized)
+
+    def to_gray(self, img, out='gray'):
+        """
+        Grayscale version of img in a reused buffer (single-channel input is returned as is).
+        """
+        if img.ndim == 2:
+            return img
+        dst = self.buffer(out, img.shape[:2])
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=dst)
+
+    def apply_clahe(self, img, out='clahe'):
+        """
+        Contrast Limited Adaptive Histogram Equalization into a reused buffer.
+        """
+        gray = self.to_gray(img)
+        dst = self.buffer(out, gray.shape)
+        return self.clahe().apply(gray, dst=dst)
+
+_local = threading.local()
+
+def get_context():
+    """
+    Thread-local default PreprocessContext.
+    """
+    ctx = getattr(_local, 'context', None)
+    if ctx is None:
+        ctx = _local.context = PreprocessContext()
+    return ctx
+
+# -------------------------------
+# Allocation / Speed Report
+# -------------------------------
+
+def report(frames=50, shape=(2160, 2560, 3), r=1000, tolerance=10):
+    from pipelineVideo import crop_image, mask_image, clahe
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, shape, dtype=np.uint8)
+    x, y = shape[1] // 2, shape[0] // 2
+    ctx = PreprocessContext()
+
+    def old(img):
+        return clahe(mask_image(crop_image(img, x, y, r, tolerance), r))
+
+    def new(img):
+        return ctx.apply_clahe(ctx.mask_image(crop_image(img, x, y, r, tolerance), r))
+
+    assert np.array_equal(old(frame), new(frame))
+
+    print(f"{'path':<10}{'fps':>8}{'allocated MB/frame':>20}")
+    for name, fn in (('old', old), ('context', new)):
+        fn(frame)  # warm up caches
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        fn(frame)
+        allocated = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            fn(frame)
+        fps = frames / (time.perf_counter() - start)
+        print(f"{name:<10}{fps:>8.1f}{allocated / 1e6:>20.2f}")
+
+if __name__ == "__main__":
+    report()
@@ -1,31 +1,428 @@
+"""
+Chunked SAM2 Video Segmentation
+
+Segments the nematodes of a cropped video (pipelineVideo.py output) with the
+SAM2 video predictor, prompted by the points of the annotation tool.
+
+Instead of handing every clicked point of every frame to one predictor call
+for the whole video, the prompts are routed to the frame they were clicked on
+and the video is processed in temporal chunks:
+  1. Points are grouped by frame (annotation filenames carry the source frame
+     index, '<video>_frame_<idx>.jpg') and by object: every point of the
+     OBJECT_LABELS is one object, background points (label 0) are added to each
+     object of that frame as negative points. Points are scaled from the
+     annotated crop to the video resolution.
+  2. The video is cut into chunks of at most CHUNK_FRAMES frames that start at
+     an annotated frame, so the prompts always land on the first frame of a
+     chunk. A chunk without new annotations continues the objects of the
+     previous chunk, prompted with an interior point of each object's last mask.
+  3. Each chunk is written to a temporary video and run through the video
+     predictor with stream=True; masks are appended to a run-length-encoded
+     mask store (maskRLE.py) frame by frame, so memory is bounded by one chunk,
+     no matter how long the video is. The predictor (and its weights) is built
+     once per video; only its per-source state (memory bank) is reset between
+     chunks. The predictor takes prompts on the first frame of its source
+     only, so chunks still start at every annotated frame.
+  4. progress.json records the finished chunks; a rerun resumes after the last
+     finished chunk.
+
+MODE = 'keyframe' runs the full model (SAM2 image predictor) only on keyframes
+and carries the masks to the frames in between along dense optical flow (see
+maskPropagation.py). A keyframe is taken every KEYFRAME_STRIDE frames or earlier
+when the propagated masks degrade (object lost, area drift, warp error). If a
+full MODE = 'video' run of the same video exists, the keyframe masks are
+compared with it (per-object IoU) and written with the throughput to
+quality.json, so the accuracy cost of the speed-up is known.
+
+Output (<video>_sam2/, <video>_sam2_keyframe/ in keyframe mode):
+  - masks/                  RLE mask store, one mask per object and frame (see maskRLE.MaskStore)
+  - objects_<start>.csv     frame_idx, object_id, area, x, y per object and frame (one file per chunk)
+  - progress.json
+  - quality.json            keyframe mode: keyframes, frames per second and IoU against the video mode masks
+
+Requirements:
+  - ultralytics (SAM2)
+  - OpenCV
+  - Python 3.x
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import shutil
+import cv2
+import numpy as np
+from ultralytics import SAM
 from ultralytics.models.sam import SAM2VideoPredictor
+from annotationStore import AnnotationStore, default_store_path
+from frameStore import FrameStore, is_frame_store
+from manifest import params_hash
+from circleCache import file_fingerprint
+from maskPropagation import MaskPropagator, KEYFRAME_STRIDE, interior_point, masks_to_labels, mask_quality
+from maskRLE import MaskWriter, is_mask_store
+import instrumentation as inst
+
+VIDEO_PATH = 'NematodeAI/Da/C0098_cropped.mp4'
+IMAGE_DIR = 'C:/Users/linus/NematodeAI/NematodeAI/Data/C0105.MP4_processedFrames/C0105_cropped'  # Annotated frames
+ANNOTATIONS_DB = default_store_path(IMAGE_DIR)
+OVERRIDES = dict(conf=0.25, task="segment", mode="predict", imgsz=1024, model="sam2_b.pt")
+MODE = 'video'               # 'video': SAM2 video predictor on every frame, 'keyframe': SAM2 on keyframes + optical flow
+OBJECT_LABELS = [1, 2, 3]    # Every point of these labels is one object to track
+NEGATIVE_LABELS = [0]        # Points of these labels are negative prompts for every object of the frame
+CHUNK_FRAMES = 300           # Frames per chunk, at most (bounds memory)
+ANNOTATED_SIZE = None        # (width, height) of the annotated images if IMAGE_DIR is not available
+PROFILE = False              # Write a per-stage timing report (<output>/run_report.json/.prom)
+
+FRAME_PATTERN = re.compile(r'_frame_(\d+)')
+
+# -------------------------------
+# Prompts
+# -------------------------------
+
+def frame_index(filename):
+    """
+    Source frame index of an annotated image ('<video>_frame_<idx>.jpg') or None.
+    """
+    match = FRAME_PATTERN.search(filename)
+    return int(match.group(1)) if match else None
+
+def annotated_size(image_dir, filename):
+    """
+    (width, height) of an annotated image, read from the image folder or frame store.
+    """
+    if image_dir and is_frame_store(image_dir):
+        h, w = FrameStore(image_dir).frame_shape[:2]
+        return w, h
+    path = os.path.join(image_dir, filename) if image_dir else None
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED) if path and os.path.exists(path) else None
+    if img is not None:
+        return img.shape[1], img.shape[0]
+    return ANNOTATED_SIZE
+
+def load_prompts(store, image_dir, video_size, object_labels=OBJECT_LABELS, negative_labels=NEGATIVE_LABELS):
+    """
+    Group the annotated points by video frame.
+    Returns {frame_idx: (objects, negatives)} with [x, y] points in video pixels.
+    """
+    prompts = {}
+    for filename in store.filenames(labels=object_labels):
+        idx = frame_index(filename)
+        if idx is None:
+            print(f"WARNING: No frame index in {filename}, skipping its points")
+            continue
+        size = annotated_size(image_dir, filename)
+        sx, sy = (video_size[0] / size[0], video_size[1] / size[1]) if size else (1.0, 1.0)
+        objects = [[x * sx, y * sy] for _, _, x, y in store.points(filename, labels=object_labels)]
+        negatives = [[x * sx, y * sy] for _, _, x, y in store.points(filename, labels=negative_labels)]
+        prompts.setdefault(idx, ([], []))
+        prompts[idx][0].extend(objects)
+        prompts[idx][1].extend(negatives)
+    return prompts
+
+def predictor_prompts(objects, negatives):
+    """
+    One prompt per object: its positive point plus all negative points of the frame.
+    """
+    points = [[p] + negatives for p in objects]
+    labels = [[1] + [0] * len(negatives) for _ in objects]
+    return points, labels
+
+# -------------------------------
+# Chunks
+# -------------------------------
+
+def plan_chunks(prompt_frames, n_frames, chunk_frames=CHUNK_FRAMES):
+    """
+    [(start, end), ...] covering the video from the first annotated frame on.
+    Chunks start at every annotated frame and are at most chunk_frames long.
+    """
+    prompt_frames = sorted(f for f in prompt_frames if 0 <= f < n_frames)
+    chunks = []
+    for i, start in enumerate(prompt_frames):
+        stop = prompt_frames[i + 1] if i + 1 < len(prompt_frames) else n_frames
+        for s in range(start, stop, chunk_frames):
+            chunks.append((s, min(s + chunk_frames, stop)))
+    return chunks
+
+def write_chunk_video(cap, start, end, path, fps):
+    """
+    Write frames [start, end) of an open capture to a temporary video. Returns the frame count.
+    """
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    writer = None
+    count = 0
+    try:
+        for _ in range(start, end):
+            with inst.stage('decode'):
+                ret, frame = cap.read()
+            if not ret:
+                break
+            if writer is None:
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+            count += 1
+    finally:
+        if writer is not None:
+            writer.release()
+    return count
+
+def object_rows(frame_idx, labels):
+    """
+    (frame_idx, object_id, area, x, y) rows of the objects of a label image.
+    """
+    flat = labels.ravel()
+    ys, xs = np.divmod(np.arange(flat.size), labels.shape[1])
+    area = np.bincount(flat)
+    sum_x = np.bincount(flat, weights=xs, minlength=area.size)
+    sum_y = np.bincount(flat, weights=ys, minlength=area.size)
+    return [(frame_idx, obj_id, int(area[obj_id]), round(sum_x[obj_id] / area[obj_id], 2),
+             round(sum_y[obj_id] / area[obj_id], 2)) for obj_id in np.nonzero(area)[0] if obj_id]
+
+# -------------------------------
+# Progress
+# -------------------------------
+
+def load_progress(path, key):
+    """
+    Progress of an earlier run with the same video, prompts and parameters, or a fresh one.
+    """
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                progress = json.load(f)
+            if progress.get('key') == key:
+                return progress
+            print("Video, annotations or parameters changed, starting over")
+        except (OSError, ValueError):
+            print(f"WARNING: Could not read {path}, starting over")
+    return {'key': key, 'done': [], 'next_object_id': 1, 'carry': {}}
+
+def save_progress(path, progress):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f, indent=1)
+    os.replace(tmp_path, path)
+
+# -------------------------------
+# Segmentation
+# -------------------------------
+
+def reset_predictor(predictor):
+    """
+    Forget the per-source state (memory bank, frame count) of a video
+    predictor, keeping the loaded model; it is rebuilt for the next source.
+    """
+    predictor.inference_state = {}
+
+def run_chunk(chunk_video, start, points, labels, object_ids, mask_writer, predictor):
+    """
+    Segment one chunk with the video predictor (reset first, it keeps its
+    state per source) and stream the masks to disk.
+    Returns (rows, carry) with a prompt point for every object still found.
+    """
+    reset_predictor(predictor)
+    rows = []
+    last_masks = {}
+    results = predictor(source=chunk_video, points=points, labels=labels, stream=True)
+    for offset, result in enumerate(results):
+        with inst.stage('sam2'):
+            masks = result.masks.data.cpu().numpy() > 0.5 if result.masks is not None else None
+        if masks is None or len(masks) == 0:
+            inst.count('frames_without_masks')
+            continue
+        with inst.stage('write'):
+            mask_writer.append_masks(start + offset, masks, object_ids)
+            rows.extend(object_rows(start + offset, masks_to_labels(masks, object_ids)))
+        for mask, obj_id in zip(masks, object_ids):
+            if mask.any():
+                last_masks[obj_id] = mask
+    return rows, {i: interior_point(m) for i, m in last_masks.items()}
+
+def segment_keyframe(model, frame, points, labels, object_ids, imgsz=OVERRIDES['imgsz']):
+    """
+    Label image of one frame from the SAM2 image predictor.
+    """
+    with inst.stage('sam2'):
+        result = model(frame, points=points, labels=labels, imgsz=imgsz, verbose=False)[0]
+    if result.masks is None:
+        return np.zeros(frame.shape[:2], np.uint16)
+    masks = result.masks.data.cpu().numpy() > 0.5
+    return masks_to_labels(masks, object_ids[:len(masks)])
+
+def run_chunk_keyframes(cap, start, end, points, labels, object_ids, mask_writer, model, stride=KEYFRAME_STRIDE):
+    """
+    Segment one chunk with the image model on keyframes only; the masks of the
+    frames in between are propagated along the optical flow.
+    Returns (rows, carry, keyframes) with a prompt point for every object.
+    """
+    propagator = MaskPropagator(stride=stride)
+    rows = []
+    keyframes = 0
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for frame_idx in range(start, end):
+        with inst.stage('decode'):
+            ret, frame = cap.read()
+        if not ret:
+            break
+        if frame_idx == start:
+            frame_labels = segment_keyframe(model, frame, points, labels, object_ids)
+            reason = 'first'
+        else:
+            with inst.stage('propagate'):
+                frame_labels, reason = propagator.step(frame)
+            if reason:
+                prompts = propagator.prompt_points()
+                ids = list(prompts)
+                key_points, key_labels = predictor_prompts(list(prompts.values()), [])
+                frame_labels = segment_keyframe(model, frame, key_points, key_labels, ids)
+        if reason:
+            keyframes += 1
+            inst.count(f'keyframes_{reason}')
+            propagator.set_keyframe(frame, frame_labels, object_ids)
+        with inst.stage('write'):
+            mask_writer.append_labels(frame_idx, frame_labels)
+            rows.extend(object_rows(frame_idx, frame_labels))
+    carry = propagator.prompt_points() if propagator.labels is not None else {}
+    return rows, carry, keyframes
+
+def default_output_dir(video_path, mode=MODE):
+    return os.path.splitext(video_path)[0] + ('_sam2_keyframe' if mode == 'keyframe' else '_sam2')
+
+def segment_video(video_path, store, image_dir=IMAGE_DIR, output_dir=None, chunk_frames=CHUNK_FRAMES,
+                  overrides=OVERRIDES, mode=MODE, keyframe_stride=KEYFRAME_STRIDE):
+    """
+    Segment a video chunk by chunk with prompts routed to their frames, with the
+    video predictor on every frame (mode='video') or the image model on
+    keyframes and optical flow in between (mode='keyframe').
+    Resumes after the last finished chunk of an earlier run. Returns the output directory.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Could not open video file: {video_path}")
+        return None
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 20.0
+    video_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    prompts = load_prompts(store, image_dir, video_size)
+    chunks = plan_chunks(prompts.keys(), n_frames, chunk_frames)
+    if not chunks:
+        print("No annotated frames within the video")
+        cap.release()
+        return None
 
-# Create SAM2VideoPredictor
-overrides = dict(conf=0.25, task="segment", mode="predict", imgsz=1024, model="sam2_b.pt")
-predictor = SAM2VideoPredictor(overrides=overrides)
+    output_dir = output_dir or default_output_dir(video_path, mode)
+    mask_dir = os.path.join(output_dir, 'masks')
+    work_dir = os.path.join(output_dir, 'tmp')
+    os.makedirs(work_dir, exist_ok=True)
 
-video = 'NematodeAI/Da/C0098_cropped.mp4'
+    progress_path = os.path.join(output_dir, 'progress.json')
+    key = params_hash({'video': file_fingerprint(video_path), 'prompts': sorted(prompts.items()),
+                       'chunk_frames': chunk_frames, 'overrides': overrides, 'mode': mode,
+                       'keyframe_stride': keyframe_stride if mode == 'keyframe' else None})
+    progress = load_progress(progress_path, key)
+    progress.setdefault('frames', 0)
+    progress.setdefault('keyframes', 0)
+    progress.setdefault('seconds', 0.0)
+    done = {tuple(c) for c in progress['done']}
+    # Built once: loading the weights costs more than segmenting a short chunk
+    model = SAM(overrides['model']) if mode == 'keyframe' else None
+    predictor = SAM2VideoPredictor(overrides=overrides) if mode == 'video' else None
+    # Masks of a chunk that did not finish are dropped again
+    mask_writer = MaskWriter(mask_dir, (video_size[1], video_size[0]), keep=progress.get('mask_rows', 0),
+                             source=video_path)
 
-# Run inference with single point
-# Read the CSV file
-points_df = pd.read_csv('C:/Users/linus/NematodeAI/NematodeAI/Data/C0105.MP4_processedFrames/C0105_cropped_clicked_points.csv')
+    try:
+        for start, end in chunks:
+            if (start, end) in done:
+                continue
+            if start in prompts:
+                # New annotations: new objects
+                objects, negatives = prompts[start]
+                object_ids = list(range(progress['next_object_id'], progress['next_object_id'] + len(objects)))
+                progress['next_object_id'] += len(objects)
+            else:
+                # Continue the objects of the previous chunk
+                carry = progress['carry']
+                object_ids = [int(i) for i in carry]
+                objects, negatives = [carry[str(i)] for i in object_ids], []
 
-# Filter points for class 1 and 2 (exclude class 0/background)
-valid_points = points_df[points_df['class'].isin([1, 2])]
+            print(f"Chunk {start}-{end} of {n_frames}: {len(object_ids)} objects")
+            if object_ids:
+                chunk_start = time.perf_counter()
+                points, labels = predictor_prompts(objects, negatives)
+                if mode == 'keyframe':
+                    rows, carry, keyframes = run_chunk_keyframes(cap, start, end, points, labels, object_ids,
+                                                                 mask_writer, model, keyframe_stride)
+                    progress['keyframes'] += keyframes
+                else:
+                    chunk_video = os.path.join(work_dir, f"chunk_{start:06d}.mp4")
+                    write_chunk_video(cap, start, end, chunk_video, fps)
+                    rows, carry = run_chunk(chunk_video, start, points, labels, object_ids, mask_writer, predictor)
+                    os.remove(chunk_video)
+                progress['frames'] += end - start
+                progress['seconds'] += time.perf_counter() - chunk_start
 
-# Convert to format needed by predictor
-points = valid_points[['x', 'y']].values.tolist()
-labels = valid_points['class'].map({1: 1, 2: 1}).tolist()  # Map both classes to 1 for segmentation
+                # Per-chunk object table, renamed into place only when the chunk is complete
+                table_path = os.path.join(output_dir, f"objects_{start:06d}.csv")
+                with open(table_path + '.part', 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(['frame_idx', 'object_id', 'area', 'x', 'y'])
+                    writer.writerows(rows)
+                os.replace(table_path + '.part', table_path)
+                progress['carry'] = {str(i): p for i, p in carry.items()}
+            else:
+                progress['carry'] = {}
 
-# Run inference with points from CSV
-results = predictor(source=video, points=points, labels=labels)
+            progress['done'].append([start, end])
+            progress['mask_rows'] = mask_writer.count
+            save_progress(progress_path, progress)
+    finally:
+        cap.release()
+        mask_writer.close()
 
-# Run inference with multiple points
-# results = predictor(source=video, points=[[920, 470], [909, 138]], labels=[1, 1])
+    shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"Saved masks to: {mask_dir}")
+    if progress['seconds'] > 0:
+        print(f"Segmented {progress['frames']} frames at {progress['frames'] / progress['seconds']:.2f} frames/s")
+    if mode == 'keyframe':
+        write_quality(video_path, output_dir, progress)
+    inst.write_report(os.path.join(output_dir, 'run_report.json'),
+                      prometheus_path=os.path.join(output_dir, 'run_report.prom'))
+    return output_dir
 
-# Run inference with multiple points prompt per object
-# results = predictor(source=video, points=[[[920, 470], [909, 138]]], labels=[[1, 1]])
+def write_quality(video_path, output_dir, progress):
+    """
+    Keyframe share, throughput and (if a full per-frame run of the video exists)
+    per-object IoU against it, written to <output_dir>/quality.json.
+    """
+    quality = {'frames': progress['frames'], 'keyframes': progress['keyframes'],
+               'keyframe_fraction': progress['keyframes'] / progress['frames'] if progress['frames'] else 0.0,
+               'frames_per_second': progress['frames'] / progress['seconds'] if progress['seconds'] else 0.0}
+    reference_dir = os.path.join(default_output_dir(video_path, 'video'), 'masks')
+    if is_mask_store(reference_dir):
+        quality['reference'] = reference_dir
+        quality.update(mask_quality(reference_dir, os.path.join(output_dir, 'masks')))
+        with open(os.path.join(os.path.dirname(reference_dir), 'progress.json')) as f:
+            reference = json.load(f)
+        if reference.get('seconds'):
+            reference_fps = reference['frames'] / reference['seconds']
+            quality['speedup'] = quality['frames_per_second'] / reference_fps
+        print(f"Keyframe masks vs. per-frame inference: mean IoU {quality.get('mean_iou', 0):.3f}, "
+              f"10th percentile {quality.get('p10_iou', 0):.3f}, speed-up {quality.get('speedup', 0):.1f}x")
+    else:
+        print("No per-frame (MODE = 'video') masks of this video to compare with")
+    with open(os.path.join(output_dir, 'quality.json'), 'w') as f:
+        json.dump(quality, f, indent=2)
+    return quality
 
-# Run inference with negative points prompt
-# results = predictor(source=video, points=[[[920, 470], [909, 138]]], labels=[[1, 0]])
+def main():
+    if PROFILE:
+        inst.enable('samMobile')
+    with AnnotationStore(ANNOTATIONS_DB) as store:
+        segment_video(VIDEO_PATH, store, mode=MODE)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Multi-Video Job Scheduler
+
+Runs one preprocessing task (pipelineVideo, 1_VideoToFrames, VideoToFrames)
+over every video of a folder tree, e.g. all recordings of one fermenter run,
+instead of one hard-coded video at a time.
+
+  1. Videos are discovered recursively (VIDEO_EXTENSIONS).
+  2. The cost of each video is estimated from its metadata as
+     frame count x width x height (file size if the container has no usable
+     metadata).
+  3. Jobs are started longest-first on WORKERS processes (LPT scheduling), so
+     the long videos do not end up running alone at the end and the wall time
+     approaches total work / cores instead of the sum of all videos.
+  4. Every video runs in its own process with its output in a log file
+     (<output_dir>/logs/<folder>/<video>.log). Outputs and logs mirror each
+     video's folder relative to the scanned path, so same-named videos of
+     different folders do not overwrite each other. A corrupt file that raises, hangs past
+     JOB_TIMEOUT or crashes the interpreter only fails its own job.
+  5. Progress is reported as finished / total cost with an ETA based on the
+     measured throughput (cost units per worker-second); a JSON summary of all
+     jobs is written to <output_dir>/schedule_report.json.
+
+Each worker process limits OpenCV to cores / WORKERS threads, so concurrent
+videos do not oversubscribe the CPU.
+
+Usage:
+    python scheduler.py "Videos/2025.03.24_gemischte Stadien aus Fermenterlauf D31220_Tag 11" --task pipelineVideo
+    python scheduler.py Videos --task 1_VideoToFrames --output-dir Frames --workers 6
+
+Requirements:
+  - OpenCV
+  - Python 3.x
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import importlib
+import traceback
+import multiprocessing
+import cv2
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+WORKERS = os.cpu_count()  # Videos processed at the same time
+JOB_TIMEOUT = None        # Seconds after which a job is killed (None = no limit)
+POLL_INTERVAL = 0.5       # Seconds between two checks of the running jobs
+REPORT_INTERVAL = 10.0    # Seconds between two progress lines while nothing finishes
+
+# -------------------------------
+# Tasks
+# -------------------------------
+
+def run_pipeline_video(video_path, output_dir, threads):
+    import pipelineVideo
+    base_name = os.path.splitext(os.path.basename(video_path))[0]
+    output_path = os.path.join(output_dir, base_name + '_cropped.mp4')
+    if pipelineVideo.process_video(video_path, output_path, workers=threads) is None:
+        raise RuntimeError("No output written (unreadable video or no well detected)")
+
+def run_video_to_frames(video_path, output_dir, threads):
+    module = importlib.import_module('1_VideoToFrames')
+    if module.process_video(video_path, output_dir) == 0:
+        raise RuntimeError("No frames extracted")
+
+def run_avi_to_frames(video_path, output_dir, threads):
+    import VideoToFrames
+    if VideoToFrames.process_video(video_path, output_dir) == 0:
+        raise RuntimeError("No frames extracted")
+
+TASKS = {'pipelineVideo': run_pipeline_video, '1_VideoToFrames': run_video_to_frames,
+         'VideoToFrames': run_avi_to_frames}
+
+# -------------------------------
+# Discovery and Cost
+# -------------------------------
+
+def discover_videos(paths, extensions=VIDEO_EXTENSIONS):
+    """
+    Sorted (video path, folder relative to the scanned directory) pairs of the
+    video files below the given files / directories. Files given directly have
+    the folder ''.
+    """
+    videos = {}
+    for path in paths:
+        if os.path.isfile(path):
+            videos.setdefault(path, '')
+            continue
+        for root, _, files in os.walk(path):
+            folder = os.path.relpath(root, path)
+            for f in files:
+                if f.lower().endswith(extensions):
+                    videos.setdefault(os.path.join(root, f), '' if folder == os.curdir else folder)
+    return sorted(videos.items())
+
+def estimate_cost(video_path):
+    """
+    (cost, info) of a video: frame count x width x height from its metadata,
+    or the file size if the metadata is missing or the file cannot be opened.
+    """
+    size = os.path.getsize(video_path)
+    cap = cv2.VideoCapture(video_path)
+    try:
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+        width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
+    info = {'frames': frames, 'width': width, 'height': height, 'bytes': size}
+    if frames > 0 and width > 0 and height > 0:
+        return float(frames) * width * height, info
+    info['estimate'] = 'file size'
+    return float(size), info
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+# -------------------------------
+# Worker Process
+# -------------------------------
+
+def run_job(task, video_path, output_dir, threads, log_path, results):
+    """
+    Process entry point: run one task on one video with stdout/stderr in its
+    log file and put (video_path, error or None) on the results queue.
+    """
+    with open(log_path, 'w', buffering=1) as log:
+        sys.stdout = sys.stderr = log
+        cv2.setNumThreads(threads)
+        error = None
+        try:
+            TASKS[task](video_path, output_dir, threads)
+        except BaseException as e:
+            traceback.print_exc()
+            error = f"{type(e).__name__}: {e}"
+        log.flush()
+        results.put((video_path, error))
+
+# -------------------------------
+# Scheduler
+# -------------------------------
+
+class Scheduler:
+    """
+    Longest-first distribution of video jobs over isolated worker processes.
+    """
+
+    def __init__(self, task, output_dir, workers=WORKERS, timeout=JOB_TIMEOUT):
+        if task not in TASKS:
+            raise ValueError(f"Unknown task {task!r}, expected one of {sorted(TASKS)}")
+        self.task = task
+        self.output_dir = output_dir
+        self.workers = max(1, workers or 1)
+        self.timeout = timeout
+        self.threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self.log_dir = os.path.join(output_dir, 'logs')
+        self.jobs = []
+        self.names = set()
+
+    def add(self, video_path, folder=''):
+        """
+        Queue a video. Its outputs go to <output_dir>/<folder>, its log to
+        <output_dir>/logs/<folder>/<video>.log.
+        """
+        cost, info = estimate_cost(video_path)
+        base_name = os.path.splitext(os.path.basename(video_path))[0]
+        # Same-named videos in the same folder (e.g. from two scanned paths) get a folder of their own
+        key = os.path.normcase(os.path.join(folder, base_name))
+        if key in self.names:
+            folder = os.path.join(folder, f"{base_name}_{len(self.jobs)}")
+        self.names.add(os.path.normcase(os.path.join(folder, base_name)))
+        self.jobs.append({'video': video_path, 'cost': cost, 'info': info, 'status': 'pending',
+                          'output_dir': os.path.join(self.output_dir, folder),
+                          'log': os.path.join(self.log_dir, folder, base_name + '.log')})
+
+    def eta(self, running, now):
+        """
+        Seconds until all jobs are done, from the throughput of the successful
+        jobs (cost per worker-second; failed jobs often stop early), or None
+        before the first job succeeded.
+        """
+        finished = [j for j in self.jobs if j['status'] == 'done']
+        busy = sum(j['seconds'] for j in finished)
+        if busy <= 0:
+            return None
+        rate = sum(j['cost'] for j in finished) / busy
+        remaining = sum(j['cost'] for j in self.jobs if j['status'] == 'pending')
+        remaining += sum(max(j['cost'] - (now - j['start']) * rate, 0) for j in running.values())
+        return remaining / (rate * self.workers)
+
+    def report(self, running, start):
+        now = time.perf_counter()
+        total = sum(j['cost'] for j in self.jobs)
+        finished = sum(j['cost'] for j in self.jobs if j['status'] in ('done', 'failed'))
+        done = sum(j['status'] == 'done' for j in self.jobs)
+        failed = sum(j['status'] == 'failed' for j in self.jobs)
+        eta = self.eta(running, now)
+        print(f"[{format_duration(now - start)}] {done + failed}/{len(self.jobs)} videos "
+              f"({100 * finished / max(total, 1):.1f}% of work, {failed} failed, {len(running)} running), "
+              f"ETA {format_duration(eta) if eta is not None else 'unknown'}")
+
+    def run(self):
+        """
+        Run all jobs. Returns the job list with status, seconds and error per video.
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        pending = sorted(self.jobs, key=lambda j: j['cost'], reverse=True)
+        print(f"Scheduling {len(pending)} videos on {self.workers} worker(s), "
+              f"{self.threads} OpenCV thread(s) each")
+        results = multiprocessing.Queue()
+        running = {}  # video path -> job (with its process)
+        start = last_report = time.perf_counter()
+
+        def finish(job, error):
+            job['process'].join()
+            job['seconds'] = time.perf_counter() - job['start']
+            job['status'] = 'failed' if error else 'done'
+            job['error'] = error
+            del running[job['video']]
+            print(f"{'FAILED' if error else 'Finished'} {job['video']} in {job['seconds']:.1f} s"
+                  + (f": {error} (see {job['log']})" if error else ''))
+
+        try:
+            while pending or running:
+                while pending and len(running) < self.workers:
+                    job = pending.pop(0)
+                    os.makedirs(os.path.dirname(job['log']), exist_ok=True)
+                    os.makedirs(job['output_dir'], exist_ok=True)
+                    job['process'] = multiprocessing.Process(
+                        target=run_job, args=(self.task, job['video'], job['output_dir'], self.threads,
+                                              job['log'], results), daemon=True)
+                    job['start'] = time.perf_counter()
+                    job['status'] = 'running'
+                    job['process'].start()
+                    running[job['video']] = job
+
+                reported = False
+                while not results.empty():
+                    video, error = results.get()
+                    if video in running:
+                        finish(running[video], error)
+                        reported = True
+                # Processes that died without reporting (segfault, killed) or ran too long
+                now = time.perf_counter()
+                for job in list(running.values()):
+                    if job['video'] not in running:
+                        continue
+                    if not job['process'].is_alive():
+                        # A result sent just before the exit may still be in flight
+                        try:
+                            while job['video'] in running:
+                                video, error = results.get(timeout=1.0)
+                                if video in running:
+                                    finish(running[video], error)
+                        except queue.Empty:
+                            finish(job, f"worker exited with code {job['process'].exitcode}")
+                        reported = True
+                    elif self.timeout and now - job['start'] > self.timeout:
+                        job['process'].kill()
+                        finish(job, f"timed out after {self.timeout} s")
+                        reported = True
+
+                if reported or now - last_report >= REPORT_INTERVAL:
+                    self.report(running, start)
+                    last_report = now
+                time.sleep(POLL_INTERVAL)
+        finally:
+            for job in running.values():
+                job['process'].kill()
+
+        elapsed = time.perf_counter() - start
+        busy = sum(j.get('seconds', 0) for j in self.jobs)
+        print(f"Finished {len(self.jobs)} videos in {format_duration(elapsed)} "
+              f"(sum of job times {format_duration(busy)}, {busy / max(elapsed, 1e-9):.1f}x parallel)")
+        self.write_report(elapsed)
+        return self.jobs
+
+    def write_report(self, elapsed):
+        path = os.path.join(self.output_dir, 'schedule_report.json')
+        jobs = [{k: v for k, v in j.items() if k not in ('process', 'start')} for j in self.jobs]
+        with open(path, 'w') as f:
+            json.dump({'task': self.task, 'workers': self.workers, 'elapsed': elapsed, 'jobs': jobs}, f, indent=2)
+        print(f"Saved schedule report to: {path}")
+
+def schedule(paths, task, output_dir, workers=WORKERS, timeout=JOB_TIMEOUT):
+    """
+    Discover the videos below paths and run task on all of them. Returns the job list.
+    """
+    videos = discover_videos(paths)
+    if not videos:
+        print(f"No videos found in {paths}")
+        return []
+    scheduler = Scheduler(task, output_dir, workers, timeout)
+    for video, folder in videos:
+        scheduler.add(video, folder)
+    return scheduler.run()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a preprocessing task on many videos in parallel.')
+    parser.add_argument('paths', nargs='+', help='video files or folders (searched recursively)')
+    parser.add_argument('--task', default='pipelineVideo', choices=sorted(TASKS))
+    parser.add_argument('--output-dir', default='NematodeAI/Processed', help='output directory of all jobs')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='videos processed at the same time')
+    parser.add_argument('--timeout', type=float, default=JOB_TIMEOUT, help='seconds before a job is killed')
+    args = parser.parse_args()
+    jobs = schedule(args.paths, args.task, args.output_dir, args.workers, args.timeout)
+    if any(j['status'] == 'failed' for j in jobs):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+"""
+Multi-Object Nematode Tracker
+
+Links the per-frame detections of counting.py into tracks, so movement features
+(speed, straightness, turning) can be used to tell J, DJ and adult worms apart.
+
+Detections come from a cropped video (pipelineVideo.py output): either the
+counts directory written by pipelineVideo with COUNT = True (<video>_counts/),
+or, if there is none, by running counting.Counter on every frame of the video.
+
+Per frame:
+  1. Every live track predicts its position with a constant-velocity model.
+  2. The cost matrix of all tracks x all detections is built in one NumPy
+     broadcast: squared distance between prediction and detection plus a
+     penalty for a relative change in worm length. Pairs farther apart than the
+     gate (GATE_DISTANCE, widened by GATE_GROWTH per missed frame) are
+     impossible.
+  3. Only tracks and detections with at least one pair inside the gate go to
+     the assignment: scipy.optimize.linear_sum_assignment if SciPy is
+     installed, otherwise a greedy assignment of the cheapest gated pairs.
+  4. Matched tracks are updated (velocity smoothed with VELOCITY_SMOOTHING),
+     unmatched detections start new tracks, tracks missed for more than
+     MAX_MISSED frames end.
+
+Track state is kept in NumPy arrays (one row per live track), not in one
+object per worm, so a frame with hundreds of worms costs a few array
+operations.
+
+Output (<video>_tracks.npz), columnar:
+  - obs_track_id, obs_frame_idx, obs_timestamp, obs_x, obs_y, obs_area, obs_length
+      one row per detection that belongs to a track
+  - track_id, first_frame, last_frame, n_frames, duration, path_length,
+    net_displacement, straightness, mean_speed, max_speed, speed_std,
+    active_fraction, turn_rate, mean_length, mean_area
+      one row per track with at least MIN_TRACK_FRAMES detections
+Positions are in pixels of the cropped video, speeds in pixels per second.
+
+Usage:
+    python tracker.py                       # track VIDEO_PATH
+    python tracker.py --video C0098_cropped.mp4
+    python tracker.py --benchmark --worms 300 --frames 500
+    python tracker.py --benchmark --render  # detections by counting.py on rendered frames
+
+    tracks = load_tracks('C0098_cropped_tracks.npz')
+
+Requirements:
+  - OpenCV
+  - NumPy
+  - Python 3.x
+  - Optional: SciPy (optimal assignment, otherwise greedy)
+"""
+
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+from counting import Counter, load_counts
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+VIDEO_PATH = 'NematodeAI/Processed/C0098_cropped.mp4'
+GATE_DISTANCE = 25.0        # Pixels between prediction and detection, at most
+GATE_GROWTH = 10.0          # Pixels the gate widens per missed frame
+LENGTH_WEIGHT = 100.0       # Cost (squared pixels) of a 100 % change in worm length
+VELOCITY_SMOOTHING = 0.5    # Weight of the newest velocity in the constant-velocity model
+MAX_MISSED = 5              # Frames a track survives without a detection
+MIN_TRACK_FRAMES = 10       # Shorter tracks are dropped from the output
+ACTIVE_SPEED = 5.0          # Pixels per second above which a worm counts as moving
+
+OBSERVATION_FIELDS = ['track_id', 'frame_idx', 'timestamp', 'x', 'y', 'area', 'length']
+
+# -------------------------------
+# Assignment
+# -------------------------------
+
+def cost_matrix(predicted, lengths, det_xy, det_length, gate):
+    """
+    (tracks x detections) cost: squared distance plus the length penalty,
+    np.inf outside the per-track gate radius.
+    """
+    diff = predicted[:, None, :] - det_xy[None, :, :]
+    dist2 = np.einsum('ijk,ijk->ij', diff, diff)
+    change = np.abs(lengths[:, None] - det_length[None, :]) / np.maximum(lengths[:, None], 1)
+    cost = dist2 + LENGTH_WEIGHT * change
+    cost[dist2 > (gate ** 2)[:, None]] = np.inf
+    return cost
+
+def greedy_assignment(cost):
+    """
+    Cheapest gated pairs first, each row and column used once.
+    """
+    rows, cols = np.nonzero(np.isfinite(cost))
+    order = np.argsort(cost[rows, cols], kind='stable')
+    used_rows, used_cols = set(), set()
+    matched_rows, matched_cols = [], []
+    for r, c in zip(rows[order], cols[order]):
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        matched_rows.append(r)
+        matched_cols.append(c)
+    return np.array(matched_rows, np.int64), np.array(matched_cols, np.int64)
+
+def assign(cost):
+    """
+    (rows, cols) of the matched (track, detection) pairs of a gated cost matrix.
+    """
+    # Rows / columns without any pair inside the gate cannot be matched
+    finite = np.isfinite(cost)
+    active_rows, active_cols = np.flatnonzero(finite.any(axis=1)), np.flatnonzero(finite.any(axis=0))
+    if active_rows.size == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    sub = cost[np.ix_(active_rows, active_cols)]
+    if linear_sum_assignment is None:
+        rows, cols = greedy_assignment(sub)
+    else:
+        # Gated pairs get a cost no real pair can reach; they are dropped after the assignment
+        big = sub[np.isfinite(sub)].max() * 2 + 1
+        rows, cols = linear_sum_assignment(np.where(np.isfinite(sub), sub, big))
+        valid = np.isfinite(sub[rows, cols])
+        rows, cols = rows[valid], cols[valid]
+    return active_rows[rows], active_cols[cols]
+
+# -------------------------------
+# Tracker
+# -------------------------------
+
+class Tracker:
+    """
+    Constant-velocity multi-object tracker with gated assignment.
+    """
+
+    def __init__(self, gate=GATE_DISTANCE, gate_growth=GATE_GROWTH, max_missed=MAX_MISSED,
+                 smoothing=VELOCITY_SMOOTHING):
+        self.gate = gate
+        self.gate_growth = gate_growth
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.next_id = 1
+        # Live tracks, one row each
+        self.ids = np.zeros(0, np.int64)
+        self.positions = np.zeros((0, 2))
+        self.velocities = np.zeros((0, 2))
+        self.lengths = np.zeros(0)
+        self.missed = np.zeros(0, np.int64)
+        self.observations = {k: [] for k in OBSERVATION_FIELDS}
+
+    def update(self, frame_idx, timestamp, detections):
+        """
+        Add the detections of one frame (column dict with x, y, area, length as
+        returned in counting.Counter.count()['objects']). Returns the track id
+        of every detection.
+        """
+        det_xy = np.column_stack([detections['x'], detections['y']]).astype(np.float64)
+        det_length = np.asarray(detections['length'], np.float64)
+        n_det = len(det_xy)
+
+        # Predict, the gap since the last detection is missed + 1 frames
+        steps = (self.missed + 1)[:, None]
+        predicted = self.positions + self.velocities * steps
+        gate = self.gate + self.gate_growth * self.missed
+        rows, cols = assign(cost_matrix(predicted, self.lengths, det_xy, det_length, gate))
+
+        # Matched tracks
+        velocity = (det_xy[cols] - self.positions[rows]) / steps[rows]
+        self.velocities[rows] = self.smoothing * velocity + (1 - self.smoothing) * self.velocities[rows]
+        self.positions[rows] = det_xy[cols]
+        self.lengths[rows] = det_length[cols]
+        self.missed += 1
+        self.missed[rows] = 0
+
+        # New tracks for the unmatched detections
+        new = np.ones(n_det, bool)
+        new[cols] = False
+        n_new = int(new.sum())
+        new_ids = np.arange(self.next_id, self.next_id + n_new)
+        self.next_id += n_new
+        self.ids = np.concatenate([self.ids, new_ids])
+        self.positions = np.concatenate([self.positions, det_xy[new]])
+        self.velocities = np.concatenate([self.velocities, np.zeros((n_new, 2))])
+        self.lengths = np.concatenate([self.lengths, det_length[new]])
+        self.missed = np.concatenate([self.missed, np.zeros(n_new, np.int64)])
+
+        track_ids = np.empty(n_det, np.int64)
+        track_ids[cols] = self.ids[rows]
+        track_ids[new] = new_ids
+        self._record(frame_idx, timestamp, track_ids, detections)
+
+        # End tracks that were missed too often
+        alive = self.missed <= self.max_missed
+        if not alive.all():
+            self.ids, self.positions, self.velocities = self.ids[alive], self.positions[alive], self.velocities[alive]
+            self.lengths, self.missed = self.lengths[alive], self.missed[alive]
+        return track_ids
+
+    def _record(self, frame_idx, timestamp, track_ids, detections):
+        n = len(track_ids)
+        self.observations['track_id'].append(track_ids)
+        self.observations['frame_idx'].append(np.full(n, frame_idx, np.int64))
+        self.observations['timestamp'].append(np.full(n, timestamp, np.float64))
+        for key in OBSERVATION_FIELDS[3:]:
+            self.observations[key].append(np.asarray(detections[key], np.float32))
+
+    def result(self, min_frames=MIN_TRACK_FRAMES, active_speed=ACTIVE_SPEED):
+        """
+        Columnar observations (obs_*) and per-track statistics of all tracks
+        with at least min_frames detections, sorted by track and frame.
+        """
+        if not self.observations['track_id']:
+            obs = {k: np.zeros(0) for k in OBSERVATION_FIELDS}
+        else:
+            obs = {k: np.concatenate(v) for k, v in self.observations.items()}
+        order = np.lexsort((obs['frame_idx'], obs['track_id']))
+        obs = {k: v[order] for k, v in obs.items()}
+        track_ids, counts = np.unique(obs['track_id'], return_counts=True)
+        keep = np.isin(obs['track_id'], track_ids[counts >= min_frames])
+        obs = {k: v[keep] for k, v in obs.items()}
+        columns = {'obs_' + k: v for k, v in obs.items()}
+        columns.update(motility_stats(obs, active_speed))
+        return columns
+
+# -------------------------------
+# Motility Statistics
+# -------------------------------
+
+def motility_stats(obs, active_speed=ACTIVE_SPEED):
+    """
+    Per-track movement statistics from observations sorted by track and frame.
+    """
+    track_ids, starts, n_frames = np.unique(obs['track_id'], return_index=True, return_counts=True)
+    n = len(track_ids)
+    ends = starts + n_frames - 1
+    x, y, t = obs['x'].astype(np.float64), obs['y'].astype(np.float64), obs['timestamp']
+
+    # Steps between consecutive observations of the same track
+    same = obs['track_id'][1:] == obs['track_id'][:-1]
+    dx, dy, dt = np.diff(x)[same], np.diff(y)[same], np.diff(t)[same]
+    step_track = np.searchsorted(track_ids, obs['track_id'][1:][same])
+    step = np.hypot(dx, dy)
+    speed = step / np.maximum(dt, 1e-9)
+    steps = np.maximum(np.bincount(step_track, minlength=n), 1)
+
+    path_length = np.bincount(step_track, step, n)
+    mean_speed = np.bincount(step_track, speed, n) / steps
+    speed_var = np.bincount(step_track, speed ** 2, n) / steps - mean_speed ** 2
+    max_speed = np.zeros(n)
+    np.maximum.at(max_speed, step_track, speed)
+    active_fraction = np.bincount(step_track, speed > active_speed, n) / steps
+
+    # Turning: absolute heading change between consecutive steps of the same track
+    heading = np.arctan2(dy, dx)
+    consecutive = step_track[1:] == step_track[:-1]
+    turn = np.abs(np.angle(np.exp(1j * (heading[1:] - heading[:-1]))))[consecutive]
+    turn_track = step_track[1:][consecutive]
+    duration = t[ends] - t[starts]
+    turn_rate = np.bincount(turn_track, turn, n) / np.maximum(duration, 1e-9)
+
+    net = np.hypot(x[ends] - x[starts], y[ends] - y[starts])
+    return {'track_id': track_ids, 'first_frame': obs['frame_idx'][starts], 'last_frame': obs['frame_idx'][ends],
+            'n_frames': n_frames, 'duration': duration, 'path_length': path_length,
+            'net_displacement': net, 'straightness': net / np.maximum(path_length, 1e-9),
+            'mean_speed': mean_speed, 'max_speed': max_speed, 'speed_std': np.sqrt(np.maximum(speed_var, 0)),
+            'active_fraction': active_fraction, 'turn_rate': turn_rate,
+            'mean_length': np.bincount(np.repeat(np.arange(n), n_frames), obs['length'], n) / n_frames,
+            'mean_area': np.bincount(np.repeat(np.arange(n), n_frames), obs['area'], n) / n_frames}
+
+# -------------------------------
+# Video Tracking
+# -------------------------------
+
+def video_detections(video_path):
+    """
+    Generator yielding (frame_idx, timestamp, detections) for a cropped video:
+    from its counts directory if pipelineVideo wrote one, otherwise by counting
+    every frame.
+    """
+    counts_dir = os.path.splitext(video_path)[0] + '_counts'
+    if os.path.isdir(counts_dir):
+        print(f"Using detections from {counts_dir}")
+        counts = load_counts(counts_dir)
+        bounds = np.searchsorted(counts['object_frame_idx'], counts['frame_idx'], side='left')
+        ends = np.searchsorted(counts['object_frame_idx'], counts['frame_idx'], side='right')
+        for frame_idx, timestamp, start, end in zip(counts['frame_idx'], counts['timestamp'], bounds, ends):
+            yield int(frame_idx), float(timestamp), {k: counts['object_' + k][start:end]
+                                                      for k in ('x', 'y', 'area', 'length')}
+        return
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Could not open video {video_path}")
+        return
+    fps = cap.get(cv2.CAP_PROP_FPS) or 20.0
+    counter = Counter()
+    frame_idx = 0
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame_idx, frame_idx / fps, counter.count(frame)['objects']
+            frame_idx += 1
+    finally:
+        cap.release()
+
+def default_output_path(video_path):
+    return os.path.splitext(video_path)[0] + '_tracks.npz'
+
+def save_tracks(path, columns):
+    """
+    Write the columns atomically (temporary file, then rename).
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(tmp_path, path)
+
+def load_tracks(path):
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+def track_video(video_path, output_path=None):
+    """
+    Track the worms of a cropped video and write <video>_tracks.npz. Returns the output path.
+    """
+    output_path = output_path or default_output_path(video_path)
+    tracker = Tracker()
+    start = time.perf_counter()
+    frame_count = 0
+    for frame_idx, timestamp, detections in video_detections(video_path):
+        tracker.update(frame_idx, timestamp, detections)
+        frame_count += 1
+        if frame_count % 100 == 0:
+            print(f"Tracked {frame_count} frames, {tracker.next_id - 1} tracks started")
+    columns = tracker.result()
+    save_tracks(output_path, columns)
+    elapsed = time.perf_counter() - start
+    print(f"Finished tracking {frame_count} frames in {elapsed:.1f}s: {len(columns['track_id'])} tracks")
+    print(f"Saved tracks to: {output_path}")
+    return output_path
+
+# -------------------------------
+# Benchmark
+# -------------------------------
+
+def benchmark(n_frames=300, n_worms=60, size=1024, render=False, jitter=1.0, miss_rate=0.05, seed=0):
+    """
+    Track synthetic moving worms (benchmark.synthetic_frames) with known
+    identities. Detections are the true positions with jitter and random misses,
+    or, with render=True, counting.py run on the rendered frames. Returns
+    tracking speed and identity errors.
+    """
+    from benchmark import synthetic_frames, synthetic_well
+
+    rng = np.random.default_rng(seed)
+    _, _, radius = synthetic_well((size, size))
+    counter = Counter() if render else None
+    tracker = Tracker()
+    truth = {k: [] for k in ('track_id', 'worm')}
+    update_time = 0.0
+    n_detections = 0
+
+    for frame_idx, (frame, positions) in enumerate(synthetic_frames(n_frames, (size, size), n_worms, seed=seed)):
+        if render:
+            detections = counter.count(frame, radius)['objects']
+            det_xy = np.column_stack([detections['x'], detections['y']])
+        else:
+            seen = rng.uniform(size=n_worms) >= miss_rate
+            det_xy = positions[seen] + rng.normal(0, jitter, (int(seen.sum()), 2))
+            detections = {'x': det_xy[:, 0], 'y': det_xy[:, 1], 'area': np.full(len(det_xy), 300.0),
+                          'length': np.full(len(det_xy), 100.0)}
+        t0 = time.perf_counter()
+        track_ids = tracker.update(frame_idx, frame_idx / 20.0, detections)
+        update_time += time.perf_counter() - t0
+        n_detections += len(track_ids)
+
+        # True identity of every detection: the nearest worm centre
+        diff = det_xy[:, None, :] - positions[None, :, :]
+        truth['track_id'].append(track_ids)
+        truth['worm'].append(np.argmin(np.einsum('ijk,ijk->ij', diff, diff), axis=1))
+
+    track_ids, worms = np.concatenate(truth['track_id']), np.concatenate(truth['worm'])
+    # Identity switches: a worm whose track id changes between consecutive detections
+    order = np.lexsort((np.arange(len(worms)), worms))
+    switches = int(((worms[order][1:] == worms[order][:-1]) & (track_ids[order][1:] != track_ids[order][:-1])).sum())
+    # Purity: share of a track's detections that belong to its majority worm
+    pairs, pair_counts = np.unique(track_ids * n_worms + worms, return_counts=True)
+    majority = np.zeros(tracker.next_id)
+    np.maximum.at(majority, pairs // n_worms, pair_counts)
+
+    return {'frames': n_frames, 'worms': n_worms, 'detections': n_detections,
+            'assignment': 'hungarian' if linear_sum_assignment is not None else 'greedy',
+            'update_ms': update_time / n_frames * 1000, 'fps': n_frames / max(update_time, 1e-9),
+            'tracks_started': tracker.next_id - 1, 'id_switches': switches,
+            'purity': float(majority.sum() / max(len(track_ids), 1))}
+
+def main():
+    parser = argparse.ArgumentParser(description='Track nematodes across the frames of a cropped video.')
+    parser.add_argument('--video', default=VIDEO_PATH, help='cropped video (pipelineVideo.py output)')
+    parser.add_argument('--output', help='tracks file (default <video>_tracks.npz)')
+    parser.add_argument('--benchmark', action='store_true', help='track synthetic worms instead of a video')
+    parser.add_argument('--frames', type=int, default=300, help='benchmark: synthetic frames')
+    parser.add_argument('--worms', type=int, default=60, help='benchmark: synthetic worms')
+    parser.add_argument('--size', type=int, default=1024, help='benchmark: frame size in pixels')
+    parser.add_argument('--render', action='store_true', help='benchmark: detect worms with counting.py')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        result = benchmark(args.frames, args.worms, args.size, args.render)
+        for key, value in result.items():
+            print(f"{key:<16}{value:.3f}" if isinstance(value, float) else f"{key:<16}{value}")
+    else:
+        track_video(args.video, args.output)
+
+if __name__ == "__main__":
+    main()